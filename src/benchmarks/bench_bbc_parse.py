@@ -0,0 +1,161 @@
+"""BBC Parse Benchmark.
+
+Measures how long it takes to extract recipes from saved BBC Good Food pages,
+comparing the previous BeautifulSoup implementation, which built a full soup
+and ran CSS selectors on every page, with the precompiled lxml XPath parser.
+Also checks that both extract the same records.
+
+The pages are read from the raw HTML cache filled by the scraper, see
+`scrapers.page_cache.PageCache`.
+
+Run from the `src` directory:
+    python -m benchmarks.bench_bbc_parse ../data
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+
+from scrapers.page_cache import PageCache
+from scrapers.scrape_bbc import parse_one_article, parse_one_page
+
+
+def legacy_parse_one_page(url):
+    """The previous parse_one_page, using BeautifulSoup's html.parser."""
+    soup = BeautifulSoup(url, 'html.parser')
+    hrefs = []
+    for link in soup.find_all('a'):
+        hrefs.append(link.get('href'))
+    res = list(filter(None, hrefs))
+    links = []
+    for href in res:
+        if href.startswith('/recipes/'):
+            if (not href.startswith('/recipes/category/')
+                    and not href.startswith('/recipes/collection/')):
+                links.append(href)
+    return list(set(links))
+
+
+def legacy_parse_one_article(currenturl, link):
+    """The previous parse_one_article, using BeautifulSoup CSS selectors."""
+    if link is not None:
+        soup = BeautifulSoup(link, 'lxml')
+        name = soup.select(
+            "#__next > div.default-layout > main > div > section > div > "
+            "div.post-header__body.oflow-x-hidden > "
+            "div.headline.post-header__title.post-header__title--masthead"
+            "-layout > h1")[
+            0].get_text()
+        description = soup.select(
+            "#__next > div.default-layout > main > div > section > div > "
+            "div.post-header__body.oflow-x-hidden > "
+            "div.editor-content.mt-sm.pr-xxs.hidden-print > p")[
+            0].get_text()
+        nutrition_names = soup.select(
+            "#__next > div.default-layout > main > div > section > div > "
+            "div.post-header__body.oflow-x-hidden > table > tbody > tr > "
+            "td.key-value-blocks__key")
+        nutrition_name = []
+        for i in range(len(nutrition_names)):
+            nutrition_name.append(nutrition_names[i].get_text())
+        nutrition_values = soup.select(
+            "#__next > div.default-layout > main > div > section > div > "
+            "div.post-header__body.oflow-x-hidden > table > tbody > tr > "
+            "td.key-value-blocks__value")
+        nutrition_value = []
+        for i in range(len(nutrition_values)):
+            nutrition_value.append(nutrition_values[i].get_text())
+        ingredient_list = soup.select(
+            "#__next > div.default-layout > main > div > div > "
+            "div.layout-md-rail > div.layout-md-rail__primary > "
+            "div.post__content > div > div > "
+            "section.recipe__ingredients.col-12.mt-md.col-lg-6 > section > ul "
+            "> li")
+        ingredients = []
+        for i in range(len(ingredient_list)):
+            ingredients.append(ingredient_list[i].get_text())
+        methods = soup.select(
+            "#__next > div.default-layout > main > div > div > "
+            "div.layout-md-rail > div.layout-md-rail__primary > "
+            "div.post__content > div > div > "
+            "section.recipe__method-steps.mb-lg.col-12.col-lg-6 > div > ul > "
+            "li > div > p")
+        method = []
+        for i in range(len(methods)):
+            method.append('Step' + str(i + 1) + ': ' + methods[i].get_text())
+        data = {"name": name,
+                "description": description,
+                "nutrition_name": nutrition_name,
+                "nutrition_value": nutrition_value,
+                "ingredients": ingredients,
+                "method": method,
+                "recipe_url": currenturl}
+        return 1, data
+    return 0, None
+
+
+def parse_all(parse, pages):
+    """Parses all (url, page) pairs, treating selector misses as invalid."""
+    records = []
+    for url, page in pages:
+        try:
+            records.append(parse(url, page)[1])
+        except IndexError:
+            records.append(None)
+    return records
+
+
+def time_per_page(function, pages, repeat: int) -> float:
+    """Average time in ms the function takes per page over all passes."""
+    start = perf_counter()
+    for _ in range(repeat):
+        function(pages)
+    return (perf_counter() - start) / (repeat * len(pages)) * 1000
+
+
+def parse_args():
+    p = ArgumentParser(description="Benchmarks parsing BBC Good Food pages.")
+    p.add_argument("DATA_DIR", type=Path,
+                   help="Path to the data directory.")
+    p.add_argument("--repeat", type=int, default=3,
+                   help="Number of passes over all cached pages.")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cache = PageCache(args.DATA_DIR / "html_cache" / "bbc")
+    pages = [(url, cache.get(url)) for url in sorted(cache.urls())]
+    if not pages:
+        raise SystemExit("No cached pages found, run the BBC scraper first.")
+
+    legacy = parse_all(legacy_parse_one_article, pages)
+    current = parse_all(parse_one_article, pages)
+    mismatches = [url for (url, _), old, new in zip(pages, legacy, current)
+                  if old is not None and old != new]
+    assert not mismatches, f"Records differ for {mismatches[:5]}"
+    recovered = sum(old is None and new is not None
+                    for old, new in zip(legacy, current))
+    for _, page in pages:
+        assert set(legacy_parse_one_page(page)) == set(parse_one_page(page))
+    print(f"Records identical for {len(pages) - legacy.count(None)} pages, "
+          f"{recovered} more recovered from JSON-LD.")
+
+    t_legacy = time_per_page(
+        lambda p: parse_all(legacy_parse_one_article, p), pages, args.repeat
+    )
+    t_current = time_per_page(
+        lambda p: parse_all(parse_one_article, p), pages, args.repeat
+    )
+    print(f"parse_one_article: legacy {t_legacy:.3f} ms/page, "
+          f"lxml {t_current:.3f} ms/page ({t_legacy / t_current:.1f}x)")
+    t_legacy = time_per_page(
+        lambda p: [legacy_parse_one_page(page) for _, page in p], pages,
+        args.repeat
+    )
+    t_current = time_per_page(
+        lambda p: [parse_one_page(page) for _, page in p], pages, args.repeat
+    )
+    print(f"parse_one_page: legacy {t_legacy:.3f} ms/page, "
+          f"lxml {t_current:.3f} ms/page ({t_legacy / t_current:.1f}x)")
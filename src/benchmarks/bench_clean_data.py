@@ -0,0 +1,100 @@
+"""Clean Data Benchmark.
+
+Measures how long it takes to extract the nutrition table of a large recipe
+corpus, comparing the previous implementation, which looped over every recipe
+in Python and relied on the position of each value, with the vectorized
+`nutrition_table`. Also checks that both produce the same values.
+
+The corpus is the scraped BBC Good Food recipes repeated `--scale` times.
+
+Run from the `src` directory:
+    python -m benchmarks.bench_clean_data ../data --scale 100
+"""
+from argparse import ArgumentParser
+from ast import literal_eval
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from preprocessing.clean_data import nutrition_table, NUTRITION_COLUMNS
+
+
+def legacy_nutrition_table(recipes: pd.DataFrame) -> pd.DataFrame:
+    """The previous nutrition extraction of clean_data."""
+    name_list = []
+    kcal_list = []
+    fat_list = []
+    saturates_list = []
+    carbs_list = []
+    sugars_list = []
+    fibre_list = []
+    protein_list = []
+    salt_list = []
+    for name, item in zip(recipes["name"].tolist(),
+                          recipes['nutrition_value'].tolist()):
+        if item is not None:
+            if len(item) > 1:
+                name_list.append(name)
+                kcal_list.append(item[0])
+                fat_list.append(item[1].strip('g'))
+                saturates_list.append(item[2].strip('g'))
+                carbs_list.append(item[3].strip('g'))
+                sugars_list.append(item[4].strip('g'))
+                fibre_list.append(item[5].strip('g'))
+                protein_list.append(item[6].strip('g'))
+                salt_list.append(item[7].strip('g'))
+    val_dict = {
+        "name": name_list, 'Calories': kcal_list, 'Total Fat': fat_list,
+        'Saturated Fat': saturates_list, 'Carbohydrates': carbs_list,
+        'Sugars': sugars_list, 'Fiber': fibre_list, 'Protein': protein_list,
+        'Sodium': salt_list
+    }
+    return pd.DataFrame(val_dict)
+
+
+def load_corpus(data_dir: Path, scale: int) -> pd.DataFrame:
+    """Loads the scraped BBC recipes and repeats them `scale` times."""
+    recipes = pd.read_csv(data_dir / "recipe_bbc.csv", encoding="utf-8-sig",
+                          usecols=["name", "nutrition_name",
+                                   "nutrition_value"])
+    for column in ["nutrition_name", "nutrition_value"]:
+        recipes[column] = [None if pd.isna(x) else literal_eval(x)
+                           for x in recipes[column]]
+    corpus = pd.concat([recipes] * scale, ignore_index=True)
+    corpus["name"] = corpus["name"] + " " + (corpus.index // len(recipes)) \
+        .astype(str)
+    return corpus
+
+
+def parse_args():
+    p = ArgumentParser(description="Benchmarks nutrition table extraction.")
+    p.add_argument("DATA_DIR", type=Path,
+                   help="Path to the data directory.")
+    p.add_argument("--scale", type=int, default=100,
+                   help="Number of times the scraped recipes are repeated.")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    corpus = load_corpus(args.DATA_DIR, args.scale)
+    print(f"Corpus of {len(corpus)} recipes.")
+
+    start = perf_counter()
+    legacy = legacy_nutrition_table(corpus)
+    t_legacy = perf_counter() - start
+
+    start = perf_counter()
+    current = nutrition_table(corpus)
+    t_current = perf_counter() - start
+
+    assert legacy["name"].tolist() == current["name"].tolist(), \
+        "Recipes differ from the legacy implementation."
+    for column in NUTRITION_COLUMNS.values():
+        assert np.allclose(pd.to_numeric(legacy[column]), current[column],
+                           equal_nan=True), f"{column} differs."
+    print(f"Values identical for {len(current)} recipes.")
+    print(f"legacy: {t_legacy:.3f}s, vectorized: {t_current:.3f}s "
+          f"({t_legacy / t_current:.1f}x)")
@@ -0,0 +1,256 @@
+"""Graph Backend Benchmark.
+
+Measures how long it takes to load a synthetic corpus into the graph and to
+answer the queries of the web app, with the embedded SQLite backend of
+`knowledge_graph.repository`. Needs no database server, so that it runs
+deterministically, e.g. in CI.
+
+The corpus is the scraped BBC Good Food recipes repeated up to the requested
+size, see `benchmarks.bench_pipeline_memory`, added as both recipe datasets.
+Nutrition and substitutions are generated for its canonical ingredients.
+
+The macros of recommended recipes are timed both as the web app computed
+them before, by a traversal per recipe and nutrient, and as read from the
+table materialized while loading, see `knowledge_graph.recipe_macros`, and
+checked to be the same.
+
+The corpus is then loaded a second time, as the pipeline does when its code or
+inputs change, which is checked to leave the answers unchanged, and the
+nutrition is changed and loaded again, which is checked to update the macros.
+
+Given the port of a Neo4j database, which is cleared, the corpus is also
+loaded into it and both backends are checked to answer the queries alike.
+
+Run from the `src` directory:
+    python -m benchmarks.bench_graph_backend ../data --size 2000
+"""
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from gensim.models import KeyedVectors
+from neo4j import GraphDatabase
+
+from benchmarks.bench_pipeline_memory import build_corpus, \
+    load_bench_vectors, scrape_dataset
+from knowledge_graph.ingredients_to_graph import NV_NAME_MAP, \
+    load_ingredients
+from knowledge_graph.recipe_macros import MACROS, load_recipe_macros
+from knowledge_graph.recipes_to_graph import load_recipes
+from knowledge_graph.repository import Neo4jRepository, SQLiteRepository
+from preprocessing.clean_data import clean_data
+from preprocessing.recipe_ingredient_embedding import \
+    embed_recipe_ingredients
+
+# Nutrients the web app computes for every recommended recipe
+NUTRIENTS = list(MACROS)
+
+
+def prepare_corpus(data_dir: Path, source_dir: Path, size: int):
+    """Writes the datasets of a synthetic corpus, up to the clean tables."""
+    build_corpus(data_dir, source_dir, size)
+    scrape_dataset(data_dir, size)
+    shutil.copy(data_dir / "recipe_bbc.parquet",
+                data_dir / "studentfoodrecipe.parquet")
+    embed_recipe_ingredients(data_dir, model_loader=load_bench_vectors,
+                             use_cache=False,
+                             recipe_files=[
+                                 data_dir / "recipe_bbc.parquet",
+                                 data_dir / "studentfoodrecipe.parquet"
+                             ])
+    clean_data(data_dir)
+
+    names = KeyedVectors.load(
+        str(data_dir / "canonical_ingredient_embeddings.gz")
+    ).index_to_key
+    rng = np.random.default_rng(0)
+    pd.DataFrame({"name": names, **{
+        key: [f"{amount:.2f} g" for amount in rng.uniform(0, 30, len(names))]
+        for key in NV_NAME_MAP
+    }}).to_csv(data_dir / "nutrition.csv", index=False)
+    pd.DataFrame({"Food label": names[:-1],
+                  "Substitution label": names[1:]}).to_csv(
+        data_dir / "substitutions.csv", index=False
+    )
+
+
+def legacy_calculate_nutritional_value(nut_list):
+    """The previous `calculate_nutritional_value` of the web app."""
+    nutritional_value = 0
+    for amount, nutrient_amount in nut_list:
+        if amount is None or nutrient_amount is None:
+            continue
+        nutritional_value += amount * nutrient_amount / 100
+    return nutritional_value
+
+
+def legacy_recipe_macros(graph, recipes: List[str]) -> pd.DataFrame:
+    """The macros of recipes as the web app computed them before."""
+    return pd.DataFrame([[legacy_calculate_nutritional_value(
+        graph.recipe_nutrient_amounts(recipe, nutrient)
+    ) for nutrient in NUTRIENTS] for recipe in recipes],
+        index=recipes, columns=NUTRIENTS)
+
+
+def recipe_macros(graph, recipes: List[str]) -> pd.DataFrame:
+    """The macros of recipes looked up in the materialized table."""
+    return load_recipe_macros(graph, recipes).loc[recipes]
+
+
+def load(graph, data_dir: Path):
+    load_ingredients(graph, data_dir)
+    load_recipes(graph, data_dir)
+
+
+def check_nutrition_refresh(graph, data_dir: Path, recipes: List[str]):
+    """Checks that loading changed nutrition updates the recipe macros.
+
+    Doubles every amount of the nutrition table and loads the ingredients
+    again, restoring the table afterwards.
+    """
+    path = data_dir / "nutrition.csv"
+    original = path.read_bytes()
+    nutrition_df = pd.read_csv(path)
+    for key in NV_NAME_MAP:
+        nutrition_df[key] = [f"{2 * float(amount.split()[0]):.2f} g"
+                             for amount in nutrition_df[key]]
+    before = recipe_macros(graph, recipes)
+    try:
+        nutrition_df.to_csv(path, index=False)
+        load_ingredients(graph, data_dir)
+    finally:
+        path.write_bytes(original)
+    pd.testing.assert_frame_equal(recipe_macros(graph, recipes), 2 * before)
+    pd.testing.assert_frame_equal(recipe_macros(graph, recipes),
+                                  legacy_recipe_macros(graph, recipes),
+                                  check_names=False)
+
+
+def query_all(graph, recipes: List[str]) -> Dict[str, object]:
+    """Answers every query of the web app, in order independent form."""
+    return {
+        "canonical ingredient names":
+            sorted(graph.recipe_canonical_ingredient_names()),
+        "recipes": sorted(graph.recipes()),
+        "recipe canonical ingredients":
+            Counter(graph.recipe_canonical_ingredients()),
+        "recipe ingredients": [sorted(graph.recipe_ingredients(recipe))
+                               for recipe in recipes],
+        "recipe substitutes": [sorted(graph.recipe_substitutes(recipe))
+                               for recipe in recipes],
+        "recipe nutrient amounts": [
+            sorted(graph.recipe_nutrient_amounts(recipe, nutrient),
+                   key=repr)
+            for recipe in recipes for nutrient in NUTRIENTS
+        ],
+        "recipe macros": recipe_macros(graph, recipes).round(6).to_dict(),
+    }
+
+
+def measure(function: Callable[[], object], repeat: int = 1) -> float:
+    start = perf_counter()
+    for _ in range(repeat):
+        function()
+    return (perf_counter() - start) / repeat
+
+
+def run(graph, data_dir: Path, recipes: Optional[List[str]],
+        n_recipes: int) -> Dict[str, float]:
+    """Loads the corpus and times the load and every query, then loads it
+    again.
+
+    Args:
+        graph: The empty repository of the graph.
+        data_dir: The data directory of the corpus.
+        recipes: The recipes queried one at a time. The first `n_recipes`
+            recipes of the graph if None.
+        n_recipes: Number of recipes queried one at a time.
+    """
+    times = {"load": measure(lambda: load(graph, data_dir))}
+    if recipes is None:
+        recipes = sorted(name for name, _ in graph.recipes())[:n_recipes]
+    times.update({
+        "canonical ingredient names":
+            measure(graph.recipe_canonical_ingredient_names),
+        "recipes": measure(graph.recipes),
+        "recipe canonical ingredients":
+            measure(graph.recipe_canonical_ingredients),
+        "recipe ingredients": measure(
+            lambda: [graph.recipe_ingredients(recipe) for recipe in recipes]
+        ) / len(recipes),
+        "recipe substitutes": measure(
+            lambda: [graph.recipe_substitutes(recipe) for recipe in recipes]
+        ) / len(recipes),
+        "recipe nutrient amounts": measure(
+            lambda: [graph.recipe_nutrient_amounts(recipe, nutrient)
+                     for recipe in recipes for nutrient in NUTRIENTS]
+        ) / len(recipes),
+        "recipe macros, traversal": measure(
+            lambda: legacy_recipe_macros(graph, recipes)
+        ) / len(recipes),
+        "recipe macros, table": measure(
+            lambda: recipe_macros(graph, recipes)
+        ) / len(recipes),
+    })
+    expected = query_all(graph, recipes)
+    times["reload"] = measure(lambda: load(graph, data_dir))
+    assert query_all(graph, recipes) == expected, \
+        "Loading the corpus again changed the answers of the queries."
+    return times
+
+
+def parse_args():
+    p = ArgumentParser(description="Benchmarks loading and querying the "
+                                   "graph with the embedded backend.")
+    p.add_argument("DATA_DIR", type=Path,
+                   help="Path to the data directory holding recipe_bbc.csv.")
+    p.add_argument("--size", type=int, default=2000,
+                   help="Number of recipes per dataset of the corpus.")
+    p.add_argument("--recipes", type=int, default=100,
+                   help="Number of recipes queried one at a time.")
+    p.add_argument("--port", type=str, default=None,
+                   help="Port of a Neo4j database to compare with. It is "
+                        "cleared.")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = Path(tmp_dir)
+        prepare_corpus(data_dir, args.DATA_DIR, args.size)
+
+        with SQLiteRepository() as graph:
+            results["sqlite"] = run(graph, data_dir, None, args.recipes)
+            recipes = sorted(name for name, _
+                             in graph.recipes())[:args.recipes]
+            expected = query_all(graph, recipes)
+            pd.testing.assert_frame_equal(
+                recipe_macros(graph, recipes),
+                legacy_recipe_macros(graph, recipes), check_names=False
+            )
+            check_nutrition_refresh(graph, data_dir, recipes)
+
+        if args.port is not None:
+            driver = GraphDatabase.driver(f"bolt://localhost:{args.port}",
+                                          auth=("neo4j", "password"))
+            with driver.session() as session:
+                session.run("""MATCH (a) CALL { WITH a DETACH DELETE a }
+                               IN TRANSACTIONS OF 10000 ROWS""").consume()
+            with Neo4jRepository(driver) as graph:
+                results["neo4j"] = run(graph, data_dir, recipes,
+                                       args.recipes)
+                assert query_all(graph, recipes) == expected, \
+                    "The backends answer the queries differently."
+            print("Both backends answer the queries alike.")
+
+    print(f"\nLoading {args.size} recipes per dataset, queries of single "
+          f"recipes per recipe (ms):")
+    print((pd.DataFrame(results) * 1000).round(2).to_string())
@@ -0,0 +1,197 @@
+"""Graph Load Benchmark.
+
+Measures how long it takes to add the ingredients of all recipes to the
+graph, comparing the previous implementation, which merged the ingredients
+and relationships of every recipe in sessions of their own, with merging
+every distinct ingredient once and writing the relationships in batches of
+concurrent transactions. Also checks that both build the same graph.
+
+Needs a running Neo4j database, which is cleared before every run, and the
+prepared datasets of the data directory (embedded datasets, clean tables and
+canonical ingredient embeddings).
+
+Run from the `src` directory:
+    python -m benchmarks.bench_graph_load ../data 7687 --workers 1 4 8
+"""
+from argparse import ArgumentParser
+from itertools import chain
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, List
+
+import pandas as pd
+from gensim.models import KeyedVectors
+from neo4j import Driver, GraphDatabase
+from tqdm import tqdm
+
+from knowledge_graph.ingredients_to_graph import add_all_canonical_ingredients
+from knowledge_graph.recipes_to_graph import EMBEDDED_DATASETS, \
+    add_canonical_ingredient_relation, add_ingredients, \
+    add_recipe_ingredients, add_recipes
+from knowledge_graph.repository import Neo4jRepository
+from preprocessing.dataset_store import iter_embedded
+
+
+def legacy_add_recipe_ingredients(driver: Driver, recipe_df: pd.DataFrame):
+    """The previous `add_recipe_ingredients`."""
+    def embeddings_to_list(ingredient_list):
+        out = []
+        for ingredient in ingredient_list:
+            if ingredient["embedding"] is not None:
+                e = (ingredient["embedding"].tolist())
+            else:
+                e = None
+            out.append({"original_name": ingredient["original_name"],
+                        "amount": ingredient["amount"],
+                        "grams": ingredient.get("grams"),
+                        "canonical_name": ingredient["canonical_name"],
+                        "embedding": e})
+        return out
+    recipe_df["ingredients"] = recipe_df["ingredients"].apply(
+        lambda x: embeddings_to_list(x))
+    records = recipe_df.to_dict("records")
+
+    for record in tqdm(records, desc="Adding recipe ingredients"):
+        with driver.session() as session:
+            run_str = """ UNWIND $ingredients as row
+                          MERGE (a:Ingredient {name: row.original_name})
+                          ON CREATE SET a.embedding = row.embedding
+                          """
+            session.run(run_str, ingredients=record["ingredients"])
+
+        relations = []
+        for ingredient in record["ingredients"]:
+            relations.append({"origin": record["name"],
+                              "target": ingredient["original_name"],
+                              "amount": ingredient["amount"],
+                              "grams": ingredient.get("grams")})
+        with driver.session() as session:
+            run_str = """UNWIND $relations as row
+                         MATCH (a:Recipe {name: row.origin}),
+                               (b:Ingredient {name: row.target})
+                         MERGE (a)-[r:HAS_INGREDIENT]->(b)
+                         ON CREATE SET r.amount = row.amount,
+                                       r.grams =  row.grams
+                         """
+            session.run(run_str, relations=relations)
+
+
+def legacy_add_canonical_ingredient_relation(driver: Driver,
+                                             recipe_df: pd.DataFrame):
+    """The previous `add_canonical_ingredient_relation`."""
+    records = recipe_df.to_dict("records")
+
+    for record in tqdm(records, desc="Adding ingredient canonical relations"):
+        relations = []
+        for ingredient in record["ingredients"]:
+            relations.append({"origin": ingredient["original_name"],
+                              "target": ingredient["canonical_name"]})
+        with driver.session() as session:
+            run_str = """ UNWIND $relations as row
+                          MATCH (a:Ingredient {name: row.origin}),
+                                (b:CanonicalIngredient {name: row.target})
+                          MERGE (a)-[r:HAS_CANONICAL_NAME]->(b) """
+            session.run(run_str, relations=relations)
+
+
+def legacy_load(driver: Driver, embedded_dirs: List[Path]):
+    for embedded_dir in embedded_dirs:
+        for embedded_df in iter_embedded(embedded_dir):
+            legacy_add_recipe_ingredients(driver, embedded_df)
+            legacy_add_canonical_ingredient_relation(driver, embedded_df)
+
+
+def batched_load(driver: Driver, embedded_dirs: List[Path], workers: int):
+    graph = Neo4jRepository(driver, workers)
+    add_ingredients(graph, embedded_dirs)
+    for embedded_dir in embedded_dirs:
+        for embedded_df in iter_embedded(embedded_dir):
+            add_recipe_ingredients(graph, embedded_df)
+            add_canonical_ingredient_relation(graph, embedded_df)
+
+
+def prepare_graph(driver: Driver, data_dir: Path):
+    """Clears the database and adds the recipes and canonical ingredients."""
+    with driver.session() as session:
+        session.run("""MATCH (a) CALL { WITH a DETACH DELETE a }
+                       IN TRANSACTIONS OF 10000 ROWS""").consume()
+    graph = Neo4jRepository(driver)
+    graph.create_schema()
+    add_recipes(graph, pd.read_csv(data_dir / "clean_datasets" /
+                                   "recipes.csv"))
+    add_all_canonical_ingredients(graph, KeyedVectors.load(
+        str(data_dir / "canonical_ingredient_embeddings.gz")
+    ))
+
+
+def snapshot(driver: Driver) -> dict:
+    """The ingredients and their relationships in the graph."""
+    queries = {
+        "ingredients": """MATCH (a:Ingredient)
+                          RETURN a.name, a.embedding ORDER BY a.name""",
+        "recipe ingredients": """MATCH (a:Recipe)-[r:HAS_INGREDIENT]->(b)
+                                 RETURN a.name, b.name, r.amount, r.grams
+                                 ORDER BY a.name, b.name""",
+        "canonical names": """MATCH (a:Ingredient)-[:HAS_CANONICAL_NAME]->(b)
+                              RETURN a.name, b.name
+                              ORDER BY a.name, b.name""",
+    }
+    with driver.session() as session:
+        return {name: [tuple(record.values())
+                       for record in session.run(query)]
+                for name, query in queries.items()}
+
+
+def measure(driver: Driver, data_dir: Path,
+            load: Callable[[], object]) -> float:
+    prepare_graph(driver, data_dir)
+    start = perf_counter()
+    load()
+    return perf_counter() - start
+
+
+def parse_args():
+    p = ArgumentParser(description="Benchmarks adding the ingredients of all "
+                                   "recipes to the graph.")
+    p.add_argument("DATA_DIR", type=Path,
+                   help="Path to the data directory.")
+    p.add_argument("PORT", type=str,
+                   help="Port used to connect to the database.")
+    p.add_argument("--user", type=str, default="neo4j",
+                   help="User to authenticate as.")
+    p.add_argument("--password", type=str, default="password",
+                   help="Password to authenticate with.")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 4],
+                   help="Numbers of concurrent write transactions to "
+                        "measure.")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    driver = GraphDatabase.driver(f"bolt://localhost:{args.PORT}",
+                                  auth=(args.user, args.password))
+    embedded_dirs = [args.DATA_DIR / name for name in EMBEDDED_DATASETS]
+    n_ingredients = len({ingredient["original_name"] for ingredient in
+                         chain.from_iterable(chain.from_iterable(
+                             df["ingredients"] for path in embedded_dirs
+                             for df in iter_embedded(path)
+                         ))})
+
+    t_legacy = measure(driver, args.DATA_DIR,
+                       lambda: legacy_load(driver, embedded_dirs))
+    expected = snapshot(driver)
+    results = {"legacy": t_legacy}
+    for workers in args.workers:
+        results[f"batched, {workers} workers"] = measure(
+            driver, args.DATA_DIR,
+            lambda: batched_load(driver, embedded_dirs, workers)
+        )
+        assert snapshot(driver) == expected, \
+            f"Graph differs with {workers} workers."
+    driver.close()
+
+    print(f"\nAdding {n_ingredients} distinct ingredients and their "
+          f"relationships:")
+    for name, t in results.items():
+        print(f"{name:<22} {t:8.2f}s  {t_legacy / t:6.1f}x")
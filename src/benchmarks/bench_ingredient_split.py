@@ -0,0 +1,69 @@
+"""Ingredient Split Benchmark.
+
+Measures the per-line cost of splitting ingredient strings into amount and
+ingredient, comparing the previous implementation, which rebuilt and
+recompiled its regexes on every call, with the precompiled module-level
+parser. Also checks that both produce the same output.
+
+Run from the `src` directory:
+    python -m benchmarks.bench_ingredient_split ../data
+"""
+import re
+from argparse import ArgumentParser
+from pathlib import Path
+from timeit import timeit
+
+import pandas as pd
+
+from preprocessing.recipe_ingredient_embedding import ingredient_split, \
+    parse_ingredients, UNITS, WORD_QTYS
+
+
+def legacy_ingredient_split(ingredient: str):
+    """The previous ingredient_split, which builds its regexes per call."""
+    units = "|".join(list(UNITS))
+    word_qtys = "|".join(list(WORD_QTYS))
+    fraction_codes = r"[\u00BC-\u00BE]|[\u2150-\u215E]|\d/\d"
+    regex_str = rf"^((\d+|{word_qtys}|{fraction_codes})\s*-*\s*)*({units})*"
+    regex_amt_matcher = re.compile(regex_str, re.IGNORECASE)
+
+    end_of_amount_str = regex_amt_matcher.match(ingredient).end()
+    amount = ingredient[0:end_of_amount_str].strip()
+    ingredient = ingredient[end_of_amount_str:]
+
+    parentheses_regex = re.compile(r"\(.*\)|\[.*]")
+    ingredient = parentheses_regex.sub("", ingredient)
+    ingredient = ingredient.strip()
+
+    return amount, ingredient
+
+
+def parse_args():
+    p = ArgumentParser(description="Benchmarks ingredient splitting.")
+    p.add_argument("DATA_DIR", type=Path,
+                   help="Path to the data directory.")
+    p.add_argument("--repeat", type=int, default=5,
+                   help="Number of passes over all ingredient lines.")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    lines = pd.read_csv(args.DATA_DIR / "clean_datasets" / "ingredients.csv")
+    lines = lines["ingredients"].dropna().tolist()
+
+    legacy = [legacy_ingredient_split(line) for line in lines]
+    current = [ingredient_split(line) for line in lines]
+    assert legacy == current, "Outputs differ from the legacy parser."
+    print(f"Outputs identical for {len(lines)} ingredient lines.")
+
+    n = len(lines) * args.repeat
+    t_legacy = timeit(lambda: [legacy_ingredient_split(x) for x in lines],
+                      number=args.repeat) / n * 1e6
+    t_split = timeit(lambda: [ingredient_split(x) for x in lines],
+                     number=args.repeat) / n * 1e6
+    t_batch = timeit(lambda: parse_ingredients(lines),
+                     number=args.repeat) / n * 1e6
+    print(f"legacy ingredient_split: {t_legacy:.2f} us/line")
+    print(f"ingredient_split:        {t_split:.2f} us/line")
+    print(f"parse_ingredients:       {t_batch:.2f} us/line")
@@ -0,0 +1,242 @@
+"""Pipeline Memory Benchmark.
+
+Measures the peak memory (RSS) of every pipeline stage on synthetic corpora
+of growing size, comparing processing whole datasets at once with streaming
+them in chunks (`--chunk-size` of `prepare_database.py`). Also checks that
+both modes produce the same datasets.
+
+The corpus is the scraped BBC Good Food recipes repeated up to the requested
+size. The stages are:
+
+    scrape: Writing the scraped dataset from the checkpoint of parsed recipes,
+            as the scrapers do after fetching. Whole mode uses the previous
+            implementation, which loaded every parsed recipe.
+    embed:  `embed_recipe_ingredients`, with random word vectors for the
+            words of the corpus instead of GloVe.
+    clean:  `clean_data`.
+    load:   Reading the clean tables and embedded datasets in the way
+            `add_recipes_to_graph` does, without writing to a database.
+
+Every stage runs in a fresh process, so that its peak RSS is its own.
+
+Run from the `src` directory:
+    python -m benchmarks.bench_pipeline_memory ../data --sizes 2000 200000
+"""
+import json
+import multiprocessing
+import resource
+import tempfile
+from argparse import ArgumentParser
+from ast import literal_eval
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from gensim.models import KeyedVectors
+
+from preprocessing.clean_data import clean_data
+from preprocessing.dataset_store import CHUNK_SIZE, RECIPE_COLUMNS, \
+    iter_embedded, save_recipes, write_recipe_records
+from preprocessing.recipe_ingredient_embedding import \
+    embed_recipe_ingredients, ingredient_split
+from preprocessing.word_embedding import normalize_ingredient_string
+from scrapers.page_cache import RecordCheckpoint
+
+STAGES = ["scrape", "embed", "clean", "load"]
+VECTOR_SIZE = 50
+
+
+def load_bench_vectors(data_dir: Path) -> KeyedVectors:
+    """Loads the random word vectors of the benchmark corpus."""
+    return KeyedVectors.load(str(data_dir / "bench_vectors.kv"))
+
+
+def build_corpus(data_dir: Path, source_dir: Path, size: int):
+    """Writes a checkpoint of `size` recipes and matching word vectors.
+
+    Args:
+        data_dir: The data directory of the benchmark run.
+        source_dir: The data directory holding `recipe_bbc.csv`.
+        size: Number of recipes in the corpus.
+    """
+    recipes = pd.read_csv(source_dir / "recipe_bbc.csv", encoding="utf-8-sig")
+    list_columns = ["nutrition_name", "nutrition_value", "ingredients",
+                    "method"]
+    for column in list_columns:
+        recipes[column] = [None if pd.isna(x) else literal_eval(x)
+                           for x in recipes[column]]
+    records = recipes[RECIPE_COLUMNS].to_dict("records")
+
+    with open(data_dir / "recipe_bbc_checkpoint.jsonl", "w") as f:
+        for i in range(size):
+            record = dict(records[i % len(records)])
+            record["name"] = f"{record['name']} {i // len(records)}"
+            record["recipe_url"] = f"{record['recipe_url']}?copy={i}"
+            f.write(json.dumps(record) + "\n")
+    (data_dir / "bbc_recipe_urls.txt").write_text("".join(
+        f"{records[i % len(records)]['recipe_url']}?copy={i}\n"
+        for i in range(size)
+    ))
+
+    # Random vectors for every word of the ingredients, and canonical
+    # ingredients named after the first word of some of them
+    words = set()
+    canonical = set()
+    for record in records:
+        for ingredient in record["ingredients"]:
+            _, name = ingredient_split(ingredient)
+            name_words = normalize_ingredient_string(name).split()
+            words.update(name_words)
+            if name_words:
+                canonical.add(name_words[0])
+    rng = np.random.default_rng(0)
+    model = KeyedVectors(VECTOR_SIZE)
+    words = sorted(words)
+    model.add_vectors(words, rng.standard_normal(
+        (len(words), VECTOR_SIZE)).astype(np.float32))
+    model.save(str(data_dir / "bench_vectors.kv"))
+    canonical_embeddings = KeyedVectors(VECTOR_SIZE)
+    canonical = sorted(canonical)[::4]
+    canonical_embeddings.add_vectors(
+        canonical, np.stack([model.get_vector(word) for word in canonical])
+    )
+    canonical_embeddings.save(
+        str(data_dir / "canonical_ingredient_embeddings.gz")
+    )
+    (data_dir / "clean_datasets").mkdir()
+
+
+def legacy_scrape_dataset(data_dir: Path):
+    """The previous dataset writing of the scrapers.
+
+    Every parsed recipe was loaded from the checkpoint before the dataset was
+    written at once.
+    """
+    checkpoint = RecordCheckpoint(data_dir / "recipe_bbc_checkpoint.jsonl")
+    offsets = checkpoint.index()
+    parsed = dict(zip(offsets, checkpoint.iter_records(offsets.values())))
+    data = {column: [] for column in RECIPE_COLUMNS}
+    for link in (data_dir / "bbc_recipe_urls.txt").read_text().split():
+        recipe_data = parsed.get(link.strip())
+        if recipe_data is not None:
+            for key, value in recipe_data.items():
+                data[key].append(value)
+    save_recipes(pd.DataFrame(data), data_dir / "recipe_bbc.parquet")
+
+
+def scrape_dataset(data_dir: Path, chunk_size: int):
+    """The dataset writing of the scrapers, streamed from the checkpoint."""
+    checkpoint = RecordCheckpoint(data_dir / "recipe_bbc_checkpoint.jsonl")
+    parsed = checkpoint.index()
+    urls = [link.strip() for link
+            in (data_dir / "bbc_recipe_urls.txt").read_text().split()]
+    write_recipe_records(
+        checkpoint.iter_records(parsed[url] for url in urls if url in parsed),
+        data_dir / "recipe_bbc.parquet", chunk_size
+    )
+
+
+def read_for_graph(data_dir: Path, chunk_size: Optional[int]):
+    """Reads the datasets as `add_recipes_to_graph` does."""
+    clean_dir = data_dir / "clean_datasets"
+    for name in ["recipes.csv", "values.csv"]:
+        chunks = [pd.read_csv(clean_dir / name)] if chunk_size is None \
+            else pd.read_csv(clean_dir / name, chunksize=chunk_size)
+        for chunk in chunks:
+            chunk.to_dict("records")
+    for embedded_df in iter_embedded(data_dir / "recipe_bbc_embedded",
+                                     chunk_size):
+        # The ingredients are sent to the database with list embeddings
+        [[None if ingredient["embedding"] is None
+          else ingredient["embedding"].tolist()
+          for ingredient in ingredient_list]
+         for ingredient_list in embedded_df["ingredients"]]
+
+
+def run_stage(stage: str, data_dir: Path,
+              chunk_size: Optional[int]) -> float:
+    """Runs a stage and returns the peak RSS of the process in MB."""
+    if stage == "scrape":
+        if chunk_size is None:
+            legacy_scrape_dataset(data_dir)
+        else:
+            scrape_dataset(data_dir, chunk_size)
+    elif stage == "embed":
+        embed_recipe_ingredients(data_dir, model_loader=load_bench_vectors,
+                                 use_cache=False,
+                                 recipe_files=[data_dir /
+                                               "recipe_bbc.parquet"],
+                                 chunk_size=chunk_size)
+    elif stage == "clean":
+        clean_data(data_dir, chunk_size)
+    else:
+        read_for_graph(data_dir, chunk_size)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def assert_same_outputs(whole_dir: Path, stream_dir: Path):
+    """Checks that both modes wrote the same datasets."""
+    files = ["recipe_bbc.parquet", "recipe_bbc_embedded/recipes.parquet",
+             "recipe_bbc_embedded/ingredients.parquet"]
+    for file in files:
+        assert pq.read_table(whole_dir / file).equals(
+            pq.read_table(stream_dir / file)), f"{file} differs."
+    for file in ["recipes.csv", "values.csv"]:
+        file = Path("clean_datasets") / file
+        assert (whole_dir / file).read_bytes() == \
+            (stream_dir / file).read_bytes(), f"{file} differs."
+    assert (whole_dir / "recipe_bbc_embedded" / "embeddings.arrow")\
+        .read_bytes() == (stream_dir / "recipe_bbc_embedded" /
+                          "embeddings.arrow").read_bytes(), \
+        "embeddings.arrow differs."
+
+
+def parse_args():
+    p = ArgumentParser(description="Benchmarks the peak memory of every "
+                                   "pipeline stage.")
+    p.add_argument("DATA_DIR", type=Path,
+                   help="Path to the data directory.")
+    p.add_argument("--sizes", type=int, nargs="+",
+                   default=[2000, 20000, 200000],
+                   help="Numbers of recipes in the synthetic corpora.")
+    p.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                   help="Number of recipes per chunk when streaming.")
+    p.add_argument("--streaming-only", action="store_true",
+                   help="Skip the whole mode, which needs memory in "
+                        "proportion to the corpus.")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # Fresh processes, so that no memory is inherited from this one
+    context = multiprocessing.get_context("spawn")
+    modes = {"streaming": args.chunk_size}
+    if not args.streaming_only:
+        modes = {"whole": None, **modes}
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dirs = {}
+            for mode in modes:
+                dirs[mode] = Path(tmp_dir) / mode
+                dirs[mode].mkdir()
+                build_corpus(dirs[mode], args.DATA_DIR, size)
+            for stage in STAGES:
+                for mode, chunk_size in modes.items():
+                    with context.Pool(1) as pool:
+                        peak = pool.apply(run_stage,
+                                          (stage, dirs[mode], chunk_size))
+                    results.append((size, stage, mode, peak))
+                    print(f"{size} recipes, {stage}, {mode}: {peak:.0f} MB")
+            if not args.streaming_only:
+                assert_same_outputs(dirs["whole"], dirs["streaming"])
+                print(f"Outputs identical for {size} recipes.")
+
+    print(f"\nPeak RSS per stage (MB), streaming in chunks of "
+          f"{args.chunk_size} recipes:")
+    print(pd.DataFrame(results, columns=["recipes", "stage", "mode", "peak"])
+          .pivot(index="stage", columns=["mode", "recipes"], values="peak")
+          .reindex(STAGES).round(0).to_string())
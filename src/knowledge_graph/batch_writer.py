@@ -0,0 +1,247 @@
+"""Batch Writer.
+
+Writes many nodes, or relationships between nodes matched by name, in large
+batches.
+
+Nodes and relationships are given as flat rows with their names, or the names
+of their start and end node, and their properties. The rows are streamed
+through long-lived sessions in batches, each written by a single `UNWIND`
+query in its own managed write transaction, so that thousands of rows take a
+few round trips. Nodes are matched with `{name: ...}` patterns, which are
+answered by the index behind a uniqueness constraint on the name, see
+`knowledge_graph.schema`.
+
+Batches can be written by several concurrent transactions, each worker with
+its own session. Concurrent batches locking the same nodes may deadlock, in
+which case the batch is retried.
+"""
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from time import perf_counter, sleep
+from typing import Iterable, Iterator, List, Optional
+
+from neo4j import Driver, ManagedTransaction, Session
+from neo4j.exceptions import TransientError
+from tqdm import tqdm
+
+# Number of relationships created per transaction
+RELATIONSHIP_BATCH_SIZE = 10000
+
+# Number of concurrent write transactions
+WRITE_WORKERS = 4
+
+# Number of times a batch is retried once the driver gives up on a deadlock
+DEADLOCK_RETRIES = 5
+
+
+def node_query(label: str, properties: List[str],
+               vector_property: Optional[str] = None,
+               update_properties: List[str] = ()) -> str:
+    """Builds the query merging a batch of nodes by name.
+
+    Args:
+        label: Label of the nodes.
+        properties: Keys of the rows which are set as node properties when a
+            node is created.
+        vector_property: Key of the rows holding an embedding, which is set
+            as a float32 vector property on nodes which have none yet.
+        update_properties: Keys of the rows which are also set as node
+            properties when a node exists already.
+    """
+    query = f"""UNWIND $rows AS row
+                MERGE (a:{label} {{name: row.name}})"""
+    if properties:
+        query += "\n                ON CREATE SET " + ", ".join(
+            f"a.{key} = row.{key}" for key in properties
+        )
+    if update_properties:
+        query += "\n                ON MATCH SET " + ", ".join(
+            f"a.{key} = row.{key}" for key in update_properties
+        )
+    if vector_property is not None:
+        query += f"""
+                WITH a, row
+                WHERE a.{vector_property} IS NULL
+                  AND row.{vector_property} IS NOT NULL
+                CALL db.create.setNodeVectorProperty(a, '{vector_property}',
+                                                     row.{vector_property})"""
+    return query
+
+
+def relationship_query(origin_label: str, target_label: str,
+                       relationship: str, properties: List[str],
+                       merge: bool = False, update: bool = False) -> str:
+    """Builds the query creating a batch of relationships.
+
+    Args:
+        origin_label: Label of the start nodes.
+        target_label: Label of the end nodes.
+        relationship: Type of the relationships.
+        properties: Keys of the rows which are set as relationship
+            properties.
+        merge: Whether relationships are merged, setting their properties
+            only when they are created, rather than always created.
+        update: Whether merged relationships which exist already get their
+            properties set too, so that writing the rows again updates
+            rather than duplicates them.
+    """
+    query = f"""UNWIND $rows AS row
+                MATCH (a:{origin_label} {{name: row.origin}})
+                MATCH (b:{target_label} {{name: row.target}})"""
+    if merge:
+        query += f"\n                MERGE (a)-[r:{relationship}]->(b)"
+        if properties:
+            query += "\n                " + \
+                ("SET " if update else "ON CREATE SET ") + ", ".join(
+                f"r.{key} = row.{key}" for key in properties
+            )
+        return query
+    set_properties = ", ".join(f"{key}: row.{key}" for key in properties)
+    if set_properties:
+        set_properties = f" {{{set_properties}}}"
+    return query + \
+        f"\n                CREATE (a)-[r:{relationship}{set_properties}]->(b)"
+
+
+def _run_batch(tx: ManagedTransaction, query: str, rows: List[dict]):
+    tx.run(query, rows=rows).consume()
+
+
+def _write_batch(session: Session, query: str, rows: List[dict]):
+    """Writes a batch, retrying it with backoff if it keeps deadlocking."""
+    for attempt in range(DEADLOCK_RETRIES + 1):
+        try:
+            # Managed transactions already retry transient errors such as
+            # deadlocks for a while
+            session.execute_write(_run_batch, query, rows)
+            return
+        except TransientError:
+            if attempt == DEADLOCK_RETRIES:
+                raise
+            sleep(0.1 * 2 ** attempt * (1 + random.random()))
+
+
+def write_batches(driver: Driver, query: str, rows: Iterable[dict],
+                  batch_size: int = RELATIONSHIP_BATCH_SIZE,
+                  workers: int = 1, desc: str = "Writing") -> int:
+    """Runs a query on batches of rows in concurrent write transactions.
+
+    Args:
+        driver: The database driver.
+        query: The query, which unwinds the batch given as `$rows`.
+        rows: The rows. May be a generator, only the batches being written
+            are kept in memory.
+        batch_size: Number of rows per transaction.
+        workers: Number of concurrent write transactions.
+        desc: Description shown on the progress bar.
+
+    Returns:
+        The number of rows written.
+    """
+    rows = iter(rows)
+    batches: Iterator[List[dict]] = iter(
+        lambda: list(islice(rows, batch_size)), []
+    )
+    lock = threading.Lock()
+
+    def write(bar: tqdm) -> int:
+        count = 0
+        with driver.session() as session:
+            while True:
+                with lock:
+                    batch = next(batches, None)
+                if batch is None:
+                    return count
+                _write_batch(session, query, batch)
+                count += len(batch)
+                with lock:
+                    bar.update(len(batch))
+
+    with tqdm(desc=desc, unit=" rows") as bar:
+        if workers == 1:
+            return write(bar)
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(write, bar) for _ in range(workers)]
+            return sum(future.result() for future in futures)
+
+
+def write_nodes(driver: Driver, rows: Iterable[dict], label: str,
+                properties: List[str] = (),
+                vector_property: Optional[str] = None,
+                batch_size: int = RELATIONSHIP_BATCH_SIZE,
+                workers: int = 1, desc: str = "Adding nodes",
+                update_properties: List[str] = ()) -> int:
+    """Merges nodes by name, in batches.
+
+    Args:
+        driver: The database driver.
+        rows: One dictionary per node, with its name as "name" and the keys
+            of `properties`. Names should be distinct, as concurrent
+            transactions merging the same name may create it twice.
+        label: Label of the nodes.
+        properties: Keys of the rows which are set as node properties when a
+            node is created.
+        vector_property: Key of the rows holding an embedding, see
+            `node_query`.
+        batch_size: Number of nodes per transaction.
+        workers: Number of concurrent write transactions.
+        desc: Description shown on the progress bar.
+        update_properties: Keys of the rows which are also set as node
+            properties when a node exists already.
+
+    Returns:
+        The number of rows written.
+    """
+    start = perf_counter()
+    query = node_query(label, list(properties), vector_property,
+                       list(update_properties))
+    count = write_batches(driver, query, rows, batch_size, workers, desc)
+    t = perf_counter() - start
+    print(f"Done adding {count} {label} nodes. {t=:.3f} "
+          f"({count / max(t, 1e-9):.0f} rows/s)")
+    return count
+
+
+def write_relationships(driver: Driver, rows: Iterable[dict],
+                        origin_label: str, target_label: str,
+                        relationship: str, properties: List[str] = (),
+                        batch_size: int = RELATIONSHIP_BATCH_SIZE,
+                        desc: str = "Adding relationships",
+                        merge: bool = False, workers: int = 1,
+                        update: bool = False) -> int:
+    """Creates relationships between nodes matched by name, in batches.
+
+    Args:
+        driver: The database driver.
+        rows: One dictionary per relationship, with the name of the start
+            node as "origin", the name of the end node as "target" and the
+            keys of `properties`. May be a generator, only one batch is kept
+            in memory at a time.
+        origin_label: Label of the start nodes.
+        target_label: Label of the end nodes.
+        relationship: Type of the relationships.
+        properties: Keys of the rows which are set as relationship
+            properties.
+        batch_size: Number of relationships per transaction.
+        desc: Description shown on the progress bar.
+        merge: Whether relationships are merged, setting their properties
+            only when they are created, rather than always created. Pairs of
+            nodes should then be distinct, as concurrent transactions merging
+            the same pair may create the relationship twice.
+        workers: Number of concurrent write transactions.
+        update: Whether merged relationships which exist already get their
+            properties set too, see `relationship_query`.
+
+    Returns:
+        The number of rows written.
+    """
+    query = relationship_query(origin_label, target_label, relationship,
+                               list(properties), merge, update)
+    start = perf_counter()
+    count = write_batches(driver, query, rows, batch_size, workers, desc)
+    t = perf_counter() - start
+    print(f"Done adding {count} {relationship} relationships. {t=:.3f} "
+          f"({count / max(t, 1e-9):.0f} rows/s)")
+    return count
@@ -0,0 +1,381 @@
+"""Bulk Import.
+
+Writes the whole knowledge graph as CSV files for `neo4j-admin database
+import`, which builds a new database offline in a fraction of the time the
+loaders take to add the graph through the database connection.
+
+The files are written straight from the embedded datasets, the canonical
+ingredient embeddings, `nutrition.csv` and `substitutions.csv`:
+
+    recipes.csv:                       Recipe nodes.
+    ingredients.csv:                   Ingredient nodes.
+    canonical_ingredients.csv:         CanonicalIngredient nodes.
+    nutritional_values.csv:            NutritionalValue nodes.
+    has_ingredient.csv:                Recipe -> Ingredient.
+    has_canonical_name.csv:            Ingredient -> CanonicalIngredient.
+    has_substitute.csv:                CanonicalIngredient -> itself.
+    recipe_nutritional_values.csv:     Recipe -> NutritionalValue.
+    ingredient_nutritional_values.csv: CanonicalIngredient -> NutritionalValue.
+
+Nodes are identified by their name within their label, e.g.
+`name:ID(Recipe)`, so relationships refer to them by name like the loaders
+do. The graph is the one the loaders build: nodes with the same name are
+merged, keeping the properties of the first, and relationships to nodes
+which do not exist are left out.
+
+Run from the `src` directory, then run the printed command with the database
+stopped and create the constraints and indexes once it is started again:
+    python -m knowledge_graph.bulk_import DATA_DIR
+    python -m knowledge_graph.schema PORT
+"""
+import shlex
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from gensim.models import KeyedVectors
+from tqdm import tqdm
+
+from knowledge_graph.ingredients_to_graph import NV_NAME_MAP, \
+    parse_substitutions
+from knowledge_graph.recipes_to_graph import EMBEDDED_DATASETS
+from preprocessing.clean_data import NUTRITION_COLUMNS, nutrition_table
+from preprocessing.dataset_store import CHUNK_SIZE, iter_embedded_tables, \
+    load_embeddings, table_to_pandas
+from preprocessing.quantities import parse_nutrient_amount
+
+# Separates the values of array properties, e.g. embeddings
+ARRAY_DELIMITER = ";"
+
+
+def _columns(*names: str) -> pa.Schema:
+    """Columns of an import file, strings unless typed as doubles."""
+    return pa.schema([(name, pa.float64() if name.endswith(":double")
+                       else pa.string()) for name in names])
+
+
+# The import files with their kind, label or relationship type and columns
+IMPORT_FILES = {
+    "recipes.csv": ("nodes", "Recipe", _columns(
+        "name:ID(Recipe)", "id", "description", "url", "method"
+    )),
+    "ingredients.csv": ("nodes", "Ingredient", _columns(
+        "name:ID(Ingredient)", "embedding:float[]"
+    )),
+    "canonical_ingredients.csv": ("nodes", "CanonicalIngredient", _columns(
+        "name:ID(CanonicalIngredient)", "id", "embedding:float[]"
+    )),
+    "nutritional_values.csv": ("nodes", "NutritionalValue", _columns(
+        "name:ID(NutritionalValue)", "id"
+    )),
+    "has_ingredient.csv": ("relationships", "HAS_INGREDIENT", _columns(
+        ":START_ID(Recipe)", ":END_ID(Ingredient)", "amount", "grams:double"
+    )),
+    "has_canonical_name.csv": ("relationships", "HAS_CANONICAL_NAME",
+                               _columns(":START_ID(Ingredient)",
+                                        ":END_ID(CanonicalIngredient)")),
+    "has_substitute.csv": ("relationships", "HAS_SUBSTITUTE", _columns(
+        ":START_ID(CanonicalIngredient)", ":END_ID(CanonicalIngredient)"
+    )),
+    "recipe_nutritional_values.csv": (
+        "relationships", "HAS_NUTRITIONAL_VALUE",
+        _columns(":START_ID(Recipe)", ":END_ID(NutritionalValue)",
+                 "amount:double")
+    ),
+    "ingredient_nutritional_values.csv": (
+        "relationships", "HAS_NUTRITIONAL_VALUE",
+        _columns(":START_ID(CanonicalIngredient)",
+                 ":END_ID(NutritionalValue)", "amount:double")
+    ),
+}
+
+
+def bulk_import_dir(data_dir: Path) -> Path:
+    """Directory of the import files within the data directory."""
+    return data_dir / "bulk_import"
+
+
+def import_files(data_dir: Path) -> List[Path]:
+    """Paths of all import files."""
+    return [bulk_import_dir(data_dir) / name for name in IMPORT_FILES]
+
+
+def import_command(data_dir: Path, database: str = "neo4j") -> List[str]:
+    """The neo4j-admin command importing the files into a new database.
+
+    Args:
+        data_dir: Path to the data directory.
+        database: Name of the database, which is replaced.
+    """
+    command = ["neo4j-admin", "database", "import", "full"]
+    for path in import_files(data_dir):
+        kind, label, _ = IMPORT_FILES[path.name]
+        command.append(f"--{kind}={label}={path.resolve()}")
+    return command + [f"--array-delimiter={ARRAY_DELIMITER}",
+                      "--multiline-fields=true", "--overwrite-destination",
+                      database]
+
+
+def import_command_line(data_dir: Path, database: str = "neo4j") -> str:
+    """The command of `import_command` as a line to run in a shell."""
+    return shlex.join(import_command(data_dir, database))
+
+
+class ImportWriter:
+    """Writes the import files chunk by chunk.
+
+    Files are written next to their final path and only replace it once all
+    of them are complete.
+    """
+    def __init__(self, out_dir: Path):
+        self.out_dir = out_dir
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.counts = {name: 0 for name in IMPORT_FILES}
+        self._writers = {}
+
+    def _tmp_path(self, name: str) -> Path:
+        return self.out_dir / (name + ".tmp")
+
+    def write(self, name: str, columns: List[Iterable]):
+        """Appends rows to an import file.
+
+        Args:
+            name: Name of the file, see `IMPORT_FILES`.
+            columns: The values of every column of the file, missing values
+                being None or NaN.
+        """
+        schema = IMPORT_FILES[name][2]
+        table = pa.Table.from_arrays(
+            [column if isinstance(column, pa.Array)
+             else pa.array(column, type=field.type, from_pandas=True)
+             for column, field in zip(columns, schema)],
+            schema=schema
+        )
+        if name not in self._writers:
+            self._writers[name] = pacsv.CSVWriter(str(self._tmp_path(name)),
+                                                  schema)
+        self._writers[name].write_table(table)
+        self.counts[name] += table.num_rows
+
+    def close(self):
+        for name in IMPORT_FILES:
+            if name not in self._writers:
+                # Files without rows still need their header
+                self.write(name, [[] for _ in IMPORT_FILES[name][2]])
+            self._writers[name].close()
+        for name in IMPORT_FILES:
+            self._tmp_path(name).replace(self.out_dir / name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        for writer in self._writers.values():
+            writer.close()
+        for name in IMPORT_FILES:
+            self._tmp_path(name).unlink(missing_ok=True)
+
+
+def format_arrays(vectors: np.ndarray) -> pa.Array:
+    """Formats every row of a matrix as an array property value."""
+    n, dim = vectors.shape
+    values = pc.cast(pa.array(vectors.ravel()), pa.string())
+    offsets = pa.array(np.arange(0, n * dim + 1, max(dim, 1)), pa.int32())
+    return pc.binary_join(pa.ListArray.from_arrays(offsets, values),
+                          ARRAY_DELIMITER)
+
+
+def _embedding_column(embeddings: np.ndarray,
+                      embedding_ids: pd.Series) -> pa.Array:
+    """Formats the embeddings of ingredients, null for those without one."""
+    valid = embedding_ids.notna().to_numpy()
+    formatted = format_arrays(
+        embeddings[embedding_ids[valid].to_numpy(dtype=np.int64)]
+    )
+    positions = np.full(len(valid), -1)
+    positions[valid] = np.arange(valid.sum())
+    return formatted.take(pa.array(positions, mask=~valid))
+
+
+def write_canonical_ingredients(writer: ImportWriter,
+                                embeddings: KeyedVectors,
+                                nutrition_df: pd.DataFrame,
+                                substitutions: List[tuple]):
+    """Writes the canonical ingredients and their relationships."""
+    canonical = pd.DataFrame({
+        "name": [key.strip() for key in embeddings.index_to_key],
+        "index": np.arange(len(embeddings.index_to_key)),
+    }).drop_duplicates("name")
+    writer.write("canonical_ingredients.csv", [
+        canonical["name"],
+        [f"ci_{index:05d}" for index in canonical["index"]],
+        format_arrays(embeddings.vectors[canonical["index"].to_numpy()]),
+    ])
+    names = set(canonical["name"])
+
+    substitutions = [(origin, target) for origin, target in substitutions
+                     if origin in names and target in names]
+    writer.write("has_substitute.csv", list(zip(*substitutions)) or [[], []])
+
+    writer.write("nutritional_values.csv", [
+        [value.strip() for value in NV_NAME_MAP.values()],
+        [f"nv_{idx:05d}" for idx in range(len(NV_NAME_MAP))],
+    ])
+    rows = [(record["name"], value.strip(),
+             parse_nutrient_amount(record[key]))
+            for record in nutrition_df.to_dict("records")
+            if record["name"] in names
+            for key, value in NV_NAME_MAP.items()]
+    writer.write("ingredient_nutritional_values.csv",
+                 list(zip(*rows)) or [[], [], []])
+
+
+def write_recipes(writer: ImportWriter, embedded_dir: Path,
+                  canonical_names: set, seen: Dict[str, set],
+                  id_offset: int, chunk_size: Optional[int]) -> int:
+    """Writes the recipes of an embedded dataset and their relationships.
+
+    Args:
+        writer: The import files.
+        embedded_dir: Directory of the embedded dataset.
+        canonical_names: Names of all canonical ingredients.
+        seen: Names of the recipes and ingredients, and the pairs of
+            ingredient and canonical names, written so far. Updated with those
+            of the dataset.
+        id_offset: Number of recipes in the datasets written before, so that
+            node ids do not clash with theirs.
+        chunk_size: Number of recipes written at a time.
+
+    Returns:
+        The number of recipes in the dataset.
+    """
+    embeddings = load_embeddings(embedded_dir)
+    count = 0
+    tables = iter_embedded_tables(
+        embedded_dir, chunk_size,
+        ["name", "description", "method", "recipe_url", "nutrition_name",
+         "nutrition_value"],
+        ["original_name", "amount", "grams", "canonical_name",
+         "embedding_id"]
+    )
+    for recipe_table, ingredient_table, first_id in tqdm(
+            tables, desc=f"Writing {embedded_dir.name}"):
+        recipes = table_to_pandas(recipe_table)
+        ids = [f"r_{idx + id_offset:05d}"
+               for idx in range(first_id, first_id + len(recipes))]
+        count += len(recipes)
+
+        # Recipes with the name of a previous recipe are merged into it
+        names = recipes["name"]
+        keep = (names.notna() & ~names.duplicated()
+                & ~names.isin(seen["recipes"])).to_numpy()
+        recipes = recipes[keep]
+        seen["recipes"].update(recipes["name"])
+        writer.write("recipes.csv", [
+            recipes["name"], np.array(ids, dtype=object)[keep],
+            recipes["description"], recipes["recipe_url"],
+            [None if method is None else str(list(method))
+             for method in recipes["method"]],
+        ])
+
+        nv_only = nutrition_table(recipes)
+        columns = list(NUTRITION_COLUMNS.values())
+        writer.write("recipe_nutritional_values.csv", [
+            np.repeat(nv_only["name"].to_numpy(dtype=object), len(columns)),
+            np.tile(np.array(columns, dtype=object), len(nv_only)),
+            nv_only[columns].to_numpy().ravel(),
+        ])
+
+        ingredients = table_to_pandas(ingredient_table)
+        row = ingredient_table["recipe_id"].to_numpy() - first_id
+        valid = keep[row] & ingredients["original_name"].notna().to_numpy()
+        ingredients = ingredients[valid]
+        ingredients.insert(0, "recipe",
+                           names.to_numpy(dtype=object)[row[valid]])
+        ingredients = ingredients.drop_duplicates(["recipe_id",
+                                                   "original_name"])
+        writer.write("has_ingredient.csv", [
+            ingredients["recipe"], ingredients["original_name"],
+            ingredients["amount"], ingredients["grams"],
+        ])
+
+        new = ingredients.drop_duplicates("original_name")
+        new = new[~new["original_name"].isin(seen["ingredients"])]
+        seen["ingredients"].update(new["original_name"])
+        writer.write("ingredients.csv", [
+            new["original_name"],
+            _embedding_column(embeddings, new["embedding_id"]),
+        ])
+
+        pairs = ingredients[ingredients["canonical_name"].isin(
+            canonical_names
+        )][["original_name", "canonical_name"]].drop_duplicates()
+        pairs = [pair for pair in pairs.itertuples(index=False, name=None)
+                 if pair not in seen["canonical_pairs"]]
+        seen["canonical_pairs"].update(pairs)
+        writer.write("has_canonical_name.csv", list(zip(*pairs)) or [[], []])
+    return count
+
+
+def write_bulk_import(data_dir: Path, chunk_size: Optional[int] = CHUNK_SIZE):
+    """Writes the import files of the whole graph.
+
+    Args:
+        data_dir: Path to the data directory.
+        chunk_size: Number of recipes written at a time, so that memory use
+            does not grow with the number of recipes. Whole datasets are
+            written at once if None.
+    """
+    print("Collecting required data...")
+    canonical_embeddings = KeyedVectors.load(
+        str(data_dir / "canonical_ingredient_embeddings.gz")
+    )
+    substitutions = parse_substitutions(data_dir / "substitutions.csv")
+    nutrition_df = pd.read_csv(data_dir / "nutrition.csv")
+    canonical_names = {key.strip()
+                       for key in canonical_embeddings.index_to_key}
+
+    start = perf_counter()
+    out_dir = bulk_import_dir(data_dir)
+    seen = {"recipes": set(), "ingredients": set(),
+            "canonical_pairs": set()}
+    id_offset = 0
+    with ImportWriter(out_dir) as writer:
+        write_canonical_ingredients(writer, canonical_embeddings,
+                                    nutrition_df, substitutions)
+        for name in EMBEDDED_DATASETS:
+            id_offset += write_recipes(writer, data_dir / name,
+                                       canonical_names, seen, id_offset,
+                                       chunk_size)
+    t = perf_counter() - start
+    for name, count in writer.counts.items():
+        print(f"{name:<36} {count} rows")
+    print(f"Done writing the import files to {out_dir}. {t=:.3f}")
+
+
+def parse_args():
+    p = ArgumentParser(description="Writes the graph as CSV files for "
+                                   "neo4j-admin database import.")
+    p.add_argument("DATA_DIR", type=Path,
+                   help="Path to the data directory")
+    p.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                   help="Number of recipes written at a time.")
+    p.add_argument("--database", type=str, default="neo4j",
+                   help="Name of the database to import into.")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    write_bulk_import(args.DATA_DIR, args.chunk_size)
+    print("Import the files with the database stopped by running:")
+    print(import_command_line(args.DATA_DIR, args.database))
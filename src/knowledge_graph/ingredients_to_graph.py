@@ -8,9 +8,22 @@ from typing import List
 
 import pandas as pd
 from gensim.models import KeyedVectors
-from neo4j import GraphDatabase, Driver
+from preprocessing.quantities import parse_nutrient_amount
 from tqdm import tqdm
-from time import perf_counter
+
+from knowledge_graph.batch_writer import RELATIONSHIP_BATCH_SIZE
+from knowledge_graph.recipe_macros import update_recipe_macros
+from knowledge_graph.repository import open_repository
+
+# Select nutritional values we are interested in
+NV_NAME_MAP = {"calories": "Calories",
+               "total_fat": "Total Fat",
+               "saturated_fat": "Saturated Fat",
+               "carbohydrate": "Carbohydrates",
+               "sugars": "Sugars",
+               "fiber": "Fiber",
+               "protein": "Protein",
+               "sodium": "Sodium"}
 
 
 def parse_args():
@@ -19,16 +32,22 @@ def parse_args():
                    help="Path to the data directory")
     p.add_argument("PORT", type=str,
                    help="Port used to connect to the database")
+    p.add_argument("--batch-size", type=int,
+                   default=RELATIONSHIP_BATCH_SIZE,
+                   help="Number of relationships created per transaction.")
 
     return p.parse_args()
 
 
-def add_all_canonical_ingredients(driver: Driver,
-                                  embeddings: KeyedVectors):
+def add_all_canonical_ingredients(graph, embeddings: KeyedVectors):
     """Adds all canonical ingredients to the knowledge graph.
 
+    Embeddings are stored as float32 vectors, half the size of the float64
+    lists sent by the driver.
+
     Args:
-        driver: The driver the transactions should be committed with.
+        graph: The repository of the graph, see
+            `knowledge_graph.repository`.
         embeddings: The embeddings of the canonical ingredients
     """
     ingredients = []
@@ -36,37 +55,35 @@ def add_all_canonical_ingredients(driver: Driver,
     for key, index in tqdm(embeddings.key_to_index.items(),
                            desc="Processing canonical ingredients"):
         ingredients.append({"name": key.strip(),
-                            "node_id": f"ci_{index:05d}",
+                            "id": f"ci_{index:05d}",
                             "embedding": embeddings.get_vector(key).tolist()})
-    print("Adding canonical ingredients...")
-    start = perf_counter()
-    with driver.session() as session:
-        run_str = """ UNWIND $ingredients as row
-                      MERGE (a:CanonicalIngredient {name: row.name})
-                      ON CREATE SET a.id =        row.node_id,
-                                    a.embedding = row.embedding"""
-        session.run(run_str, ingredients=ingredients)
-    t = perf_counter() - start
-    print(f"Done adding canonical ingredients. {t=:.3f}")
-
-
-def add_all_ingredient_substitutions(driver: Driver,
-                                     substitutions: List[tuple]):
+    graph.merge_nodes("CanonicalIngredient", ingredients, ["id"],
+                      vector_property="embedding",
+                      desc="Adding canonical ingredients")
+
+
+def add_all_ingredient_substitutions(
+        graph, substitutions: List[tuple],
+        batch_size: int = RELATIONSHIP_BATCH_SIZE
+):
     """Adds all ingredient substitution relationships.
 
+    Substitutions are sent in batches of rows, each merged by a single
+    query in its own write transaction, so that loading them again adds none
+    twice.
+
     Args:
-        driver: The driver the transactions should be committed with.
+        graph: The repository of the graph, see
+            `knowledge_graph.repository`.
         substitutions: The proper ingredient substitutions in (from, to) format.
+        batch_size: Number of substitutions per transaction.
     """
-    for substitution in tqdm(substitutions, desc="Adding substitutions"):
-        with driver.session() as session:
-            run_str = """MATCH (a:CanonicalIngredient),
-                               (b:CanonicalIngredient)
-                         WHERE a.name = $origin AND b.name = $target
-                         CREATE (a)-[r:HAS_SUBSTITUTE]->(b)"""
-            session.run(run_str,
-                        origin=substitution[0].strip(),
-                        target=substitution[1].strip())
+    rows = ({"origin": origin.strip(), "target": target.strip()}
+            for origin, target in substitutions)
+    graph.write_relationships(rows, "CanonicalIngredient",
+                              "CanonicalIngredient", "HAS_SUBSTITUTE",
+                              batch_size=batch_size,
+                              desc="Adding substitutions", merge=True)
 
 
 def parse_substitutions(substitution_path: Path) -> List[tuple]:
@@ -80,54 +97,43 @@ def parse_substitutions(substitution_path: Path) -> List[tuple]:
     return substitutions
 
 
-def add_all_nutritional_values(driver: Driver, nutrition_df: pd.DataFrame):
-    """Adds all nutritional values in the nutrition dataframe."""
-    # Select nutritional values we are interested in
-    nv_name_map = {"calories": "Calories",
-                   "total_fat": "Total Fat",
-                   "saturated_fat": "Saturated Fat",
-                   "carbohydrate": "Carbohydrates",
-                   "sugars": "Sugars",
-                   "fiber": "Fiber",
-                   "protein": "Protein",
-                   "sodium": "Sodium"}
-
-    print("Adding nutritional value entities...")
-    for idx, (key, value) in enumerate(nv_name_map.items()):
-        with driver.session() as session:
-            run_str = """MERGE (a:NutritionalValue {name: $name})
-                         ON CREATE SET a.id = $node_id"""
-            session.run(run_str,
-                        name=value.strip(),
-                        node_id=f"nv_{idx:05d}")
-
-    # Then add all ingredient -> nutritional value relations
-    nutrition = nutrition_df.to_dict("records")
-    for record in tqdm(nutrition, desc="Adding ingredient nutritional values"):
-        relations = []
-        for key, value in nv_name_map.items():
-            relations.append({"origin": record["name"],
-                              "target": value.strip(),
-                              "amount": record[key]})
-        with driver.session() as session:
-            run_str = """ UNWIND $relations as row
-                          MATCH (a:CanonicalIngredient),
-                                (b:NutritionalValue)
-                          WHERE a.name = row.origin AND b.name = row.target
-                          CREATE (a)-[r:HAS_NUTRITIONAL_VALUE 
-                                      {amount: row.amount}]->(b) """
-            session.run(run_str, relations=relations)
+def add_all_nutritional_values(graph, nutrition_df: pd.DataFrame,
+                               batch_size: int = RELATIONSHIP_BATCH_SIZE):
+    """Adds all nutritional values in the nutrition dataframe.
 
+    Amounts such as "0.28 g" are stored as numbers in grams per 100g of the
+    ingredient. The (ingredient, nutritional value, amount) triples of all
+    ingredients are merged in batches, setting the amount of relationships
+    which exist already, so that loading changed amounts updates them, see
+    `write_relationships`.
+    """
+    graph.merge_nodes("NutritionalValue", [
+        {"name": value.strip(), "id": f"nv_{idx:05d}"}
+        for idx, value in enumerate(NV_NAME_MAP.values())
+    ], ["id"], desc="Adding nutritional value entities")
 
-def add_ingredients_to_graph(data_dir: Path, uri: str, user: str,
-                             password: str):
-    """Adds the provided ingredients to the graph.
+    # Then add all ingredient -> nutritional value relations
+    rows = ({"origin": record["name"],
+             "target": value.strip(),
+             "amount": parse_nutrient_amount(record[key])}
+            for record in nutrition_df.to_dict("records")
+            for key, value in NV_NAME_MAP.items())
+    graph.write_relationships(rows, "CanonicalIngredient",
+                              "NutritionalValue", "HAS_NUTRITIONAL_VALUE",
+                              ["amount"], batch_size,
+                              desc="Adding ingredient nutritional values",
+                              merge=True, update=True)
+
+
+def load_ingredients(graph, data_dir: Path,
+                     batch_size: int = RELATIONSHIP_BATCH_SIZE):
+    """Adds the ingredients of the data directory to a graph.
 
     Args:
+        graph: The repository of the graph, see
+            `knowledge_graph.repository`.
         data_dir: Path to the data directory.
-        uri: URI the database is currently hosted on
-        user: The user to authenticate to the database with.
-        password: The password to authenticate to the database with.
+        batch_size: Number of relationships created per transaction.
     """
     canonical_embed_path = data_dir / "canonical_ingredient_embeddings.gz"
 
@@ -138,20 +144,38 @@ def add_ingredients_to_graph(data_dir: Path, uri: str, user: str,
     nutrition_df = pd.read_csv(data_dir / "nutrition.csv")
 
     # Actually commit to the database
-    driver = GraphDatabase.driver(uri, auth=(user, password))
-
     print("Starting transactions...")
-    add_all_canonical_ingredients(driver, canonical_embeddings)
-    add_all_ingredient_substitutions(driver, substitutions)
-    add_all_nutritional_values(driver, nutrition_df)
-
-    driver.close()
+    graph.create_schema()
+    add_all_canonical_ingredients(graph, canonical_embeddings)
+    graph.create_vector_index(canonical_embeddings.vector_size)
+    add_all_ingredient_substitutions(graph, substitutions, batch_size)
+    add_all_nutritional_values(graph, nutrition_df, batch_size)
+    # Recipes already in the graph may have changed nutritional values
+    update_recipe_macros(graph)
     print("Done!")
 
 
+def add_ingredients_to_graph(data_dir: Path, uri: str, user: str,
+                             password: str,
+                             batch_size: int = RELATIONSHIP_BATCH_SIZE):
+    """Adds the provided ingredients to the graph.
+
+    Args:
+        data_dir: Path to the data directory.
+        uri: URI the database is currently hosted on, see
+            `knowledge_graph.repository.open_repository`.
+        user: The user to authenticate to the database with.
+        password: The password to authenticate to the database with.
+        batch_size: Number of relationships created per transaction.
+    """
+    with open_repository(uri, user, password) as graph:
+        load_ingredients(graph, data_dir, batch_size)
+
+
 if __name__ == '__main__':
     args = parse_args()
     add_ingredients_to_graph(args.DATA_DIR,
                              uri=f"bolt://localhost:{args.PORT}",
                              user="neo4j",
-                             password="password")
+                             password="password",
+                             batch_size=args.batch_size)
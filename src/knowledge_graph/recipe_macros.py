@@ -0,0 +1,102 @@
+"""Recipe Macros.
+
+Materializes the macronutrients of every recipe, computed from its
+ingredients, as properties of the recipe nodes.
+
+The grams of protein, carbohydrates and fat of a recipe are the sums over its
+ingredients of their grams times the amount of the nutrient per 100g of their
+canonical ingredient. Computing these takes a traversal of four hops per
+recipe and nutrient, so they are computed for all recipes at once after
+loading and stored as the `protein`, `carbohydrates` and `total_fat`
+properties of the recipes. The web app then looks them up by recipe name,
+however deep the graph.
+
+The loaders keep them up to date: `load_recipes` refreshes the recipes it
+added or changed, `load_ingredients` refreshes all recipes, as the amounts of
+the nutritional values it upserts may have changed. Graphs loaded otherwise,
+e.g. by a bulk import, are refreshed by running from the `src` directory:
+    python -m knowledge_graph.recipe_macros bolt://localhost:7687
+The web app computes the macros of recipes it finds without them on demand.
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import List, Optional
+
+import pandas as pd
+
+from knowledge_graph.repository import open_repository
+
+# Nutritional values of the macronutrients and their recipe properties
+MACROS = {"Protein": "protein",
+          "Carbohydrates": "carbohydrates",
+          "Total Fat": "total_fat"}
+
+
+def update_recipe_macros(graph, recipes: Optional[List[str]] = None) -> int:
+    """Computes and stores the macronutrients of recipes.
+
+    Args:
+        graph: The repository of the graph, see
+            `knowledge_graph.repository`.
+        recipes: Names of the recipes to update, all recipes if None.
+
+    Returns:
+        The number of recipes updated.
+    """
+    print("Computing recipe macros...")
+    start = perf_counter()
+    totals = {}
+    for recipe, nutrient, grams in graph.recipe_nutrient_totals(
+            list(MACROS), recipes):
+        totals[recipe, nutrient] = grams
+    if recipes is None:
+        recipes = [name for name, in graph.recipe_properties([])]
+    t = perf_counter() - start
+    print(f"Done computing recipe macros. {t=:.3f}")
+
+    rows = ({"name": recipe, **{key: totals.get((recipe, nutrient), 0.0)
+                                for nutrient, key in MACROS.items()}}
+            for recipe in recipes)
+    return graph.merge_nodes("Recipe", rows,
+                             update_properties=list(MACROS.values()),
+                             desc="Storing recipe macros")
+
+
+def load_recipe_macros(graph, recipes: Optional[List[str]] = None
+                       ) -> pd.DataFrame:
+    """Reads the macronutrients of recipes.
+
+    Args:
+        graph: The repository of the graph, see
+            `knowledge_graph.repository`.
+        recipes: Names of the recipes, all recipes if None. Recipes which are
+            not in the graph are left out.
+
+    Returns:
+        The grams of every nutritional value of `MACROS`, with one column per
+            nutritional value, indexed by recipe name. Missing for recipes
+            whose macros were never computed.
+    """
+    rows = graph.recipe_properties(list(MACROS.values()), recipes)
+    return pd.DataFrame([values for _, *values in rows],
+                        index=[name for name, *_ in rows],
+                        columns=list(MACROS), dtype=float)
+
+
+def parse_args():
+    p = ArgumentParser(description="Computes the macronutrients of all "
+                                   "recipes in the graph.")
+    p.add_argument("URI", type=str,
+                   help="URI of the graph, see "
+                        "knowledge_graph.repository.open_repository.")
+    p.add_argument("--user", type=str, default="neo4j",
+                   help="User to authenticate as for neo4j")
+    p.add_argument("--password", type=str, default="password",
+                   help="Password to authenticate with for neo4j")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open_repository(args.URI, args.user, args.password) as graph:
+        update_recipe_macros(graph)
@@ -2,141 +2,257 @@
 
 Converts all recipes to their appropriate graph representations.
 """
+from itertools import chain
 from pathlib import Path
+from typing import Iterator, List, Optional
 import pandas as pd
-from neo4j import Driver, GraphDatabase
-from time import perf_counter
-from tqdm import tqdm
-
-
-def add_recipes(driver: Driver, recipe_df: pd.DataFrame):
-    """Adds just the recipes to the graph."""
-    recipes = []
-    for idx, record in enumerate(recipe_df.to_dict("records")):
-        record.update({"node_id": f"r_{idx:05d}"})
-        recipes.append(record)
-
-    print("Adding recipes...")
-    start = perf_counter()
-    with driver.session() as session:
-        run_str = """ UNWIND $records as row
-                      MERGE (a:Recipe {name: row.name})
-                      ON CREATE SET a.id =          row.node_id,
-                                    a.description = row.description,
-                                    a.url =         row.recipe_url,
-                                    a.method =      row.method """
-        session.run(run_str, records=recipes)
-    t = perf_counter() - start
-    print(f"Done adding recipes. {t=:.3f}")
-
-
-def add_recipe_nutritional_values(driver: Driver, nv_df: pd.DataFrame):
-    """Adds relationships for recipe nutritional values to the graph."""
-    records = nv_df.to_dict("records")
 
+from knowledge_graph.batch_writer import WRITE_WORKERS
+from knowledge_graph.recipe_macros import update_recipe_macros
+from knowledge_graph.repository import open_repository
+from preprocessing.clean_data import recipe_tables
+from preprocessing.dataset_store import iter_embedded, \
+    iter_embedded_tables, load_embedded, load_embeddings, table_to_pandas
+from preprocessing.delta import delta_dir
+
+# Embedded datasets in the order their recipes are added to the graph
+EMBEDDED_DATASETS = ["recipe_bbc_embedded", "studentfoodrecipe_embedded"]
+
+# Number of ingredients merged per transaction, smaller than for
+# relationships as every ingredient carries its embedding
+INGREDIENT_BATCH_SIZE = 1000
+
+
+def add_recipes(graph, recipe_df: pd.DataFrame, id_offset: int = 0,
+                update_existing: bool = False):
+    """Adds just the recipes to the graph.
+
+    Args:
+        graph: The repository of the graph, see
+            `knowledge_graph.repository`.
+        recipe_df: The recipes to add.
+        id_offset: Number of recipes already in the graph, so that node ids of
+            added recipes do not clash with theirs.
+        update_existing: Whether recipes which are already in the graph get
+            their properties updated.
+    """
+    recipes = ({"name": name, "id": f"r_{idx + id_offset:05d}",
+                "description": description, "url": url, "method": method}
+               for idx, (name, description, url, method) in enumerate(zip(
+                   recipe_df["name"], recipe_df["description"],
+                   recipe_df["recipe_url"], recipe_df["method"])))
+    properties = ["description", "url", "method"]
+    graph.merge_nodes("Recipe", recipes, ["id"] + properties,
+                      update_properties=properties if update_existing else (),
+                      desc="Adding recipes")
+
+
+def count_recipes(graph) -> int:
+    """Counts the recipes in the graph."""
+    return graph.count_nodes("Recipe")
+
+
+def remove_recipe_relations(graph, recipe_df: pd.DataFrame):
+    """Removes the ingredients and nutritional values of recipes.
+
+    Used before recipes are added again, so that relationships of their
+    previous version do not remain and none are added twice.
+    """
+    graph.delete_relationships("Recipe", recipe_df["name"].tolist(),
+                               ["HAS_INGREDIENT", "HAS_NUTRITIONAL_VALUE"])
+
+
+def add_recipe_nutritional_values(graph, nv_df: pd.DataFrame):
+    """Adds relationships for recipe nutritional values to the graph.
+
+    The (recipe, nutritional value, amount) triples of all recipes are merged
+    in batches, setting the amount of relationships which exist already, see
+    `write_relationships`.
+    """
     nv_types = list(nv_df.columns)[1:]  # Ignore name
+    rows = ({"origin": record["name"],
+             "target": nv_type,
+             "amount": record[nv_type]}
+            for record in nv_df.to_dict("records")
+            for nv_type in nv_types)
+    graph.write_relationships(rows, "Recipe", "NutritionalValue",
+                              "HAS_NUTRITIONAL_VALUE", ["amount"],
+                              desc="Adding recipe nutritional values",
+                              merge=True, update=True)
+
 
-    for record in tqdm(records, desc="Adding recipe nutritional values"):
-        relations = []
-        for nv_type in nv_types:
-            relations.append({"origin": record["name"],
-                              "target": nv_type,
-                              "amount": record[nv_type]})
-
-        with driver.session() as session:
-            run_str = """ UNWIND $relations as row
-                          MATCH (a:Recipe),
-                                (b:NutritionalValue)
-                          WHERE a.name = row.origin AND b.name = row.target
-                          CREATE (a)-[r:HAS_NUTRITIONAL_VALUE 
-                                      {amount: row.amount}]->(b) """
-            session.run(run_str, relations=relations)
-
-
-def add_recipe_ingredients(driver: Driver, recipe_df: pd.DataFrame):
-    """Adds associated ingredients to recipes on the graph."""
-    # Make sure that the embeddings are a list
-    def embeddings_to_list(ingredient_list):
-        out = []
-        for ingredient in ingredient_list:
-            if ingredient["embedding"] is not None:
-                e = (ingredient["embedding"].tolist())
-            else:
-                e = None
-            out.append({"original_name": ingredient["original_name"],
-                        "amount": ingredient["amount"],
-                        "canonical_name": ingredient["canonical_name"],
-                        "embedding": e})
-        return out
-    recipe_df["ingredients"] = recipe_df["ingredients"].apply(
-        lambda x: embeddings_to_list(x))
-    records = recipe_df.to_dict("records")
-
-    for record in tqdm(records, desc="Adding recipe ingredients"):
-        # Add the ingredients first
-        with driver.session() as session:
-            run_str = """ UNWIND $ingredients as row
-                          MERGE (a:Ingredient {name: row.original_name})
-                          ON CREATE SET a.embedding = row.embedding
-                          """
-            session.run(run_str, ingredients=record["ingredients"])
-
-        # Now make the relationships
-        relations = []
-        for ingredient in record["ingredients"]:
-            relations.append({"origin": record["name"],
-                              "target": ingredient["original_name"],
-                              "amount": ingredient["amount"]})
-        with driver.session() as session:
-            run_str = """UNWIND $relations as row
-                         MATCH (a:Recipe {name: row.origin}),
-                               (b:Ingredient {name: row.target})
-                         MERGE (a)-[r:HAS_INGREDIENT]->(b) 
-                         ON CREATE SET r.amount = row.amount
-                         """
-            session.run(run_str, relations=relations)
-
-
-def add_canonical_ingredient_relation(driver: Driver, recipe_df: pd.DataFrame):
+def ingredient_nodes(embedded_dirs: List[Path],
+                     chunk_size: Optional[int] = None) -> Iterator[dict]:
+    """Yields every distinct ingredient of the embedded datasets once.
+
+    Ingredients get the embedding of their first occurrence, as they did
+    when merged recipe by recipe.
+    """
+    seen = set()
+    for embedded_dir in embedded_dirs:
+        embeddings = load_embeddings(embedded_dir)
+        for _, ingredient_table, _ in iter_embedded_tables(
+                embedded_dir, chunk_size, ["name"],
+                ["original_name", "embedding_id"]):
+            ingredients = table_to_pandas(ingredient_table)
+            for name, embedding_id in zip(ingredients["original_name"],
+                                          ingredients["embedding_id"]):
+                if name is None or name in seen:
+                    continue
+                seen.add(name)
+                yield {"name": name,
+                       "embedding": None if embedding_id is None
+                       else embeddings[embedding_id].tolist()}
+
+
+def add_ingredients(graph, embedded_dirs: List[Path],
+                    chunk_size: Optional[int] = None):
+    """Adds the ingredients of all recipes to the graph.
+
+    Every distinct ingredient is merged once, in batches written by
+    concurrent transactions, before any relationships to them are added.
+    Embeddings are stored as float32 vector properties.
+    """
+    graph.merge_nodes("Ingredient", ingredient_nodes(embedded_dirs,
+                                                     chunk_size),
+                      vector_property="embedding",
+                      batch_size=INGREDIENT_BATCH_SIZE,
+                      desc="Adding ingredients", concurrent=True)
+
+
+def add_recipe_ingredients(graph, recipe_df: pd.DataFrame):
+    """Adds associated ingredients to recipes on the graph.
+
+    The ingredients have to be in the graph already, see `add_ingredients`.
+    """
+    # Only the first of repeated ingredients of a recipe sets the amount
+    relations = {}
+    for name, ingredients in zip(recipe_df["name"],
+                                 recipe_df["ingredients"]):
+        for ingredient in ingredients:
+            relations.setdefault((name, ingredient["original_name"]), {
+                "origin": name,
+                "target": ingredient["original_name"],
+                "amount": ingredient["amount"],
+                "grams": ingredient.get("grams")
+            })
+    graph.write_relationships(relations.values(), "Recipe", "Ingredient",
+                              "HAS_INGREDIENT", ["amount", "grams"],
+                              desc="Adding recipe ingredients", merge=True,
+                              concurrent=True)
+
+
+def add_canonical_ingredient_relation(graph, recipe_df: pd.DataFrame):
     """Adds a relationship between an ingredient and its canonical ingredient.
+
+    Previous canonical ingredients of the ingredients are removed first, so
+    that an ingredient matched differently than before is not named by both.
     """
-    records = recipe_df.to_dict("records")
-
-    for record in tqdm(records, desc="Adding ingredient canonical relations"):
-        relations = []
-        for ingredient in record["ingredients"]:
-            relations.append({"origin": ingredient["original_name"],
-                              "target": ingredient["canonical_name"]})
-        with driver.session() as session:
-            run_str = """ UNWIND $relations as row
-                          MATCH (a:Ingredient {name: row.origin}),
-                                (b:CanonicalIngredient {name: row.target})
-                          MERGE (a)-[r:HAS_CANONICAL_NAME]->(b) """
-            session.run(run_str, relations=relations)
-
-
-def add_recipes_to_graph(data_dir: Path, uri: str, user: str, password: str):
-    """Adds the provided recipes to the graph.
+    pairs = dict.fromkeys(
+        (ingredient["original_name"], ingredient["canonical_name"])
+        for ingredients in recipe_df["ingredients"]
+        for ingredient in ingredients
+        if ingredient["canonical_name"] is not None
+    )
+    origins = list(dict.fromkeys(origin for origin, _ in pairs))
+    graph.delete_relationships("Ingredient", origins, ["HAS_CANONICAL_NAME"])
+    graph.write_relationships(({"origin": origin, "target": target}
+                               for origin, target in pairs),
+                              "Ingredient", "CanonicalIngredient",
+                              "HAS_CANONICAL_NAME",
+                              desc="Adding ingredient canonical relations",
+                              merge=True, concurrent=True)
+
+
+def _read_csv_chunks(path: Path, chunk_size: Optional[int]
+                     ) -> Iterator[pd.DataFrame]:
+    """Reads a CSV file in chunks, or as a single chunk if chunk_size is None.
+    """
+    if chunk_size is None:
+        yield pd.read_csv(path)
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size)
+
+
+def load_recipes(graph, data_dir: Path, delta: bool = False,
+                 chunk_size: Optional[int] = None):
+    """Adds the recipes of the data directory to a graph.
+
+    The relationships of recipes which are in the graph already are
+    replaced, so that loading the same or changed recipes again updates rather
+    than duplicates them. The macros of the added recipes are computed once
+    they are in the graph, see `knowledge_graph.recipe_macros`.
 
     Args:
+        graph: The repository of the graph, see
+            `knowledge_graph.repository`.
         data_dir: Path to the data directory.
-        uri: URI the database is currently hosted on
-        user: The user to authenticate to the database with.
-        password: The password to authenticate to the database with.
+        delta: Whether only the new and changed recipes of the last
+            incremental scrape are added, see `preprocessing.delta`.
+        chunk_size: Number of recipes read and added at a time, so that
+            memory use does not grow with the number of recipes. Whole
+            datasets are added at once if None.
     """
-    recipe_df = pd.read_csv(data_dir / "clean_datasets" / "recipes.csv")
-    nv_df = pd.read_csv(data_dir / "clean_datasets" / "values.csv")
+    graph.create_schema()
+
+    if delta:
+        embedded_dirs = sorted(delta_dir(data_dir).glob("*_embedded"))
+        if not embedded_dirs:
+            print("No new or changed recipes.")
+            return
+        embedded_dfs = [load_embedded(path) for path in embedded_dirs]
+        recipe_df, nv_df = recipe_tables(pd.concat(embedded_dfs))
+        if len(recipe_df) == 0:
+            print("No new or changed recipes.")
+            return
+        remove_recipe_relations(graph, recipe_df)
+        add_recipes(graph, recipe_df, count_recipes(graph),
+                    update_existing=True)
+        add_recipe_nutritional_values(graph, nv_df)
+    else:
+        embedded_dirs = [data_dir / name for name in EMBEDDED_DATASETS]
+        clean_dir = data_dir / "clean_datasets"
+        id_offset = count_recipes(graph)
+        for recipe_df in _read_csv_chunks(clean_dir / "recipes.csv",
+                                          chunk_size):
+            remove_recipe_relations(graph, recipe_df)
+            add_recipes(graph, recipe_df, id_offset, update_existing=True)
+            id_offset += len(recipe_df)
+        for nv_df in _read_csv_chunks(clean_dir / "values.csv", chunk_size):
+            add_recipe_nutritional_values(graph, nv_df)
+        embedded_dfs = chain.from_iterable(
+            iter_embedded(path, chunk_size) for path in embedded_dirs
+        )
 
-    bbc_df = pd.read_pickle(data_dir / "recipe_bbc_embedded.pkl")
-    sfp_df = pd.read_pickle(data_dir / "studentfoodrecipe_embedded.pkl")
+    add_ingredients(graph, embedded_dirs, chunk_size)
+    for embedded_df in embedded_dfs:
+        add_recipe_ingredients(graph, embedded_df)
+        add_canonical_ingredient_relation(graph, embedded_df)
 
-    driver = GraphDatabase.driver(uri, auth=(user, password))
+    # Only the added and changed recipes of a delta need their macros
+    update_recipe_macros(graph, recipe_df["name"].tolist() if delta
+                         else None)
 
-    add_recipes(driver, recipe_df)
-    add_recipe_nutritional_values(driver, nv_df)
 
-    add_recipe_ingredients(driver, bbc_df)
-    add_canonical_ingredient_relation(driver, bbc_df)
+def add_recipes_to_graph(data_dir: Path, uri: str, user: str, password: str,
+                         delta: bool = False,
+                         chunk_size: Optional[int] = None,
+                         workers: int = WRITE_WORKERS):
+    """Adds the provided recipes to the graph.
 
-    add_recipe_ingredients(driver, sfp_df)
-    add_canonical_ingredient_relation(driver, sfp_df)
+    Args:
+        data_dir: Path to the data directory.
+        uri: URI the database is currently hosted on, see
+            `knowledge_graph.repository.open_repository`.
+        user: The user to authenticate to the database with.
+        password: The password to authenticate to the database with.
+        delta: Whether only the new and changed recipes of the last
+            incremental scrape are added, see `preprocessing.delta`.
+        chunk_size: Number of recipes read and added at a time, so that
+            memory use does not grow with the number of recipes. Whole
+            datasets are added at once if None.
+        workers: Number of concurrent write transactions adding ingredients
+            and their relationships.
+    """
+    with open_repository(uri, user, password, workers) as graph:
+        load_recipes(graph, data_dir, delta, chunk_size)
@@ -0,0 +1,608 @@
+"""Repository.
+
+Stores and queries the knowledge graph of recipes, their ingredients, the
+canonical ingredients these are named by, their substitutes and the
+nutritional values of recipes and canonical ingredients.
+
+Two interchangeable backends are provided. Both merge nodes by label and name,
+create relationships between nodes matched by name and answer the queries of
+the web app, so that the loaders and the web app work with either.
+
+    Neo4jRepository:  Writes to and queries a Neo4j database, see
+                      `knowledge_graph.batch_writer` and
+                      `knowledge_graph.schema`.
+    SQLiteRepository: Keeps the graph in a SQLite database file, or in memory,
+                      with nodes and relationships in two tables. The
+                      relationships are indexed by start and by end node, so
+                      that paths are followed through adjacency indexes
+                      rather than scans. Embedded in the process, e.g. for
+                      deterministic benchmarks or small deployments without a
+                      database server.
+
+`open_repository` opens either from a URI, e.g. "bolt://localhost:7687" or
+"sqlite:../data/graph.sqlite".
+"""
+import json
+import math
+import sqlite3
+import threading
+from itertools import islice
+from time import perf_counter
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from neo4j import Driver, GraphDatabase
+from tqdm import tqdm
+
+from knowledge_graph.batch_writer import RELATIONSHIP_BATCH_SIZE, \
+    WRITE_WORKERS, write_nodes, write_relationships
+from knowledge_graph.schema import create_schema, create_vector_index
+
+# Prefix of the URIs of SQLite repositories
+SQLITE_SCHEME = "sqlite:"
+
+
+class Neo4jRepository:
+    """The knowledge graph in a Neo4j database."""
+    def __init__(self, driver: Driver, workers: int = WRITE_WORKERS):
+        """Creates the repository.
+
+        Args:
+            driver: The database driver, closed with the repository.
+            workers: Number of concurrent write transactions of concurrent
+                writes.
+        """
+        self.driver = driver
+        self.workers = workers
+
+    def __enter__(self) -> "Neo4jRepository":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.driver.close()
+
+    def _run(self, query: str, **parameters) -> List[tuple]:
+        with self.driver.session() as session:
+            return [tuple(record.values())
+                    for record in session.run(query, **parameters)]
+
+    def create_schema(self):
+        """Creates the constraints and indexes of the graph."""
+        create_schema(self.driver)
+
+    def create_vector_index(self, dimensions: Optional[int] = None):
+        """Creates the vector index on the canonical ingredient embeddings."""
+        create_vector_index(self.driver, dimensions)
+
+    def merge_nodes(self, label: str, rows: Iterable[dict],
+                    properties: List[str] = (),
+                    vector_property: Optional[str] = None,
+                    update_properties: List[str] = (),
+                    batch_size: int = RELATIONSHIP_BATCH_SIZE,
+                    desc: str = "Adding nodes",
+                    concurrent: bool = False) -> int:
+        """Merges nodes by name, see `batch_writer.write_nodes`.
+
+        Args:
+            concurrent: Whether batches are written by concurrent
+                transactions, in which case names should be distinct.
+        """
+        return write_nodes(self.driver, rows, label, properties,
+                           vector_property, batch_size,
+                           self.workers if concurrent else 1, desc,
+                           update_properties)
+
+    def write_relationships(self, rows: Iterable[dict], origin_label: str,
+                            target_label: str, relationship: str,
+                            properties: List[str] = (),
+                            batch_size: int = RELATIONSHIP_BATCH_SIZE,
+                            desc: str = "Adding relationships",
+                            merge: bool = False,
+                            concurrent: bool = False,
+                            update: bool = False) -> int:
+        """Creates relationships between nodes matched by name, see
+        `batch_writer.write_relationships`.
+
+        Args:
+            concurrent: Whether batches are written by concurrent
+                transactions, in which case merged pairs of nodes should be
+                distinct.
+        """
+        return write_relationships(self.driver, rows, origin_label,
+                                   target_label, relationship, properties,
+                                   batch_size, desc, merge,
+                                   self.workers if concurrent else 1, update)
+
+    def delete_relationships(self, label: str, names: List[str],
+                             relationships: List[str]):
+        """Deletes the relationships of given types starting at nodes."""
+        with self.driver.session() as session:
+            session.run(f"""MATCH (a:{label})-[r]->()
+                            WHERE a.name IN $names
+                              AND type(r) IN $relationships
+                            DELETE r""",
+                        names=names, relationships=relationships).consume()
+
+    def count_nodes(self, label: str) -> int:
+        """Counts the nodes with a label."""
+        return self._run(f"MATCH (a:{label}) RETURN count(a)")[0][0]
+
+    def recipe_canonical_ingredient_names(self) -> List[str]:
+        """Names of the canonical ingredients of any recipe ingredient."""
+        return [name for name, in self._run("""
+            MATCH (:Recipe)-[:HAS_INGREDIENT]->(:Ingredient)
+                  -[:HAS_CANONICAL_NAME]->(c:CanonicalIngredient)
+            RETURN DISTINCT c.name""")]
+
+    def recipes(self) -> List[Tuple[str, str]]:
+        """(name, method) pairs of all recipes."""
+        return self._run("MATCH (r:Recipe) RETURN r.name, r.method")
+
+    def recipe_canonical_ingredients(self) -> List[Tuple[str, str]]:
+        """(recipe, canonical ingredient) pairs of all recipe ingredients."""
+        return self._run("""
+            MATCH (r:Recipe)-[:HAS_INGREDIENT]->(:Ingredient)
+                  -[:HAS_CANONICAL_NAME]->(c:CanonicalIngredient)
+            RETURN r.name, c.name""")
+
+    def recipe_ingredients(self, recipe: str) -> List[str]:
+        """Names of the ingredients of a recipe."""
+        return [name for name, in self._run("""
+            MATCH (r:Recipe {name: $recipe})-[:HAS_INGREDIENT]->(i:Ingredient)
+            RETURN i.name""", recipe=recipe)]
+
+    def recipe_substitutes(self, recipe: str) -> List[Tuple[str, str]]:
+        """(ingredient, substitute) pairs of the ingredients of a recipe."""
+        return self._run("""
+            MATCH (r:Recipe {name: $recipe})-[:HAS_INGREDIENT]->(i:Ingredient)
+                  -[:HAS_CANONICAL_NAME]->(:CanonicalIngredient)
+                  -[:HAS_SUBSTITUTE]->(s:CanonicalIngredient)
+            RETURN i.name, s.name""", recipe=recipe)
+
+    def recipe_nutrient_amounts(self, recipe: str, nutrient: str
+                                ) -> List[Tuple[float, float]]:
+        """(grams, amount) pairs of the ingredients of a recipe.
+
+        Returns:
+            The grams of every ingredient in the recipe and the grams of the
+                nutrient per 100g of its canonical ingredient. Either may be
+                None.
+        """
+        return self._run("""
+            MATCH (r:Recipe {name: $recipe})-[i:HAS_INGREDIENT]->(:Ingredient)
+                  -[:HAS_CANONICAL_NAME]->(:CanonicalIngredient)
+                  -[v:HAS_NUTRITIONAL_VALUE]->
+                  (:NutritionalValue {name: $nutrient})
+            RETURN i.grams, v.amount""", recipe=recipe, nutrient=nutrient)
+
+    def recipe_nutrient_totals(self, nutrients: List[str],
+                               recipes: Optional[List[str]] = None
+                               ) -> List[Tuple[str, str, float]]:
+        """Grams of nutrients in recipes, summed over their ingredients.
+
+        Args:
+            nutrients: Names of the nutritional values.
+            recipes: Names of the recipes, all recipes if None.
+
+        Returns:
+            (recipe, nutrient, grams) triples, see `recipe_nutrient_amounts`.
+                Ingredients without grams or amount count as 0g, recipes
+                without a path to a nutrient are left out.
+        """
+        match = "MATCH (r:Recipe)" if recipes is None \
+            else "MATCH (r:Recipe) WHERE r.name IN $recipes"
+        return self._run(match + """
+            MATCH (r)-[i:HAS_INGREDIENT]->(:Ingredient)
+                  -[:HAS_CANONICAL_NAME]->(:CanonicalIngredient)
+                  -[v:HAS_NUTRITIONAL_VALUE]->(n:NutritionalValue)
+            WHERE n.name IN $nutrients
+            RETURN r.name, n.name, sum(i.grams * v.amount / 100)""",
+                         recipes=recipes, nutrients=nutrients)
+
+    def recipe_properties(self, properties: List[str],
+                          recipes: Optional[List[str]] = None
+                          ) -> List[tuple]:
+        """(name, *properties) tuples of recipes, all recipes if None."""
+        match = "MATCH (r:Recipe)" if recipes is None \
+            else "MATCH (r:Recipe) WHERE r.name IN $recipes"
+        return self._run(match + " RETURN r.name" + "".join(
+            f", r.{key}" for key in properties
+        ), recipes=recipes)
+
+
+def _batches(rows: Iterable[dict], batch_size: int) -> Iterator[List[dict]]:
+    rows = iter(rows)
+    return iter(lambda: list(islice(rows, batch_size)), [])
+
+
+def _json_value(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _properties(row: dict, keys: Iterable[str], keep_null: bool = False
+                ) -> str:
+    """The properties of a row as a JSON object.
+
+    Missing values, including NaN, are left out as they are not stored by
+    Neo4j either, unless kept as null to remove a property when patched.
+    """
+    properties = {key: _json_value(row.get(key)) for key in keys}
+    return json.dumps({key: value for key, value in properties.items()
+                       if keep_null or value is not None})
+
+
+class SQLiteRepository:
+    """The knowledge graph in a SQLite database.
+
+    Paths are joined with CROSS JOIN, which SQLite does not reorder, so that
+    they are followed from their start node through the adjacency indexes
+    whatever the statistics of the tables.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS nodes (
+            id INTEGER PRIMARY KEY,
+            label TEXT NOT NULL,
+            name TEXT NOT NULL,
+            properties TEXT NOT NULL,
+            embedding BLOB,
+            UNIQUE (label, name)
+        );
+        CREATE TABLE IF NOT EXISTS relationships (
+            id INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            source INTEGER NOT NULL REFERENCES nodes (id),
+            target INTEGER NOT NULL REFERENCES nodes (id),
+            properties TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS relationships_source
+            ON relationships (source, type, target);
+        CREATE INDEX IF NOT EXISTS relationships_target
+            ON relationships (target, type, source);
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        """Opens the repository, creating its tables if needed.
+
+        The repository may be shared by threads, e.g. the sessions of the web
+        app, which use its connection one at a time.
+
+        Args:
+            path: Path to the database file, or ":memory:" for a graph which
+                only lives as long as the repository.
+        """
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        if path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(self.SCHEMA)
+
+    def __enter__(self) -> "SQLiteRepository":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _run(self, query: str, *parameters) -> List[tuple]:
+        with self._lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def create_schema(self):
+        """Does nothing, the tables are indexed when they are created."""
+
+    def create_vector_index(self, dimensions: Optional[int] = None):
+        """Does nothing, embeddings are searched in process, see
+        `knowledge_graph.vector_search.NumpyVectorSearch`."""
+
+    def _write(self, statements: List[Tuple[str, Callable]],
+               rows: Iterable[dict], batch_size: int, desc: str) -> int:
+        """Runs statements, given with the function mapping a row to their
+        parameters, for batches of rows, one transaction each."""
+        count = 0
+        with tqdm(desc=desc, unit=" rows") as bar:
+            for batch in _batches(rows, batch_size):
+                with self._lock, self.connection:
+                    for query, parameters in statements:
+                        self.connection.executemany(query,
+                                                    map(parameters, batch))
+                count += len(batch)
+                bar.update(len(batch))
+        return count
+
+    def merge_nodes(self, label: str, rows: Iterable[dict],
+                    properties: List[str] = (),
+                    vector_property: Optional[str] = None,
+                    update_properties: List[str] = (),
+                    batch_size: int = RELATIONSHIP_BATCH_SIZE,
+                    desc: str = "Adding nodes",
+                    concurrent: bool = False) -> int:
+        """Merges nodes by name, in batches.
+
+        Args:
+            label: Label of the nodes.
+            rows: One dictionary per node, with its name as "name" and the
+                keys of the properties.
+            properties: Keys of the rows which are set as node properties
+                when a node is created.
+            vector_property: Key of the rows holding an embedding, which is
+                stored as float32 on nodes which have none yet. Has to be
+                "embedding".
+            update_properties: Keys of the rows which are also set as node
+                properties when a node exists already.
+            batch_size: Number of nodes per transaction.
+            desc: Description shown on the progress bar.
+            concurrent: Ignored, SQLite has a single writer.
+
+        Returns:
+            The number of rows written.
+
+        Raises:
+            ValueError: If the vector property is not "embedding".
+        """
+        if vector_property not in (None, "embedding"):
+            raise ValueError(f"Unsupported vector property "
+                             f"'{vector_property}'.")
+
+        def parameters(row: dict) -> tuple:
+            embedding = None if vector_property is None \
+                else row.get(vector_property)
+            if embedding is not None:
+                embedding = np.asarray(embedding, dtype=np.float32).tobytes()
+            return (label, row["name"], _properties(row, properties),
+                    embedding,
+                    _properties(row, update_properties, keep_null=True))
+
+        start = perf_counter()
+        count = self._write([("""
+            INSERT INTO nodes (label, name, properties, embedding)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (label, name) DO UPDATE SET
+                properties = json_patch(nodes.properties, ?),
+                embedding = coalesce(nodes.embedding, excluded.embedding)
+        """, parameters)], rows, batch_size, desc)
+        t = perf_counter() - start
+        print(f"Done adding {count} {label} nodes. {t=:.3f} "
+              f"({count / max(t, 1e-9):.0f} rows/s)")
+        return count
+
+    def write_relationships(self, rows: Iterable[dict], origin_label: str,
+                            target_label: str, relationship: str,
+                            properties: List[str] = (),
+                            batch_size: int = RELATIONSHIP_BATCH_SIZE,
+                            desc: str = "Adding relationships",
+                            merge: bool = False,
+                            concurrent: bool = False,
+                            update: bool = False) -> int:
+        """Creates relationships between nodes matched by name, in batches.
+
+        Rows whose start or end node does not exist are skipped.
+
+        Args:
+            rows: One dictionary per relationship, with the name of the start
+                node as "origin", the name of the end node as "target" and the
+                keys of `properties`.
+            origin_label: Label of the start nodes.
+            target_label: Label of the end nodes.
+            relationship: Type of the relationships.
+            properties: Keys of the rows which are set as relationship
+                properties.
+            batch_size: Number of relationships per transaction.
+            desc: Description shown on the progress bar.
+            merge: Whether relationships are merged, setting their properties
+                only when they are created, rather than always created.
+            concurrent: Ignored, SQLite has a single writer.
+            update: Whether merged relationships which exist already get
+                their properties set too, so that writing the rows again
+                updates rather than duplicates them.
+
+        Returns:
+            The number of rows written.
+        """
+        query = """
+            INSERT INTO relationships (type, source, target, properties)
+            SELECT ?, a.id, b.id, ? FROM nodes a, nodes b
+            WHERE a.label = ? AND a.name = ? AND b.label = ? AND b.name = ?"""
+        if merge:
+            query += """
+              AND NOT EXISTS (SELECT 1 FROM relationships r
+                              WHERE r.source = a.id AND r.type = ?
+                                AND r.target = b.id)"""
+
+        def parameters(row: dict) -> tuple:
+            values = (relationship, _properties(row, properties),
+                      origin_label, row["origin"], target_label,
+                      row["target"])
+            return values + (relationship,) if merge else values
+
+        statements = [(query, parameters)]
+        if merge and update and properties:
+            # Sets the properties of the relationships inserted just now too,
+            # so that the last of repeated rows wins, as in Neo4j
+            statements.append(("""
+                UPDATE relationships
+                SET properties = json_patch(properties, ?)
+                WHERE source = (SELECT id FROM nodes
+                                WHERE label = ? AND name = ?)
+                  AND type = ?
+                  AND target = (SELECT id FROM nodes
+                                WHERE label = ? AND name = ?)""",
+                lambda row: (_properties(row, properties, keep_null=True),
+                             origin_label, row["origin"], relationship,
+                             target_label, row["target"])))
+
+        start = perf_counter()
+        count = self._write(statements, rows, batch_size, desc)
+        t = perf_counter() - start
+        print(f"Done adding {count} {relationship} relationships. {t=:.3f} "
+              f"({count / max(t, 1e-9):.0f} rows/s)")
+        return count
+
+    def delete_relationships(self, label: str, names: List[str],
+                             relationships: List[str]):
+        """Deletes the relationships of given types starting at nodes."""
+        types = ", ".join("?" * len(relationships))
+        with self._lock, self.connection:
+            self.connection.executemany(f"""
+                DELETE FROM relationships
+                WHERE type IN ({types}) AND source IN (
+                    SELECT id FROM nodes WHERE label = ? AND name = ?
+                )""", ((*relationships, label, name) for name in names))
+
+    def count_nodes(self, label: str) -> int:
+        """Counts the nodes with a label."""
+        return self._run("SELECT count(*) FROM nodes WHERE label = ?",
+                         label)[0][0]
+
+    def recipe_canonical_ingredient_names(self) -> List[str]:
+        """Names of the canonical ingredients of any recipe ingredient."""
+        return [name for name, in self._run("""
+            SELECT c.name FROM nodes c
+            WHERE c.label = 'CanonicalIngredient' AND EXISTS (
+                SELECT 1 FROM relationships n
+                JOIN relationships i
+                  ON i.target = n.source AND i.type = 'HAS_INGREDIENT'
+                WHERE n.target = c.id AND n.type = 'HAS_CANONICAL_NAME'
+            )""")]
+
+    def recipes(self) -> List[Tuple[str, str]]:
+        """(name, method) pairs of all recipes."""
+        return self._run("""
+            SELECT name, json_extract(properties, '$.method') FROM nodes
+            WHERE label = 'Recipe'""")
+
+    def recipe_canonical_ingredients(self) -> List[Tuple[str, str]]:
+        """(recipe, canonical ingredient) pairs of all recipe ingredients."""
+        return self._run("""
+            SELECT r.name, c.name FROM nodes r
+            CROSS JOIN relationships i
+              ON i.source = r.id AND i.type = 'HAS_INGREDIENT'
+            CROSS JOIN relationships n
+              ON n.source = i.target AND n.type = 'HAS_CANONICAL_NAME'
+            CROSS JOIN nodes c ON c.id = n.target
+            WHERE r.label = 'Recipe'""")
+
+    def recipe_ingredients(self, recipe: str) -> List[str]:
+        """Names of the ingredients of a recipe."""
+        return [name for name, in self._run("""
+            SELECT g.name FROM nodes r
+            CROSS JOIN relationships i
+              ON i.source = r.id AND i.type = 'HAS_INGREDIENT'
+            CROSS JOIN nodes g ON g.id = i.target
+            WHERE r.label = 'Recipe' AND r.name = ?""", recipe)]
+
+    def recipe_substitutes(self, recipe: str) -> List[Tuple[str, str]]:
+        """(ingredient, substitute) pairs of the ingredients of a recipe."""
+        return self._run("""
+            SELECT g.name, s.name FROM nodes r
+            CROSS JOIN relationships i
+              ON i.source = r.id AND i.type = 'HAS_INGREDIENT'
+            CROSS JOIN nodes g ON g.id = i.target
+            CROSS JOIN relationships n
+              ON n.source = i.target AND n.type = 'HAS_CANONICAL_NAME'
+            CROSS JOIN relationships b
+              ON b.source = n.target AND b.type = 'HAS_SUBSTITUTE'
+            CROSS JOIN nodes s ON s.id = b.target
+            WHERE r.label = 'Recipe' AND r.name = ?""", recipe)
+
+    def recipe_nutrient_amounts(self, recipe: str, nutrient: str
+                                ) -> List[Tuple[float, float]]:
+        """(grams, amount) pairs of the ingredients of a recipe.
+
+        Returns:
+            The grams of every ingredient in the recipe and the grams of the
+                nutrient per 100g of its canonical ingredient. Either may be
+                None.
+        """
+        return self._run("""
+            SELECT json_extract(i.properties, '$.grams'),
+                   json_extract(v.properties, '$.amount')
+            FROM nodes r
+            CROSS JOIN nodes w
+            CROSS JOIN relationships i
+              ON i.source = r.id AND i.type = 'HAS_INGREDIENT'
+            CROSS JOIN relationships n
+              ON n.source = i.target AND n.type = 'HAS_CANONICAL_NAME'
+            CROSS JOIN relationships v
+              ON v.source = n.target AND v.type = 'HAS_NUTRITIONAL_VALUE'
+             AND v.target = w.id
+            WHERE r.label = 'Recipe' AND r.name = ?
+              AND w.label = 'NutritionalValue' AND w.name = ?""",
+                         recipe, nutrient)
+
+    def recipe_nutrient_totals(self, nutrients: List[str],
+                               recipes: Optional[List[str]] = None
+                               ) -> List[Tuple[str, str, float]]:
+        """Grams of nutrients in recipes, summed over their ingredients.
+
+        Args:
+            nutrients: Names of the nutritional values.
+            recipes: Names of the recipes, all recipes if None.
+
+        Returns:
+            (recipe, nutrient, grams) triples, see `recipe_nutrient_amounts`.
+                Ingredients without grams or amount count as 0g, recipes
+                without a path to a nutrient are left out.
+        """
+        query = f"""
+            SELECT r.name, w.name,
+                   total(json_extract(i.properties, '$.grams')
+                         * json_extract(v.properties, '$.amount') / 100)
+            FROM nodes r
+            CROSS JOIN relationships i
+              ON i.source = r.id AND i.type = 'HAS_INGREDIENT'
+            CROSS JOIN relationships n
+              ON n.source = i.target AND n.type = 'HAS_CANONICAL_NAME'
+            CROSS JOIN relationships v
+              ON v.source = n.target AND v.type = 'HAS_NUTRITIONAL_VALUE'
+            CROSS JOIN nodes w ON w.id = v.target
+            WHERE r.label = 'Recipe' AND w.label = 'NutritionalValue'
+              AND w.name IN ({", ".join("?" * len(nutrients))})"""
+        if recipes is None:
+            return self._run(query + " GROUP BY r.id, w.id", *nutrients)
+        return [row for recipe in recipes
+                for row in self._run(query + " AND r.name = ? GROUP BY w.id",
+                                     *nutrients, recipe)]
+
+    def recipe_properties(self, properties: List[str],
+                          recipes: Optional[List[str]] = None
+                          ) -> List[tuple]:
+        """(name, *properties) tuples of recipes, all recipes if None."""
+        query = "SELECT name" + "".join(
+            ", json_extract(properties, ?)" for _ in properties
+        ) + " FROM nodes WHERE label = 'Recipe'"
+        paths = [f"$.{key}" for key in properties]
+        if recipes is None:
+            return self._run(query, *paths)
+        return [row for recipe in recipes
+                for row in self._run(query + " AND name = ?", *paths,
+                                     recipe)]
+
+
+def open_repository(uri: str, user: str = "neo4j", password: str = "password",
+                    workers: int = WRITE_WORKERS):
+    """Opens the repository of the graph at a URI.
+
+    Args:
+        uri: "sqlite:" followed by the path of a SQLite database, or
+            ":memory:", for a `SQLiteRepository`. Any other URI is that of a
+            Neo4j database.
+        user: The user to authenticate to a Neo4j database with.
+        password: The password to authenticate to a Neo4j database with.
+        workers: Number of concurrent write transactions to a Neo4j database.
+    """
+    if uri.startswith(SQLITE_SCHEME):
+        return SQLiteRepository(uri[len(SQLITE_SCHEME):])
+    return Neo4jRepository(GraphDatabase.driver(uri, auth=(user, password)),
+                           workers)
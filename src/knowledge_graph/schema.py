@@ -0,0 +1,210 @@
+"""Schema.
+
+Creates the constraints and indexes of the knowledge graph.
+
+Every node label gets a uniqueness constraint on `name`, which is backed by an
+index, and an index on `id`. The loaders match and merge nodes by name, so
+without these every lookup is a label scan and loading takes quadratic time.
+`create_schema` is idempotent and is called by both loaders before they write
+anything.
+
+Canonical ingredient embeddings also get a vector index, so that the nearest
+canonical ingredients of an embedding are found inside the database, see
+`knowledge_graph.vector_search`. It needs the dimensions of the embeddings, so
+it is created once they are in the graph.
+
+The plans of the queries the loaders run most are checked to use index seeks
+rather than scans, see `check_query_plans`. The check can also be run on its
+own:
+    python -m knowledge_graph.schema PORT
+"""
+import re
+from argparse import ArgumentParser
+from typing import Dict, Iterator, List, Optional
+
+from neo4j import Driver, GraphDatabase
+
+from knowledge_graph.batch_writer import node_query, relationship_query
+
+# Labels of all nodes of the graph
+NODE_LABELS = ["Recipe", "Ingredient", "CanonicalIngredient",
+               "NutritionalValue"]
+
+# Seconds to wait for created indexes to be populated
+INDEX_TIMEOUT = 300
+
+# Vector index on the canonical ingredient embeddings
+VECTOR_INDEX = "canonical_ingredient_embedding"
+
+# Queries run for every recipe or ingredient while loading
+HOT_QUERIES = {
+    "merge recipe": node_query("Recipe",
+                               ["id", "description", "url", "method"],
+                               update_properties=["description", "url",
+                                                  "method"]),
+    "merge ingredient": node_query("Ingredient", [],
+                                   vector_property="embedding"),
+    "merge canonical ingredient": node_query("CanonicalIngredient", ["id"],
+                                             vector_property="embedding"),
+    "recipe ingredients": relationship_query(
+        "Recipe", "Ingredient", "HAS_INGREDIENT", ["amount", "grams"],
+        merge=True
+    ),
+    "canonical names": relationship_query(
+        "Ingredient", "CanonicalIngredient", "HAS_CANONICAL_NAME", [],
+        merge=True
+    ),
+    "substitutions": relationship_query("CanonicalIngredient",
+                                        "CanonicalIngredient",
+                                        "HAS_SUBSTITUTE", [], merge=True),
+    "ingredient nutritional values": relationship_query(
+        "CanonicalIngredient", "NutritionalValue", "HAS_NUTRITIONAL_VALUE",
+        ["amount"], merge=True, update=True
+    ),
+    "recipe nutritional values": relationship_query(
+        "Recipe", "NutritionalValue", "HAS_NUTRITIONAL_VALUE", ["amount"],
+        merge=True, update=True
+    ),
+}
+
+
+def _snake_case(label: str) -> str:
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", label).lower()
+
+
+def create_name_constraint(driver: Driver, label: str):
+    """Creates a uniqueness constraint on the names of nodes with a label.
+
+    The constraint is backed by an index, so that the nodes are matched by
+    name with an index seek instead of a label scan. Does nothing if the
+    constraint already exists.
+
+    Args:
+        driver: The database driver.
+        label: The node label, e.g. "CanonicalIngredient". The constraint is
+            named after it, e.g. "canonical_ingredient_name".
+    """
+    with driver.session() as session:
+        session.run(f"""CREATE CONSTRAINT {_snake_case(label)}_name
+                        IF NOT EXISTS
+                        FOR (a:{label}) REQUIRE a.name IS UNIQUE""").consume()
+
+
+def create_id_index(driver: Driver, label: str):
+    """Creates an index on the ids of nodes with a label.
+
+    Does nothing if the index already exists.
+    """
+    with driver.session() as session:
+        session.run(f"""CREATE INDEX {_snake_case(label)}_id IF NOT EXISTS
+                        FOR (a:{label}) ON (a.id)""").consume()
+
+
+def _await_indexes(driver: Driver):
+    with driver.session() as session:
+        session.run("CALL db.awaitIndexes($timeout)",
+                    timeout=INDEX_TIMEOUT).consume()
+
+
+def create_vector_index(driver: Driver, dimensions: Optional[int] = None):
+    """Creates the vector index on the canonical ingredient embeddings.
+
+    Does nothing if the index already exists.
+
+    Args:
+        driver: The database driver.
+        dimensions: Dimensions of the embeddings. Taken from the embeddings
+            in the graph if None, in which case nothing is created while
+            there are none.
+    """
+    with driver.session() as session:
+        if dimensions is None:
+            record = session.run("""MATCH (a:CanonicalIngredient)
+                                    WHERE a.embedding IS NOT NULL
+                                    RETURN size(a.embedding) LIMIT 1
+                                 """).single()
+            if record is None:
+                return
+            dimensions = record[0]
+        session.run(f"""CREATE VECTOR INDEX {VECTOR_INDEX} IF NOT EXISTS
+                        FOR (a:CanonicalIngredient) ON (a.embedding)
+                        OPTIONS {{indexConfig: {{
+                            `vector.dimensions`: {int(dimensions)},
+                            `vector.similarity_function`: 'cosine'
+                        }}}}""").consume()
+    _await_indexes(driver)
+
+
+def _operators(plan: dict) -> Iterator[str]:
+    """Yields the operator types of a query plan and all its children."""
+    # Operator types may carry the runtime, e.g. "NodeIndexSeek@neo4j"
+    yield plan["operatorType"].split("@")[0]
+    for child in plan.get("children", []):
+        yield from _operators(child)
+
+
+def check_query_plans(driver: Driver) -> Dict[str, List[str]]:
+    """Checks that the queries run while loading use index seeks.
+
+    The queries are only planned with `EXPLAIN`, not run.
+
+    Returns:
+        The operator types of the plan of every query in `HOT_QUERIES`.
+
+    Raises:
+        AssertionError: If a query scans nodes instead of seeking them in an
+            index.
+    """
+    plans = {}
+    with driver.session() as session:
+        for name, query in HOT_QUERIES.items():
+            summary = session.run(f"EXPLAIN {query}", rows=[]).consume()
+            plans[name] = list(_operators(summary.plan))
+    for name, operators in plans.items():
+        scans = [op for op in operators
+                 if op in ("NodeByLabelScan", "AllNodesScan")]
+        seeks = [op for op in operators if "IndexSeek" in op]
+        assert not scans and seeks, \
+            f"Query '{name}' does not use an index seek: {operators}"
+    return plans
+
+
+def create_schema(driver: Driver, check: bool = True):
+    """Creates all constraints and indexes of the graph.
+
+    Waits until the indexes are online, so that loads started afterwards use
+    them. The vector index is only created if the graph holds canonical
+    ingredient embeddings already, see `create_vector_index`.
+
+    Args:
+        driver: The database driver.
+        check: Whether the plans of the loading queries are checked, see
+            `check_query_plans`.
+    """
+    print("Creating constraints and indexes...")
+    for label in NODE_LABELS:
+        create_name_constraint(driver, label)
+        create_id_index(driver, label)
+    create_vector_index(driver)
+    _await_indexes(driver)
+    if check:
+        check_query_plans(driver)
+
+
+def parse_args():
+    p = ArgumentParser(description="Creates the constraints and indexes of "
+                                   "the graph and checks the plans of the "
+                                   "loading queries.")
+    p.add_argument("PORT", type=str,
+                   help="Port used to connect to the database")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    driver = GraphDatabase.driver(f"bolt://localhost:{args.PORT}",
+                                  auth=("neo4j", "password"))
+    create_schema(driver, check=False)
+    for query_name, query_operators in check_query_plans(driver).items():
+        print(f"{query_name:<30} {' -> '.join(query_operators)}")
+    driver.close()
@@ -0,0 +1,155 @@
+"""Vector Search.
+
+Nearest neighbour search over the canonical ingredient embeddings.
+
+Two interchangeable backends are provided. Both search by cosine similarity
+and return the names of the best matching canonical ingredients with their
+scores, which are the cosine similarities mapped to [0, 1] as
+`(1 + similarity) / 2`, the scale of Neo4j vector indexes.
+
+    Neo4jVectorSearch: Queries the vector index of the graph, see
+                       `knowledge_graph.schema.create_vector_index`, so that
+                       lookups run inside the database.
+    NumpyVectorSearch: Exact search in process over the canonical ingredient
+                       embeddings, e.g. for tests or without a database.
+
+Run from the `src` directory to list the ingredients most similar to one:
+    python -m knowledge_graph.vector_search DATA_DIR "butter" --port 7687
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+from gensim.models import KeyedVectors
+from neo4j import Driver, GraphDatabase
+
+from knowledge_graph.schema import VECTOR_INDEX
+from preprocessing.ann_index import ExactIndex
+
+
+class Neo4jVectorSearch:
+    """Nearest canonical ingredients from the vector index of the graph."""
+    def __init__(self, driver: Driver, index_name: str = VECTOR_INDEX):
+        self.driver = driver
+        self.index_name = index_name
+
+    def nearest(self, embedding: np.ndarray,
+                k: int = 10) -> List[Tuple[str, float]]:
+        """Finds the canonical ingredients nearest to an embedding.
+
+        Returns:
+            Up to `k` (name, score) pairs, best first.
+        """
+        with self.driver.session() as session:
+            result = session.run("""
+                CALL db.index.vector.queryNodes($index, $k, $embedding)
+                YIELD node, score
+                RETURN node.name, score""",
+                index=self.index_name, k=k,
+                embedding=np.asarray(embedding, dtype=np.float32).tolist())
+            return [(name, score) for name, score in result]
+
+    def similar_ingredients(self, name: str,
+                            k: int = 10) -> List[Tuple[str, float]]:
+        """Finds the canonical ingredients most similar to another one.
+
+        Returns:
+            Up to `k` (name, score) pairs, best first, without the ingredient
+                itself. Empty if it is not in the graph.
+        """
+        with self.driver.session() as session:
+            result = session.run("""
+                MATCH (a:CanonicalIngredient {name: $name})
+                CALL db.index.vector.queryNodes($index, $k + 1, a.embedding)
+                YIELD node, score
+                WHERE node <> a
+                RETURN node.name, score
+                LIMIT $k""",
+                name=name, index=self.index_name, k=k)
+            return [(name, score) for name, score in result]
+
+
+class NumpyVectorSearch:
+    """Nearest canonical ingredients by exact search in process."""
+    def __init__(self, names: List[str], vectors: np.ndarray):
+        """Creates the search.
+
+        Args:
+            names: Names of the canonical ingredients.
+            vectors: Their embeddings, one per row.
+        """
+        self.names = names
+        self.rows = {}
+        for row, name in enumerate(names):
+            self.rows.setdefault(name, row)
+        self.index = ExactIndex(vectors)
+
+    @classmethod
+    def from_embeddings(cls, embeddings: KeyedVectors) -> "NumpyVectorSearch":
+        """Creates the search over canonical ingredient embeddings."""
+        return cls([key.strip() for key in embeddings.index_to_key],
+                   embeddings.vectors)
+
+    def _results(self, similarities: np.ndarray, rows: np.ndarray,
+                 exclude: Optional[int] = None) -> List[Tuple[str, float]]:
+        return [(self.names[row], float((1 + similarity) / 2))
+                for similarity, row in zip(similarities, rows)
+                if row != exclude]
+
+    def nearest(self, embedding: np.ndarray,
+                k: int = 10) -> List[Tuple[str, float]]:
+        """Finds the canonical ingredients nearest to an embedding.
+
+        Returns:
+            Up to `k` (name, score) pairs, best first.
+        """
+        similarities, rows = self.index.search(embedding, k)
+        return self._results(similarities[0], rows[0])
+
+    def similar_ingredients(self, name: str,
+                            k: int = 10) -> List[Tuple[str, float]]:
+        """Finds the canonical ingredients most similar to another one.
+
+        Returns:
+            Up to `k` (name, score) pairs, best first, without the ingredient
+                itself. Empty if it is unknown.
+        """
+        row = self.rows.get(name)
+        if row is None:
+            return []
+        similarities, rows = self.index.search(
+            self.index.vectors[row], k + 1
+        )
+        return self._results(similarities[0], rows[0], exclude=row)[:k]
+
+
+def parse_args():
+    p = ArgumentParser(description="Lists the canonical ingredients most "
+                                   "similar to one.")
+    p.add_argument("DATA_DIR", type=Path,
+                   help="Path to the data directory")
+    p.add_argument("NAME", type=str,
+                   help="Name of the canonical ingredient.")
+    p.add_argument("--port", type=str, default=None,
+                   help="Port used to connect to the database. The "
+                        "canonical ingredient embeddings of the data "
+                        "directory are searched in process if not given.")
+    p.add_argument("-k", type=int, default=10,
+                   help="Number of similar ingredients to list.")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.port is None:
+        search = NumpyVectorSearch.from_embeddings(KeyedVectors.load(
+            str(args.DATA_DIR / "canonical_ingredient_embeddings.gz")
+        ))
+        print(search.similar_ingredients(args.NAME, args.k))
+    else:
+        driver = GraphDatabase.driver(f"bolt://localhost:{args.port}",
+                                      auth=("neo4j", "password"))
+        print(Neo4jVectorSearch(driver).similar_ingredients(args.NAME,
+                                                            args.k))
+        driver.close()
@@ -0,0 +1,328 @@
+"""Pipeline.
+
+Runs the stages of `prepare_database.py` as a declarative stage graph.
+
+Every stage declares the files it reads and writes, the stages it depends on,
+its parameters and the modules its code lives in. Its cache key is made of
+hashes of the content of its inputs, of its parameters and of the source of
+its modules, and is recorded in `pipeline_state.json` in the data directory
+once the stage has run. A stage only runs again if its key has changed or one
+of its outputs is missing, so stale outputs are rebuilt and up to date ones
+are skipped. If a rebuilt stage writes the same outputs as before, the stages
+depending on it are skipped as well.
+
+A stage may also declare how to update its outputs incrementally, e.g. by
+embedding only newly scraped recipes. This is only done if the stage ran
+before with the same parameters and code and none of its dependencies was
+rebuilt from scratch, otherwise the stage is rebuilt as well, so that results
+of previous code or parameters do not remain.
+
+Every stage runs at most once per process, even if the pipeline is run again,
+e.g. first up to some targets and then entirely.
+
+Stages whose dependencies are done run concurrently in threads, e.g. the
+scrapers and the canonical ingredient embedding.
+"""
+import hashlib
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from importlib.util import find_spec
+from pathlib import Path
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Optional
+
+from preprocessing.embedding_cache import file_hash
+
+
+def path_hash(path: Path) -> str:
+    """Hashes the content of a file, or of all files in a directory.
+
+    Returns:
+        The SHA-256 hash, or "missing" if the path does not exist.
+    """
+    if path.is_file():
+        return file_hash(path)
+    if not path.is_dir():
+        return "missing"
+    sha = hashlib.sha256()
+    for file in sorted(p for p in path.rglob("*") if p.is_file()):
+        sha.update(file.relative_to(path).as_posix().encode("utf-8"))
+        sha.update(file_hash(file).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def _combined_hash(parts: Iterable[str]) -> str:
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(part.encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+class Stage:
+    """A step of the pipeline."""
+    def __init__(self, name: str, run: Callable[[], object],
+                 inputs: Iterable[Path] = (), outputs: Iterable[Path] = (),
+                 deps: Iterable[str] = (),
+                 modules: Iterable[str] = (),
+                 params: Optional[dict] = None, always_run: bool = False,
+                 update: Optional[Callable[[], object]] = None):
+        """Creates the stage.
+
+        Args:
+            name: Name of the stage.
+            run: Function running the stage.
+            inputs: Files and directories the stage reads.
+            outputs: Files and directories the stage writes. Stages without
+                outputs, e.g. database loads, are only skipped based on their
+                key.
+            deps: Names of the stages which have to run first, usually those
+                writing the inputs.
+            modules: Names of the modules holding the code of the stage,
+                e.g. "preprocessing.clean_data". Changing their source makes
+                the stage stale.
+            params: Parameters changing the outputs of the stage. Must be
+                JSON serializable.
+            always_run: Whether the stage runs even if it is up to date, e.g.
+                an incremental scrape.
+            update: Function updating the outputs of the stage with what is
+                new in its inputs, e.g. embedding only new recipes. Used
+                instead of `run` if the stage ran before with the same
+                parameters and code and none of its dependencies was rebuilt
+                by `run`.
+        """
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.modules = list(modules)
+        self.params = params or {}
+        self.always_run = always_run
+        self.update = update
+
+    def key(self) -> Dict[str, str]:
+        """Calculates the cache key of the stage from its current inputs.
+
+        Returns:
+            The hashes of the inputs, parameters and code of the stage.
+        """
+        inputs = _combined_hash(f"{path.name}:{path_hash(path)}"
+                                for path in self.inputs)
+        params = _combined_hash([json.dumps(self.params, sort_keys=True)])
+        code = _combined_hash(file_hash(Path(find_spec(module).origin))
+                              for module in self.modules)
+        return {"inputs": inputs, "params": params, "code": code}
+
+    def outputs_exist(self) -> bool:
+        """Whether all outputs of the stage exist."""
+        return all(path.exists() for path in self.outputs)
+
+
+class Pipeline:
+    """Runs a graph of stages, skipping those which are up to date."""
+    def __init__(self, stages: List[Stage], state_path: Path,
+                 workers: int = 4):
+        """Creates the pipeline.
+
+        Args:
+            stages: The stages. Dependencies must refer to stages in the
+                list.
+            state_path: JSON file recording the key of every stage which has
+                run.
+            workers: Maximum number of stages running at once.
+
+        Raises:
+            ValueError: If a dependency is unknown or the stages have a cycle.
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.workers = workers
+        # Stages done in this process, with whether they were rebuilt by
+        # `run` rather than updated or found up to date
+        self.completed: Dict[str, bool] = {}
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown "
+                                     f"stage {dep}.")
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> List[str]:
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage {name} is part of a cycle.")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.remove(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def _load_state(self) -> Dict[str, Dict[str, str]]:
+        if not self.state_path.exists():
+            return {}
+        return json.loads(self.state_path.read_text())
+
+    def _save_state(self, state: Dict[str, Dict[str, str]]):
+        tmp_path = self.state_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(state, indent=2, sort_keys=True))
+        tmp_path.replace(self.state_path)
+
+    def _selected(self, targets: Optional[Iterable[str]]) -> List[str]:
+        """The targets and all stages they depend on, in topological order."""
+        if targets is None:
+            return list(self.order)
+        selected = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.stages[name].deps)
+        return [name for name in self.order if name in selected]
+
+    def _reason(self, stage: Stage, key: Dict[str, str],
+                state: Dict[str, Dict[str, str]]) -> Optional[str]:
+        """Why a stage has to run, or None if it is up to date."""
+        if stage.always_run:
+            return "always runs"
+        recorded = state.get(stage.name)
+        if recorded is None:
+            if stage.outputs and stage.outputs_exist():
+                # Outputs of a run before the pipeline recorded keys are
+                # adopted rather than rebuilt
+                state[stage.name] = key
+                return None
+            return "never run"
+        if not stage.outputs_exist():
+            return "outputs missing"
+        changed = [part for part in ["inputs", "params", "code"]
+                   if recorded.get(part) != key[part]]
+        if changed:
+            return f"{', '.join(changed)} changed"
+        return None
+
+    def _updates(self, stage: Stage, key: Dict[str, str],
+                 state: Dict[str, Dict[str, str]]) -> bool:
+        """Whether a stage which has to run is updated rather than rebuilt."""
+        recorded = state.get(stage.name)
+        return (stage.update is not None and recorded is not None
+                and stage.outputs_exist()
+                and all(recorded.get(part) == key[part]
+                        for part in ["params", "code"])
+                and not any(self.completed.get(dep, False)
+                            for dep in stage.deps))
+
+    def plan(self, targets: Optional[Iterable[str]] = None
+             ) -> Dict[str, Optional[str]]:
+        """Determines which stages would run, without running any.
+
+        Args:
+            targets: Names of the stages to bring up to date, along with
+                their dependencies. Defaults to all stages.
+
+        Returns:
+            For every selected stage in topological order, why it would run,
+            or None if it is up to date. Stages depending on a stage which
+            would run are assumed to run too, as their inputs may change.
+            Stages done already in this process are up to date.
+        """
+        state = self._load_state()
+        reasons = {}
+        for name in self._selected(targets):
+            stage = self.stages[name]
+            if name in self.completed:
+                reasons[name] = None
+                continue
+            stale_deps = [dep for dep in stage.deps
+                          if reasons.get(dep) is not None]
+            if stale_deps and not stage.always_run:
+                reasons[name] = f"{', '.join(stale_deps)} will run"
+            else:
+                reasons[name] = self._reason(stage, stage.key(), state)
+        return reasons
+
+    def dry_run(self, targets: Optional[Iterable[str]] = None):
+        """Prints which stages would run and why."""
+        for name, reason in self.plan(targets).items():
+            status = "up to date" if reason is None else f"run ({reason})"
+            print(f"{name:<20} {status}")
+
+    def run(self, targets: Optional[Iterable[str]] = None):
+        """Runs all stale stages, running independent ones concurrently.
+
+        Stages done already in this process, e.g. by a previous run up to
+        other targets, are not run again.
+
+        Args:
+            targets: Names of the stages to bring up to date, along with
+                their dependencies. Defaults to all stages.
+
+        Raises:
+            Exception: The first exception raised by a stage. Stages which
+                are already running finish first, no further stages start.
+        """
+        state = self._load_state()
+        remaining = self._selected(targets)
+        done = set()
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            while remaining or running:
+                if error is None:
+                    for name in list(remaining):
+                        stage = self.stages[name]
+                        if not all(dep in done for dep in stage.deps):
+                            continue
+                        remaining.remove(name)
+                        if name in self.completed:
+                            done.add(name)
+                            continue
+                        # Inputs are hashed once the dependencies are done
+                        key = stage.key()
+                        reason = self._reason(stage, key, state)
+                        if reason is None:
+                            print(f"Stage {name} is up to date.")
+                            self._save_state(state)
+                            self.completed[name] = False
+                            done.add(name)
+                            continue
+                        update = self._updates(stage, key, state)
+                        print(f"{'Updating' if update else 'Running'} "
+                              f"stage {name} ({reason})...")
+                        future = executor.submit(self._run_stage, stage,
+                                                 update)
+                        running[future] = (name, key, update)
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, key, update = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    state[name] = key
+                    self._save_state(state)
+                    self.completed[name] = not update
+                    done.add(name)
+
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _run_stage(stage: Stage, update: bool = False):
+        start = perf_counter()
+        (stage.update if update else stage.run)()
+        t = perf_counter() - start
+        print(f"Stage {stage.name} done. {t=:.3f}")
@@ -1,23 +1,55 @@
 """Prepare Database.
 
 Prepares the database we need by scraping all the websites, preprocessing
-them, then adding them to the neo4j graph database.
+them, then adding them to the neo4j graph database, or to an embedded SQLite
+database with `--sqlite`, see `knowledge_graph.repository`.
+
+The steps are run as a stage graph, see `pipeline`. A stage is skipped if
+its inputs, parameters and code are unchanged since it last ran, and
+independent stages run concurrently. With `--incremental`, stages only
+process the recipes added or changed since the last run, unless they have to
+be rebuilt, e.g. after their code or parameters changed:
+
+    scrape_bbc ------+
+    scrape_sfp ------+--> embed_recipes --> clean -----+
+    embed_canonical -+                                 +--> load_recipes
+                     +--> load_ingredients ------------+
+
+With `--bulk-import`, the graph is not added through the database connection
+but written as CSV files for `neo4j-admin database import` instead, see
+`knowledge_graph.bulk_import`:
+
+    scrape_bbc ------+
+    scrape_sfp ------+--> embed_recipes --+
+    embed_canonical -+--------------------+--> bulk_import
 
 Assumptions prior to starting:
     1. The nutrition dataset is already placed in the data_dir
     2. The substitutions dataset is already placed in the data_dir
 """
 from argparse import ArgumentParser
+from functools import partial
 from pathlib import Path
-import gensim.downloader as api
 
+from pipeline import Pipeline, Stage
+from preprocessing.ann_index import build_canonical_index, \
+    canonical_index_path
 from preprocessing.clean_data import clean_data
-from preprocessing.recipe_ingredient_embedding import embed_recipe_ingredients
+from preprocessing.dataset_store import CHUNK_SIZE, embedded_path
+from preprocessing.delta import apply_embedded_deltas, delta_dir
+from preprocessing.domain_vocabulary import load_domain_vectors
+from preprocessing.glove_store import load_glove_model
+from preprocessing.recipe_ingredient_embedding import \
+    embed_recipe_ingredients, find_recipe_files
 from preprocessing.word_embedding import embed_canonical_ingredients
 from scrapers.scrape_bbc import scrape_from_bbc
 from scrapers.scrape_studentfood import scrape_from_studentfoodproject
+from knowledge_graph.batch_writer import WRITE_WORKERS
+from knowledge_graph.bulk_import import import_command_line, \
+    import_files, write_bulk_import
 from knowledge_graph.ingredients_to_graph import add_ingredients_to_graph
 from knowledge_graph.recipes_to_graph import add_recipes_to_graph
+from knowledge_graph.repository import SQLITE_SCHEME
 
 
 def parse_args():
@@ -29,13 +61,209 @@ def parse_args():
                    help="Port used to connect to the database")
     p.add_argument("--uri", type=str, default="bolt://localhost",
                    help="URI to connect to the database on.")
+    p.add_argument("--sqlite", type=Path, default=None,
+                   help="Add the graph to an embedded SQLite database file "
+                        "instead of Neo4j. PORT is then ignored.")
     p.add_argument("--user", type=str, default="neo4j",
                    help="User to authenticate as for neo4j")
     p.add_argument("--password", type=str, default="password",
                    help="Password to authenticate with for neo4j")
+    p.add_argument("--ann", action="store_true",
+                   help="Match canonical ingredient names using an "
+                        "approximate nearest neighbour index.")
+    p.add_argument("--n-probe", type=int, default=None,
+                   help="Number of index clusters searched per ingredient "
+                        "when using --ann.")
+    p.add_argument("--float16", action="store_true",
+                   help="Store the domain vocabulary word vectors as "
+                        "float16.")
+    p.add_argument("--workers", type=int, default=1,
+                   help="Number of processes to embed recipe ingredients "
+                        "with.")
+    p.add_argument("--incremental", action="store_true",
+                   help="Only scrape, embed and add recipes which are new "
+                        "since the last run.")
+    p.add_argument("--revalidate", action="store_true",
+                   help="With --incremental, also revalidate already scraped "
+                        "recipes with conditional GETs and update the changed "
+                        "ones.")
+    p.add_argument("--chunk-size", type=int, default=None,
+                   help="Stream recipes through embedding, cleaning and "
+                        "adding to the graph in chunks of this many recipes, "
+                        "so that memory use does not grow with the number of "
+                        "recipes.")
+    p.add_argument("--write-workers", type=int, default=WRITE_WORKERS,
+                   help="Number of concurrent write transactions adding "
+                        "recipe ingredients to the database.")
+    p.add_argument("--jobs", type=int, default=4,
+                   help="Maximum number of independent stages run at once.")
+    p.add_argument("--dry-run", action="store_true",
+                   help="Only show which stages would run and why.")
+    p.add_argument("--bulk-import", action="store_true",
+                   help="Write the graph as CSV files for neo4j-admin "
+                        "database import instead of adding it through the "
+                        "database connection.")
     return p.parse_args()
 
 
+def build_pipeline(args, incremental: bool) -> Pipeline:
+    """Declares the stages of preparing the database.
+
+    Args:
+        args: The parsed command line arguments.
+        incremental: Whether only recipes added or changed since the last run
+            are scraped, embedded and added to the graph. Stages whose
+            parameters or code changed, or which depend on a rebuilt stage,
+            are still rebuilt entirely.
+    """
+    data_dir = args.DATA_DIR
+    uri = f"{args.uri}:{args.PORT}" if args.sqlite is None \
+        else f"{SQLITE_SCHEME}{args.sqlite}"
+    bbc_file = data_dir / "recipe_bbc.parquet"
+    sfp_file = data_dir / "studentfoodrecipe.parquet"
+    embedded_dirs = [embedded_path(bbc_file), embedded_path(sfp_file)]
+    canonical_embed_path = data_dir / "canonical_ingredient_embeddings.gz"
+    canonical_files = [canonical_embed_path]
+    if args.ann:
+        canonical_files.append(canonical_index_path(canonical_embed_path))
+    clean_files = [data_dir / "clean_datasets" / "recipes.csv",
+                   data_dir / "clean_datasets" / "values.csv"]
+    scraper_modules = ["scrapers.fetch", "scrapers.page_cache",
+                       "preprocessing.dataset_store"]
+
+    # Scraped recipes are re-parsed from the page cache when a scraper is
+    # rebuilt, e.g. after its code changed
+    def scrape_bbc():
+        scrape_from_bbc(data_dir, reparse=bbc_file.exists())
+
+    def scrape_sfp():
+        scrape_from_studentfoodproject(data_dir, reparse=sfp_file.exists())
+
+    def update_bbc():
+        scrape_from_bbc(data_dir, incremental=True,
+                        revalidate=args.revalidate)
+
+    def update_sfp():
+        scrape_from_studentfoodproject(data_dir, incremental=True,
+                                       revalidate=args.revalidate)
+
+    # The canonical names only need the memory-mapped GloVe model rather
+    # than the domain vocabulary, which is built from the scraped recipes,
+    # so they are embedded while scraping
+    def embed_canonical():
+        embed_canonical_ingredients(data_dir, canonical_embed_path,
+                                    load_glove_model(data_dir))
+        if args.ann:
+            build_canonical_index(canonical_embed_path)
+
+    model_loader = partial(load_domain_vectors, use_float16=args.float16)
+
+    def embed_recipes():
+        embed_recipe_ingredients(data_dir, args.ann, args.n_probe,
+                                 model_loader=model_loader,
+                                 workers=args.workers,
+                                 chunk_size=args.chunk_size)
+
+    def update_embedded_recipes():
+        embed_recipe_ingredients(
+            data_dir, args.ann, args.n_probe, model_loader=model_loader,
+            workers=args.workers,
+            recipe_files=find_recipe_files(delta_dir(data_dir)),
+            chunk_size=args.chunk_size
+        )
+        apply_embedded_deltas(data_dir)
+
+    def load_recipes(delta: bool = False):
+        add_recipes_to_graph(data_dir, uri, args.user, args.password,
+                             delta=delta, chunk_size=args.chunk_size,
+                             workers=args.write_workers)
+
+    def bulk_import():
+        write_bulk_import(data_dir, args.chunk_size or CHUNK_SIZE)
+
+    def incremental_update(update):
+        # Incremental runs scrape, embed and add only the new and changed
+        # recipes, unless a stage has to be rebuilt, see `pipeline`
+        return update if incremental else None
+
+    clean = partial(clean_data, data_dir, args.chunk_size)
+    stages = [
+        Stage("scrape_bbc", scrape_bbc, outputs=[bbc_file],
+              modules=["scrapers.scrape_bbc"] + scraper_modules,
+              always_run=incremental, update=incremental_update(update_bbc)),
+        Stage("scrape_sfp", scrape_sfp, outputs=[sfp_file],
+              modules=["scrapers.scrape_studentfood"] + scraper_modules,
+              always_run=incremental, update=incremental_update(update_sfp)),
+        Stage("embed_canonical", embed_canonical,
+              inputs=[data_dir / "nutrition.csv"], outputs=canonical_files,
+              modules=["preprocessing.word_embedding",
+                       "preprocessing.ann_index"],
+              params={"ann": args.ann}),
+        Stage("embed_recipes", embed_recipes,
+              inputs=[bbc_file, sfp_file] + canonical_files,
+              outputs=embedded_dirs,
+              deps=["scrape_bbc", "scrape_sfp", "embed_canonical"],
+              modules=["preprocessing.recipe_ingredient_embedding",
+                       "preprocessing.word_embedding",
+                       "preprocessing.quantities",
+                       "preprocessing.domain_vocabulary",
+                       "preprocessing.ann_index",
+                       "preprocessing.dataset_store",
+                       "preprocessing.delta"],
+              params={"ann": args.ann, "n_probe": args.n_probe,
+                      "float16": args.float16},
+              update=incremental_update(update_embedded_recipes)),
+    ]
+    if args.bulk_import:
+        stages.append(Stage(
+            "bulk_import", bulk_import,
+            inputs=embedded_dirs + [canonical_embed_path,
+                                    data_dir / "nutrition.csv",
+                                    data_dir / "substitutions.csv"],
+            outputs=import_files(data_dir),
+            deps=["embed_recipes", "embed_canonical"],
+            modules=["knowledge_graph.bulk_import",
+                     "knowledge_graph.ingredients_to_graph",
+                     "preprocessing.clean_data",
+                     "preprocessing.dataset_store",
+                     "preprocessing.quantities"]
+        ))
+        return Pipeline(stages, data_dir / "pipeline_state.json", args.jobs)
+
+    stages += [
+        # Cleaning always rebuilds the clean tables from the full embedded
+        # datasets, which updates them as well
+        Stage("clean", clean,
+              inputs=embedded_dirs, outputs=clean_files,
+              deps=["embed_recipes"],
+              modules=["preprocessing.clean_data",
+                       "preprocessing.dataset_store"],
+              update=incremental_update(clean)),
+        Stage("load_ingredients",
+              partial(add_ingredients_to_graph, data_dir, uri, args.user,
+                      args.password),
+              inputs=[canonical_embed_path, data_dir / "nutrition.csv",
+                      data_dir / "substitutions.csv"],
+              deps=["embed_canonical"],
+              modules=["knowledge_graph.ingredients_to_graph",
+                       "knowledge_graph.recipe_macros",
+                       "knowledge_graph.repository",
+                       "preprocessing.quantities"],
+              params={"uri": uri}),
+        Stage("load_recipes", load_recipes,
+              inputs=clean_files + embedded_dirs,
+              deps=["clean", "load_ingredients"],
+              modules=["knowledge_graph.recipes_to_graph",
+                       "knowledge_graph.recipe_macros",
+                       "knowledge_graph.repository",
+                       "preprocessing.clean_data",
+                       "preprocessing.dataset_store"],
+              params={"uri": uri},
+              update=incremental_update(partial(load_recipes, delta=True))),
+    ]
+    return Pipeline(stages, data_dir / "pipeline_state.json", args.jobs)
+
+
 if __name__ == '__main__':
     args = parse_args()
     data_dir = args.DATA_DIR
@@ -46,49 +274,44 @@ if __name__ == '__main__':
     assert (data_dir / "substitutions.csv").exists(), \
         "Substitutions dataset could not be found."
 
-    # First scrape the websites
-    if not (data_dir / "recipe_bbc.pkl").exists():
-        # Then we need to scrape the bbc website
-        print("Scraping BBC website...")
-        scrape_from_bbc(data_dir)
-    else:
-        print("BBC website already scraped.")
-
-    if not (data_dir / "studentfoodrecipe.pkl").exists():
-        # Then we need to scrape the student food project website
-        print("Scraping The Student Food Project website...")
-        scrape_from_studentfoodproject(data_dir)
-    else:
-        print("Student Food Project website already scraped.")
-
-    # We then embed all the ingredients
-    canonical_embed_path = data_dir / "canonical_ingredient_embeddings.gz"
-    if not canonical_embed_path.exists():
-        print("Embedding canonical ingredients")
-        # Load pretrained GloVe model
-        print("Loading pretrained GloVe model (this may take a while)...")
-        model = api.load("glove-wiki-gigaword-300")
-        print("Pretrained model loaded!")
-
-        embed_canonical_ingredients(data_dir, canonical_embed_path, model)
-    else:
-        print("Canonical ingredient embeddings found.")
-
-    if not ((data_dir / "recipe_bbc_embedded.pkl").exists()
-            and (data_dir / "studentfoodrecipe_embedded.pkl").exists()):
-        # Then we need to embed the ingredients in the recipes
-        print("Getting embeddings for recipe ingredients...")
-        embed_recipe_ingredients(data_dir)
-    else:
-        print("Recipe ingredient embeddings found.")
-
-    # And clean up the data for the other scripts
-    print("Cleaning data for scripts...")
-    clean_data(data_dir)
-
-    # Embed canonical ingredients
-
-    print("Now committing changes to the database.")
+    assert not (args.bulk_import and args.incremental), \
+        "A bulk import always imports the whole graph, it cannot be " \
+        "incremental."
+    assert not (args.bulk_import and args.sqlite), \
+        "A bulk import is for Neo4j, it cannot be written to SQLite."
+
+    # An incremental run only processes the recipes added or changed since
+    # the last run, which requires the full datasets to exist already
+    incremental = args.incremental and all(
+        (data_dir / file).exists()
+        for file in ["recipe_bbc_embedded", "studentfoodrecipe_embedded"]
+    )
+    pipeline = build_pipeline(args, incremental)
+
+    if args.dry_run:
+        pipeline.dry_run()
+        exit()
+
+    if args.bulk_import:
+        pipeline.run()
+        print("Import the files with the database stopped by running:")
+        print(import_command_line(data_dir))
+        print("Then start the database and create its constraints and "
+              "indexes with `python -m knowledge_graph.schema PORT`, and "
+              "the recipe macros with `python -m "
+              "knowledge_graph.recipe_macros bolt://localhost:PORT`.")
+        exit()
+
+    # First scrape, embed and clean the recipes
+    pipeline.run(targets=["clean"])
+
+    to_load = [name for name, reason in pipeline.plan().items()
+               if reason is not None]
+    if not to_load:
+        print("The database is up to date.")
+        exit()
+
+    print(f"Now committing changes to the database ({', '.join(to_load)}).")
     should_continue = False
     while not should_continue:
         user_input = input("Continue? (y/n) >> ")
@@ -97,9 +320,4 @@ if __name__ == '__main__':
         elif user_input == "y":
             should_continue = True
 
-    uri = f"{args.uri}:{args.PORT}"
-
-    print("Adding canonical ingredients to graph")
-    add_ingredients_to_graph(data_dir, uri, args.user, args.password)
-    print("Adding recipes to graph")
-    add_recipes_to_graph(data_dir, uri, args.user, args.password)
+    pipeline.run()
@@ -0,0 +1,314 @@
+"""ANN Index.
+
+Nearest neighbour indexes for looking up canonical ingredient embeddings.
+
+Two interchangeable indexes are provided. Both search by cosine similarity and
+return the similarities and row indices of the best matches, where a row index
+refers to the `index_to_key` of the canonical KeyedVectors object.
+
+    ExactIndex: Brute force search using chunked matrix multiplications.
+    IVFIndex:   Approximate inverted file index. Canonical embeddings are
+                clustered with spherical k-means and only the `n_probe`
+                clusters closest to a query are searched. Increasing `n_probe`
+                trades latency for recall.
+
+The IVF index is built once and saved next to the canonical KeyedVectors file.
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+from typing import Tuple, Optional
+
+import numpy as np
+from gensim.models import KeyedVectors
+
+MATCH_CHUNK_SIZE = 1024
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalizes every row of the given matrix."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _top_k(similarities: np.ndarray, topn: int) -> np.ndarray:
+    """Indices of the `topn` largest values per row, sorted descending."""
+    topn = min(topn, similarities.shape[1])
+    if topn == 1:
+        return np.argmax(similarities, axis=1)[:, np.newaxis]
+    part = np.argpartition(-similarities, topn - 1, axis=1)[:, :topn]
+    part_sims = np.take_along_axis(similarities, part, axis=1)
+    order = np.argsort(-part_sims, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+
+class ExactIndex:
+    """Exact cosine similarity search over a set of vectors."""
+    def __init__(self, vectors: np.ndarray,
+                 chunk_size: int = MATCH_CHUNK_SIZE):
+        """Creates an exact index.
+
+        Args:
+            vectors: The vectors to search through, one per row.
+            chunk_size: Number of queries to compare per matrix
+                multiplication. Bounds the size of the similarity matrix held
+                in memory.
+        """
+        self.vectors = normalize_rows(vectors)
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @classmethod
+    def from_normalized(cls, vectors: np.ndarray,
+                        chunk_size: int = MATCH_CHUNK_SIZE) -> "ExactIndex":
+        """Creates an exact index over already normalized vectors.
+
+        The vectors are used as they are, without being copied, so they may
+        e.g. be memory-mapped.
+        """
+        index = cls.__new__(cls)
+        index.vectors = vectors
+        index.chunk_size = chunk_size
+        return index
+
+    def search(self, queries: np.ndarray,
+               topn: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the most similar vectors for every query.
+
+        Args:
+            queries: The query vectors, one per row.
+            topn: The number of neighbours to return per query.
+
+        Returns:
+            A tuple of (similarities, indices), both of shape
+                (len(queries), topn).
+        """
+        queries = normalize_rows(np.atleast_2d(queries))
+        all_sims, all_idxs = [], []
+        for start in range(0, len(queries), self.chunk_size):
+            similarities = queries[start:start + self.chunk_size] \
+                @ self.vectors.T
+            idxs = _top_k(similarities, topn)
+            all_idxs.append(idxs)
+            all_sims.append(np.take_along_axis(similarities, idxs, axis=1))
+        return np.concatenate(all_sims), np.concatenate(all_idxs)
+
+
+class IVFIndex:
+    """Approximate inverted file index using cosine similarity."""
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray,
+                 list_ids: np.ndarray, vectors: np.ndarray, n_probe: int):
+        """Creates an IVF index from its parts.
+
+        Use `IVFIndex.build` or `IVFIndex.load` instead of calling this
+        directly.
+
+        Args:
+            centroids: The normalized cluster centroids.
+            list_offsets: Start offsets of each cluster in `list_ids`, with
+                one extra entry holding the total length.
+            list_ids: Row indices of the vectors, grouped by cluster.
+            vectors: The normalized vectors, ordered like `list_ids`.
+            n_probe: The number of clusters to search per query.
+        """
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.vectors = vectors
+        self.n_probe = n_probe
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, n_lists: Optional[int] = None,
+              n_probe: Optional[int] = None, n_iter: int = 20,
+              seed: int = 0) -> "IVFIndex":
+        """Builds an IVF index using spherical k-means.
+
+        Args:
+            vectors: The vectors to index, one per row.
+            n_lists: Number of clusters. Defaults to 4 * sqrt(len(vectors)).
+            n_probe: Number of clusters searched per query. Defaults to an
+                eighth of the clusters.
+            n_iter: Number of k-means iterations.
+            seed: Seed used to pick the initial centroids.
+        """
+        vectors = normalize_rows(vectors)
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+        if n_probe is None:
+            n_probe = max(1, n_lists // 8)
+
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        exact = ExactIndex(centroids)
+        for _ in range(n_iter):
+            exact.vectors = centroids
+            assignment = exact.search(vectors)[1][:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, vectors)
+            counts = np.bincount(assignment, minlength=n_lists)
+            # Re-seed empty clusters with random vectors
+            empty = counts == 0
+            sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+            centroids = normalize_rows(sums)
+        exact.vectors = centroids
+        assignment = exact.search(vectors)[1][:, 0]
+
+        list_ids = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=n_lists)
+        list_offsets = np.concatenate(([0], np.cumsum(counts)))
+        return cls(centroids, list_offsets, list_ids, vectors[list_ids],
+                   n_probe)
+
+    def search(self, queries: np.ndarray,
+               topn: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the approximately most similar vectors for every query.
+
+        Args:
+            queries: The query vectors, one per row.
+            topn: The number of neighbours to return per query.
+
+        Returns:
+            A tuple of (similarities, indices), both of shape
+                (len(queries), topn). If fewer than `topn` candidates were
+                found, the remaining indices are -1 and similarities -inf.
+        """
+        queries = normalize_rows(np.atleast_2d(queries))
+        n_probe = max(1, min(self.n_probe, self.n_lists))
+        out_sims = np.full((len(queries), topn), -np.inf, dtype=np.float32)
+        out_idxs = np.full((len(queries), topn), -1, dtype=np.int64)
+
+        probes = _top_k(queries @ self.centroids.T, n_probe)
+        for q, (query, clusters) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([
+                np.arange(self.list_offsets[c], self.list_offsets[c + 1])
+                for c in clusters
+            ])
+            if len(candidates) == 0:
+                continue
+            similarities = self.vectors[candidates] @ query
+            best = _top_k(similarities[np.newaxis, :], topn)[0]
+            out_sims[q, :len(best)] = similarities[best]
+            out_idxs[q, :len(best)] = self.list_ids[candidates[best]]
+        return out_sims, out_idxs
+
+    def save(self, path: Path):
+        """Saves the index to the given .npz file."""
+        np.savez(path, centroids=self.centroids,
+                 list_offsets=self.list_offsets, list_ids=self.list_ids,
+                 vectors=self.vectors, n_probe=self.n_probe)
+
+    @classmethod
+    def load(cls, path: Path, n_probe: Optional[int] = None) -> "IVFIndex":
+        """Loads an index saved with `save`.
+
+        Args:
+            path: Path to the saved index.
+            n_probe: Overrides the number of clusters searched per query.
+        """
+        with np.load(path) as f:
+            index = cls(f["centroids"], f["list_offsets"], f["list_ids"],
+                        f["vectors"], int(f["n_probe"]))
+        if n_probe is not None:
+            index.n_probe = n_probe
+        return index
+
+
+def canonical_index_path(embedding_path: Path) -> Path:
+    """Path of the IVF index belonging to a canonical embeddings file."""
+    return embedding_path.with_name(embedding_path.name.split(".")[0]
+                                    + "_ivf.npz")
+
+
+def build_canonical_index(embedding_path: Path,
+                          n_lists: Optional[int] = None,
+                          n_probe: Optional[int] = None) -> IVFIndex:
+    """Builds and saves the IVF index for the canonical embeddings.
+
+    Args:
+        embedding_path: Path to the canonical ingredient KeyedVectors file.
+        n_lists: Number of clusters, see `IVFIndex.build`.
+        n_probe: Number of clusters searched per query, see `IVFIndex.build`.
+    """
+    canonical_embeddings = KeyedVectors.load(str(embedding_path))
+    start = perf_counter()
+    index = IVFIndex.build(canonical_embeddings.vectors, n_lists, n_probe)
+    t = perf_counter() - start
+    index.save(canonical_index_path(embedding_path))
+    print(f"Built IVF index with {index.n_lists} lists. {t=:.3f}")
+    return index
+
+
+def recall_report(index: IVFIndex, exact: ExactIndex, queries: np.ndarray,
+                  n_probes: Tuple[int, ...], topn: int = 1):
+    """Prints recall and latency of the IVF index against exact search.
+
+    Args:
+        index: The approximate index to evaluate.
+        exact: Exact index over the same vectors.
+        queries: The query vectors, one per row.
+        n_probes: The `n_probe` values to evaluate.
+        topn: Recall is measured over the `topn` nearest neighbours.
+    """
+    start = perf_counter()
+    truth = exact.search(queries, topn)[1]
+    t_exact = (perf_counter() - start) / len(queries) * 1000
+    print(f"exact: {t_exact:.4f} ms/query")
+
+    original_n_probe = index.n_probe
+    for n_probe in n_probes:
+        index.n_probe = n_probe
+        start = perf_counter()
+        found = index.search(queries, topn)[1]
+        t = (perf_counter() - start) / len(queries) * 1000
+        hits = sum(len(np.intersect1d(f, tr)) for f, tr in zip(found, truth))
+        recall = hits / truth.size
+        print(f"n_probe={n_probe:4d}: recall@{topn}={recall:.4f} "
+              f"{t:.4f} ms/query")
+    index.n_probe = original_n_probe
+
+
+def parse_args():
+    """Parses the command line arguments."""
+    p = ArgumentParser(description="Builds the IVF index of the canonical "
+                                   "ingredient embeddings and reports its "
+                                   "recall against exact search.")
+    p.add_argument("DATA_DIR", type=Path,
+                   help="Path to the data directory.")
+    p.add_argument("--n-lists", type=int, default=None,
+                   help="Number of clusters in the index.")
+    p.add_argument("--n-probe", type=int, nargs="+", default=[1, 4, 16, 64],
+                   help="n_probe values to evaluate.")
+    p.add_argument("--topn", type=int, default=1,
+                   help="Number of neighbours to measure recall over.")
+    p.add_argument("--queries", type=int, default=1000,
+                   help="Number of (noisy canonical) query vectors.")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    embed_path = args.DATA_DIR / "canonical_ingredient_embeddings.gz"
+    ivf = build_canonical_index(embed_path, args.n_lists)
+    canonical = KeyedVectors.load(str(embed_path))
+
+    # Queries are canonical embeddings with noise added, so that they do not
+    # trivially find themselves.
+    gen = np.random.default_rng(0)
+    sample = canonical.get_normed_vectors()[
+        gen.choice(len(canonical), min(args.queries, len(canonical)),
+                   replace=False)]
+    noisy = sample + gen.normal(scale=0.05, size=sample.shape)
+    recall_report(ivf, ExactIndex(canonical.vectors), noisy,
+                  tuple(args.n_probe), args.topn)
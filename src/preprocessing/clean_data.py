@@ -1,49 +1,153 @@
-import pandas as pd
+from itertools import chain
 from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from preprocessing.dataset_store import iter_recipe_table
+
+# Columns of the embedded datasets needed for the clean tables
+RECIPE_TABLE_COLUMNS = ["name", "recipe_url", "description", "method",
+                        "nutrition_name", "nutrition_value"]
+
+# Nutrition names on the recipe pages and their columns in the clean table
+NUTRITION_COLUMNS = {"kcal": "Calories",
+                     "fat": "Total Fat",
+                     "saturates": "Saturated Fat",
+                     "carbs": "Carbohydrates",
+                     "sugars": "Sugars",
+                     "fibre": "Fiber",
+                     "protein": "Protein",
+                     "salt": "Sodium"}
+
+# A number with an optional unit, e.g. "479", "20g" or "0.5 mg"
+NUTRITION_VALUE_REGEX = (r"^\s*(?P<number>\d+(?:\.\d+)?)"
+                         r"\s*(?P<unit>k?cal|m?g)?\s*$")
+
+
+def _list_lengths(column: pd.Series) -> np.ndarray:
+    """Lengths of the lists in a column, 0 for missing lists."""
+    return np.array([len(x) if isinstance(x, list) else 0
+                     for x in column.tolist()], dtype=np.int64)
+
+
+def nutrition_table(recipes: pd.DataFrame) -> pd.DataFrame:
+    """Extracts the nutritional values of recipes into a wide table.
+
+    The `nutrition_name` and `nutrition_value` lists of every recipe are
+    flattened into (name, value) pairs, so that values are matched by their
+    name rather than their position. Values are converted to numbers, in
+    grams for weights. Only the few distinct names and values are parsed,
+    with pandas string operations.
 
+    Args:
+        recipes: Recipes with columns [name, nutrition_name, nutrition_value].
 
-def clean_data(data_dir: Path):
-    """Cleans the data so that it can be easily added to the database."""
-    recipes = []
+    Returns:
+        One row per recipe with at least one known nutritional value, with
+            columns name and those of `NUTRITION_COLUMNS`. Missing values are
+            NaN.
+    """
+    name_lengths = _list_lengths(recipes["nutrition_name"])
+    valid = (name_lengths > 0) & (
+        name_lengths == _list_lengths(recipes["nutrition_value"])
+    )
+    mismatched = ((name_lengths > 0) & ~valid).sum()
+    if mismatched:
+        print(f"Skipping {mismatched} recipes with mismatched nutrition "
+              f"lists.")
 
-    for file in data_dir.glob("*_embedded.pkl"):
-        recipes.append(pd.read_pickle(file))
+    # Flatten the lists into one (recipe, name, value) row per pair
+    recipe = np.repeat(np.flatnonzero(valid), name_lengths[valid])
+    names = list(chain.from_iterable(
+        recipes["nutrition_name"].to_numpy()[valid]
+    ))
+    values = list(chain.from_iterable(
+        recipes["nutrition_value"].to_numpy()[valid]
+    ))
 
-    recipes = pd.concat(recipes)
+    # Map every nutrition name to the index of its column
+    name_codes, unique_names = pd.factorize(pd.Series(names, dtype=object))
+    column_index = {name: i for i, name in enumerate(NUTRITION_COLUMNS)}
+    unique_columns = pd.Series(unique_names).str.strip().str.lower() \
+        .map(column_index).fillna(-1).to_numpy(dtype=np.int64)
+    column = unique_columns[name_codes] if len(names) \
+        else np.zeros(0, dtype=np.int64)
 
+    # Convert every value to a number
+    value_codes, unique_values = pd.factorize(pd.Series(values, dtype=object))
+    parsed = pd.Series(unique_values, dtype=object).astype(str) \
+        .str.extract(NUTRITION_VALUE_REGEX)
+    unique_amounts = np.array(pd.to_numeric(parsed["number"]), dtype=float)
+    unique_amounts[(parsed["unit"] == "mg").to_numpy()] /= 1000
+    amount = unique_amounts[value_codes] if len(values) \
+        else np.zeros(0, dtype=float)
+
+    known = column >= 0
+    unparsed = known & np.isnan(amount)
+    if unparsed.any():
+        print(f"Could not parse {unparsed.sum()} nutritional values, e.g. "
+              f"{values[np.flatnonzero(unparsed)[0]]!r}.")
+
+    # Scatter the values into one row per recipe with a known value, keeping
+    # the first value of duplicate names
+    rows, row = np.unique(recipe[known], return_inverse=True)
+    n_columns = len(NUTRITION_COLUMNS)
+    _, first = np.unique(row * n_columns + column[known], return_index=True)
+    wide = np.full((len(rows), n_columns), np.nan)
+    wide[row[first], column[known][first]] = amount[known][first]
+
+    nv_only = pd.DataFrame(wide, columns=list(NUTRITION_COLUMNS.values()))
+    nv_only.insert(0, "name", recipes["name"].to_numpy()[rows])
+    validate_nutrition_table(nv_only)
+    return nv_only
+
+
+def validate_nutrition_table(nv_only: pd.DataFrame):
+    """Checks that a nutrition table holds valid, numeric values.
+
+    Raises:
+        ValueError: If a column is missing or not numeric, or a value is
+            negative.
+    """
+    for column in NUTRITION_COLUMNS.values():
+        if column not in nv_only:
+            raise ValueError(f"Nutrition column {column} is missing.")
+        if not pd.api.types.is_float_dtype(nv_only[column]):
+            raise ValueError(f"Nutrition column {column} is not numeric.")
+        if (nv_only[column] < 0).any():
+            raise ValueError(f"Nutrition column {column} has negative "
+                             f"values.")
+
+
+def recipe_tables(recipes: pd.DataFrame
+                  ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Splits embedded recipes into a recipe table and a nutrition table."""
     only_recipes = recipes[["name", "recipe_url", "description", "method"]]
-    only_recipes.to_csv(data_dir / "clean_datasets" / "recipes.csv",
-                        index=False)
-
-    name_list = []
-    kcal_list = []
-    fat_list = []
-    saturates_list = []
-    carbs_list = []
-    sugars_list = []
-    fibre_list = []
-    protein_list = []
-    salt_list = []
-    for name, item in zip(recipes["name"].tolist(),
-                          recipes['nutrition_value'].tolist()):
-        if item is not None:
-            if len(item) > 1:
-                name_list.append(name)
-                kcal_list.append(item[0])
-                fat_list.append(item[1].strip('g'))
-                saturates_list.append(item[2].strip('g'))
-                carbs_list.append(item[3].strip('g'))
-                sugars_list.append(item[4].strip('g'))
-                fibre_list.append(item[5].strip('g'))
-                protein_list.append(item[6].strip('g'))
-                salt_list.append(item[7].strip('g'))
-    val_dict = {
-        "name": name_list, 'Calories': kcal_list, 'Total Fat': fat_list,
-        'Saturated Fat': saturates_list, 'Carbohydrates': carbs_list,
-        'Sugars': sugars_list, 'Fiber': fibre_list, 'Protein': protein_list,
-        'Sodium': salt_list
-    }
-
-    nv_only = pd.DataFrame(val_dict)
-
-    nv_only.to_csv(data_dir / "clean_datasets" / "values.csv", index=False)
+    return only_recipes, nutrition_table(recipes)
+
+
+def clean_data(data_dir: Path, chunk_size: Optional[int] = None):
+    """Cleans the data so that it can be easily added to the database.
+
+    Args:
+        data_dir: Path to the data directory.
+        chunk_size: Number of recipes cleaned at a time, so that memory use
+            does not grow with the number of recipes. Whole datasets are
+            cleaned at once if None.
+    """
+    recipes_path = data_dir / "clean_datasets" / "recipes.csv"
+    values_path = data_dir / "clean_datasets" / "values.csv"
+    first = True
+
+    for embedded_dir in data_dir.glob("*_embedded"):
+        for recipes in iter_recipe_table(embedded_dir, chunk_size,
+                                         RECIPE_TABLE_COLUMNS):
+            # The first chunk replaces the old tables, later ones append
+            only_recipes, nv_only = recipe_tables(recipes)
+            only_recipes.to_csv(recipes_path, mode="w" if first else "a",
+                                header=first, index=False)
+            nv_only.to_csv(values_path, mode="w" if first else "a",
+                           header=first, index=False)
+            first = False
@@ -0,0 +1,473 @@
+"""Dataset Store.
+
+Columnar on-disk storage of the scraped and embedded recipe datasets.
+
+Scraped datasets, e.g. `recipe_bbc.parquet`, are single Parquet tables with
+one row per recipe and list columns for ingredients, method and nutrition.
+
+Embedded datasets, e.g. `recipe_bbc_embedded/`, are normalized into three
+tables so that each stage only reads the columns it needs:
+
+    recipes.parquet:     One row per recipe, without its ingredients.
+    ingredients.parquet: One row per recipe ingredient, referencing its
+                         recipe by `recipe_id` (the row in recipes.parquet)
+                         and its embedding by `embedding_id`.
+    embeddings.arrow:    One row per distinct ingredient embedding, stored as
+                         a contiguous fixed size list float32 column in an
+                         uncompressed Arrow IPC file. It is memory-mapped, so
+                         the embeddings are read without being copied.
+
+Datasets can also be read and written in chunks of a bounded number of
+recipes, see `iter_recipes`, `iter_embedded`, `RecipeWriter` and
+`EmbeddedWriter`, so that memory use does not grow with the number of recipes.
+"""
+import hashlib
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+RECIPE_COLUMNS = ["name", "description", "nutrition_name", "nutrition_value",
+                  "ingredients", "method", "recipe_url"]
+INGREDIENT_COLUMNS = ["original_name", "amount", "grams", "ingredient_name",
+                      "canonical_name"]
+
+RECIPES_SCHEMA = pa.schema([("name", pa.string()),
+                            ("description", pa.string()),
+                            ("nutrition_name", pa.list_(pa.string())),
+                            ("nutrition_value", pa.list_(pa.string())),
+                            ("method", pa.list_(pa.string())),
+                            ("recipe_url", pa.string())])
+SCRAPED_SCHEMA = RECIPES_SCHEMA.insert(4, pa.field("ingredients",
+                                                   pa.list_(pa.string())))
+INGREDIENTS_SCHEMA = pa.schema([("recipe_id", pa.int32()),
+                                ("original_name", pa.string()),
+                                ("amount", pa.string()),
+                                ("grams", pa.float64()),
+                                ("ingredient_name", pa.string()),
+                                ("canonical_name", pa.string()),
+                                ("embedding_id", pa.int32())])
+
+# Number of recipes per chunk when streaming datasets
+CHUNK_SIZE = 10000
+
+
+def embedded_path(recipe_file: Path) -> Path:
+    """Path of the embedded dataset belonging to a scraped dataset."""
+    return recipe_file.with_name(recipe_file.stem + "_embedded")
+
+
+def save_recipes(recipe_df: pd.DataFrame, path: Path):
+    """Saves a scraped dataset as a Parquet table."""
+    with RecipeWriter(path) as writer:
+        writer.write(recipe_df)
+
+
+class RecipeWriter:
+    """Writes a scraped dataset chunk by chunk.
+
+    The table is written to a temporary file, which only replaces `path` once
+    the writer is closed without an error.
+    """
+    def __init__(self, path: Path):
+        """Opens the writer.
+
+        Args:
+            path: Path of the Parquet table.
+        """
+        self.path = path
+        self.tmp_path = path.with_name(path.name + ".tmp")
+        self.writer = pq.ParquetWriter(self.tmp_path, SCRAPED_SCHEMA)
+        self.count = 0
+
+    def write(self, recipe_df: pd.DataFrame):
+        """Appends a chunk of recipes."""
+        self.writer.write_table(pa.Table.from_pandas(
+            recipe_df[RECIPE_COLUMNS], schema=SCRAPED_SCHEMA,
+            preserve_index=False
+        ))
+        self.count += len(recipe_df)
+
+    def close(self):
+        """Finishes the table and moves it into place."""
+        self.writer.close()
+        self.tmp_path.replace(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.close()
+            self.tmp_path.unlink(missing_ok=True)
+
+
+def record_chunks(records: Iterable[dict],
+                  chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """Groups recipe records, e.g. read from a checkpoint, into dataframes.
+
+    Args:
+        records: Recipe dictionaries with the keys of `RECIPE_COLUMNS`.
+        chunk_size: Maximum number of recipes per dataframe.
+    """
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield pd.DataFrame(chunk, columns=RECIPE_COLUMNS)
+
+
+def write_recipe_records(records: Iterable[dict], path: Path,
+                         chunk_size: int = CHUNK_SIZE) -> int:
+    """Saves recipe records as a scraped dataset, chunk by chunk.
+
+    Returns:
+        The number of recipes written.
+    """
+    with RecipeWriter(path) as writer:
+        for chunk in record_chunks(records, chunk_size):
+            writer.write(chunk)
+    return writer.count
+
+
+def _iter_tables(path: Path, chunk_size: Optional[int] = None,
+                 columns: Optional[List[str]] = None) -> Iterator[pa.Table]:
+    """Reads a Parquet file in tables of at most `chunk_size` rows.
+
+    The whole file is read as a single table if `chunk_size` is None or the
+    file is empty.
+    """
+    # Pre-buffering keeps the buffers of every row group read so far, so
+    # memory would grow with the file
+    parquet_file = pq.ParquetFile(path, pre_buffer=False)
+    if chunk_size is None or parquet_file.metadata.num_rows == 0:
+        yield parquet_file.read(columns=columns)
+        return
+    for batch in parquet_file.iter_batches(batch_size=chunk_size,
+                                           columns=columns):
+        yield pa.Table.from_batches([batch])
+
+
+def load_recipes(path: Path,
+                 columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Loads a scraped dataset.
+
+    Args:
+        path: Path of the Parquet table.
+        columns: The columns to read. Defaults to all columns.
+    """
+    return table_to_pandas(pq.read_table(path, columns=columns))
+
+
+def iter_recipes(path: Path, chunk_size: Optional[int] = None,
+                 columns: Optional[List[str]] = None
+                 ) -> Iterator[pd.DataFrame]:
+    """Reads a scraped dataset in chunks.
+
+    Args:
+        path: Path of the Parquet table.
+        chunk_size: Maximum number of recipes per chunk. The whole dataset is
+            read as a single chunk if None.
+        columns: The columns to read. Defaults to all columns.
+    """
+    for table in _iter_tables(path, chunk_size, columns):
+        yield table_to_pandas(table)
+
+
+def count_recipes(path: Path) -> int:
+    """Number of recipes in a scraped dataset, read from its metadata."""
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def table_to_pandas(table: pa.Table) -> pd.DataFrame:
+    """Converts a table read from a dataset into a dataframe."""
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_floating(column.type):
+            columns[name] = column.to_numpy()
+        else:
+            # Strings, lists and nullable ids become Python objects, as in
+            # the pickled datasets
+            columns[name] = pd.Series(column.to_pylist(), dtype=object)
+    return pd.DataFrame(columns)
+
+
+def save_embedded(recipe_df: pd.DataFrame, out_dir: Path):
+    """Saves an embedded dataset as normalized columnar tables.
+
+    Args:
+        recipe_df: The recipes, where every ingredient is a dictionary with
+            keys [original_name, amount, grams, ingredient_name,
+            canonical_name, embedding], as returned by
+            `embed_ingredient_lists`.
+        out_dir: Directory the tables are written to.
+    """
+    with EmbeddedWriter(out_dir) as writer:
+        writer.write(recipe_df)
+
+
+class EmbeddedWriter:
+    """Writes an embedded dataset chunk by chunk.
+
+    Tables are written to temporary files first and only replace the old ones
+    once the writer is closed without an error, so that memory-mapped
+    embeddings of the old dataset stay valid. Distinct embeddings are
+    appended to a raw temporary file as they are found and only copied into
+    the Arrow file on close, so they are not kept in memory either.
+    """
+    TABLES = ["recipes.parquet", "ingredients.parquet", "embeddings.arrow"]
+
+    def __init__(self, out_dir: Path):
+        """Opens the writer.
+
+        Args:
+            out_dir: Directory the tables are written to.
+        """
+        self.out_dir = out_dir
+        out_dir.mkdir(parents=True, exist_ok=True)
+        self.recipe_writer = pq.ParquetWriter(
+            out_dir / "recipes.parquet.tmp", RECIPES_SCHEMA
+        )
+        self.ingredient_writer = pq.ParquetWriter(
+            out_dir / "ingredients.parquet.tmp", INGREDIENTS_SCHEMA
+        )
+        self.raw_path = out_dir / "embeddings.raw.tmp"
+        self.raw_file = open(self.raw_path, "wb")
+        # Digests of the distinct embeddings, so that ingredients with the
+        # same embedding share one row
+        self.embedding_ids = {}
+        self.dim = None
+        self.n_recipes = 0
+
+    def write(self, recipe_df: pd.DataFrame):
+        """Appends a chunk of embedded recipes, see `save_embedded`."""
+        ingredient_rows = {column: [] for column in INGREDIENTS_SCHEMA.names}
+        for recipe_id, ingredient_list in enumerate(recipe_df["ingredients"],
+                                                    self.n_recipes):
+            for ingredient in ingredient_list:
+                ingredient_rows["recipe_id"].append(recipe_id)
+                for column in INGREDIENT_COLUMNS:
+                    ingredient_rows[column].append(ingredient.get(column))
+                embedding = ingredient["embedding"]
+                if embedding is None:
+                    ingredient_rows["embedding_id"].append(None)
+                    continue
+                embedding = np.asarray(embedding, dtype=np.float32)
+                key = hashlib.blake2b(embedding.tobytes(),
+                                      digest_size=16).digest()
+                if key not in self.embedding_ids:
+                    self.embedding_ids[key] = len(self.embedding_ids)
+                    self.dim = len(embedding)
+                    self.raw_file.write(embedding.tobytes())
+                ingredient_rows["embedding_id"].append(
+                    self.embedding_ids[key]
+                )
+
+        recipes = recipe_df.drop(columns="ingredients")
+        self.recipe_writer.write_table(pa.Table.from_pandas(
+            recipes[RECIPES_SCHEMA.names], schema=RECIPES_SCHEMA,
+            preserve_index=False
+        ))
+        self.ingredient_writer.write_table(
+            pa.table(ingredient_rows, schema=INGREDIENTS_SCHEMA)
+        )
+        self.n_recipes += len(recipe_df)
+
+    def _write_embeddings(self):
+        """Copies the raw embeddings into a single chunk Arrow file."""
+        # Arrow needs a positive list size, even without any embeddings
+        dim = self.dim or 1
+        if self.embedding_ids:
+            matrix = np.memmap(self.raw_path, dtype=np.float32, mode="r")
+        else:
+            matrix = np.zeros(0, dtype=np.float32)
+        column = pa.FixedSizeListArray.from_arrays(
+            pa.array(matrix, type=pa.float32()), dim
+        )
+        table = pa.table({"embedding": column})
+        with pa.OSFile(str(self.out_dir / "embeddings.arrow.tmp"),
+                       "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    def close(self):
+        """Finishes the tables and moves them into place."""
+        self.recipe_writer.close()
+        self.ingredient_writer.close()
+        self.raw_file.close()
+        self._write_embeddings()
+        self.raw_path.unlink()
+        for name in self.TABLES:
+            (self.out_dir / (name + ".tmp")).replace(self.out_dir / name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        self.recipe_writer.close()
+        self.ingredient_writer.close()
+        self.raw_file.close()
+        self.raw_path.unlink(missing_ok=True)
+        for name in self.TABLES:
+            (self.out_dir / (name + ".tmp")).unlink(missing_ok=True)
+
+
+def load_recipe_table(embedded_dir: Path,
+                      columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Loads the recipes of an embedded dataset, without their ingredients.
+
+    Args:
+        embedded_dir: Directory of the embedded dataset.
+        columns: The columns to read. Defaults to all columns.
+    """
+    return table_to_pandas(pq.read_table(embedded_dir / "recipes.parquet",
+                                    columns=columns))
+
+
+def iter_recipe_table(embedded_dir: Path, chunk_size: Optional[int] = None,
+                      columns: Optional[List[str]] = None
+                      ) -> Iterator[pd.DataFrame]:
+    """Reads the recipes of an embedded dataset in chunks, see `iter_recipes`.
+    """
+    return iter_recipes(embedded_dir / "recipes.parquet", chunk_size, columns)
+
+
+def load_ingredient_table(embedded_dir: Path,
+                          columns: Optional[List[str]] = None
+                          ) -> pd.DataFrame:
+    """Loads the ingredients of an embedded dataset.
+
+    Args:
+        embedded_dir: Directory of the embedded dataset.
+        columns: The columns to read. Defaults to all columns.
+    """
+    return table_to_pandas(pq.read_table(embedded_dir / "ingredients.parquet",
+                                    columns=columns))
+
+
+def load_embeddings(embedded_dir: Path) -> np.ndarray:
+    """Memory-maps the embeddings of an embedded dataset.
+
+    Returns:
+        A read-only float32 matrix with one embedding per row, indexed by
+            the `embedding_id` of the ingredients.
+    """
+    source = pa.memory_map(str(embedded_dir / "embeddings.arrow"))
+    column = pa.ipc.open_file(source).read_all().column("embedding")
+    dim = column.type.list_size
+    if len(column) == 0:
+        return np.zeros((0, dim), dtype=np.float32)
+    # The embeddings are written as a single chunk, which is read in place
+    array = column.chunk(0) if column.num_chunks == 1 \
+        else column.combine_chunks()
+    return array.flatten().to_numpy(zero_copy_only=True).reshape(-1, dim)
+
+
+def _group_ingredients(recipes: pd.DataFrame, ingredients: pd.DataFrame,
+                       first_id: int, embeddings: np.ndarray) -> pd.DataFrame:
+    """Adds the ingredient lists to recipes, numbered from `first_id`."""
+    ingredient_lists = [[] for _ in range(len(recipes))]
+    embedding_ids = ingredients["embedding_id"].tolist()
+    records = ingredients[["recipe_id"] + INGREDIENT_COLUMNS].to_dict(
+        "records"
+    )
+    for record, embedding_id in zip(records, embedding_ids):
+        recipe_id = record.pop("recipe_id")
+        if record["grams"] is not None and np.isnan(record["grams"]):
+            record["grams"] = None
+        record["embedding"] = None if pd.isna(embedding_id) \
+            else embeddings[int(embedding_id)]
+        ingredient_lists[recipe_id - first_id].append(record)
+    recipes.insert(RECIPE_COLUMNS.index("ingredients"), "ingredients",
+                   ingredient_lists)
+    return recipes
+
+
+def iter_embedded_tables(embedded_dir: Path,
+                         chunk_size: Optional[int] = None,
+                         recipe_columns: Optional[List[str]] = None,
+                         ingredient_columns: Optional[List[str]] = None
+                         ) -> Iterator[Tuple[pa.Table, pa.Table, int]]:
+    """Reads the recipes and ingredients tables of an embedded dataset in
+    chunks of matching recipes.
+
+    The tables are read side by side, which works because ingredients are
+    stored ordered by their recipe.
+
+    Args:
+        embedded_dir: Directory of the embedded dataset.
+        chunk_size: Maximum number of recipes per chunk. The whole dataset is
+            read as a single chunk if None.
+        recipe_columns: The columns of the recipes to read. Defaults to all
+            columns.
+        ingredient_columns: The columns of the ingredients to read, besides
+            `recipe_id`. Defaults to all columns.
+
+    Yields:
+        The recipes of a chunk, their ingredients and the `recipe_id` of the
+            first recipe of the chunk.
+    """
+    if ingredient_columns is not None:
+        ingredient_columns = ["recipe_id"] + [
+            column for column in ingredient_columns if column != "recipe_id"
+        ]
+    ingredient_tables = _iter_tables(embedded_dir / "ingredients.parquet",
+                                     chunk_size, ingredient_columns)
+    pending = INGREDIENTS_SCHEMA.empty_table()
+    if ingredient_columns is not None:
+        pending = pending.select(ingredient_columns)
+    exhausted = False
+    first_id = 0
+    for recipe_table in _iter_tables(embedded_dir / "recipes.parquet",
+                                     chunk_size, recipe_columns):
+        end_id = first_id + recipe_table.num_rows
+        # Read ingredients until all those of this chunk are pending
+        while not exhausted and (pending.num_rows == 0 or
+                                 pending["recipe_id"][-1].as_py() < end_id):
+            try:
+                pending = pa.concat_tables([pending,
+                                            next(ingredient_tables)])
+            except StopIteration:
+                exhausted = True
+        split = int(np.searchsorted(pending["recipe_id"].to_numpy(), end_id))
+        yield recipe_table, pending.slice(0, split), first_id
+        pending = pending.slice(split)
+        first_id = end_id
+
+
+def iter_embedded(embedded_dir: Path, chunk_size: Optional[int] = None
+                  ) -> Iterator[pd.DataFrame]:
+    """Reads an embedded dataset in chunks, see `load_embedded`.
+
+    Args:
+        embedded_dir: Directory of the embedded dataset.
+        chunk_size: Maximum number of recipes per chunk. The whole dataset is
+            read as a single chunk if None.
+    """
+    embeddings = load_embeddings(embedded_dir)
+    for recipe_table, ingredient_table, first_id in iter_embedded_tables(
+            embedded_dir, chunk_size):
+        yield _group_ingredients(table_to_pandas(recipe_table),
+                                 table_to_pandas(ingredient_table),
+                                 first_id, embeddings)
+
+
+def load_embedded(embedded_dir: Path) -> pd.DataFrame:
+    """Loads an embedded dataset with ingredients grouped per recipe.
+
+    Returns:
+        The recipes in the format saved by `save_embedded`, where the
+            ingredient embeddings are read-only views of the memory-mapped
+            embeddings.
+    """
+    return next(iter_embedded(embedded_dir))
@@ -0,0 +1,71 @@
+"""Delta.
+
+Datasets of the recipes which were added or changed by an incremental scrape.
+
+An incremental scrape writes the new and changed recipes of every website to
+`data_dir/delta`, next to the full datasets in `data_dir`. The later stages
+then only have to process these deltas:
+
+    1. `embed_recipe_ingredients` embeds the delta recipe files, writing their
+       embedded datasets into the delta directory.
+    2. `apply_embedded_deltas` merges these into the full embedded datasets.
+    3. `add_recipes_to_graph` adds or updates only the delta recipes.
+"""
+import shutil
+from pathlib import Path
+from typing import List
+
+import pandas as pd
+
+from preprocessing.dataset_store import RECIPE_COLUMNS, embedded_path, \
+    load_embedded, save_embedded, save_recipes
+
+
+def delta_dir(data_dir: Path) -> Path:
+    """Directory of the delta datasets within the data directory."""
+    return data_dir / "delta"
+
+
+def write_delta(data_dir: Path, file_name: str, records: List[dict]):
+    """Writes the new and changed recipes of one website.
+
+    Args:
+        data_dir: Path to the data directory.
+        file_name: Name of the full dataset, e.g. "recipe_bbc.parquet".
+        records: The recipes added or changed since the last scrape.
+    """
+    out_dir = delta_dir(data_dir)
+    out_dir.mkdir(exist_ok=True)
+    # Any previously embedded delta is out of date now
+    shutil.rmtree(embedded_path(out_dir / file_name), ignore_errors=True)
+    save_recipes(pd.DataFrame(records, columns=RECIPE_COLUMNS),
+                 out_dir / file_name)
+    print(f"Wrote {len(records)} new or changed recipes to the delta.")
+
+
+def merge_delta(full: pd.DataFrame, delta: pd.DataFrame) -> pd.DataFrame:
+    """Merges delta recipes into a full dataset.
+
+    Changed recipes replace their previous version in place and new recipes
+    are appended. Recipes are identified by their url.
+    """
+    delta_urls = delta["recipe_url"].str.strip()
+    updates = dict(zip(delta_urls, delta.to_dict("records")))
+    records = []
+    for record in full.to_dict("records"):
+        records.append(updates.pop(record["recipe_url"].strip(), record))
+    records.extend(updates.values())
+    return pd.DataFrame(records, columns=full.columns)
+
+
+def apply_embedded_deltas(data_dir: Path):
+    """Merges every embedded delta dataset into its full embedded dataset."""
+    for delta_path in sorted(delta_dir(data_dir).glob("*_embedded")):
+        full_path = data_dir / delta_path.name
+        delta = load_embedded(delta_path)
+        if full_path.exists():
+            merged = merge_delta(load_embedded(full_path), delta)
+        else:
+            merged = delta
+        save_embedded(merged, full_path)
+        print(f"Merged {len(delta)} recipes into {full_path.name}.")
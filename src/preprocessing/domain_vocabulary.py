@@ -0,0 +1,184 @@
+"""Domain Vocabulary.
+
+Builds a compact subset of the GloVe model containing only the words we ever
+look up: the words of recipe ingredients in the scraped datasets and the words
+of canonical ingredient names in the nutrition dataset.
+
+The subset is only a few MB and is loaded by the embedding stages instead of
+the full 400k word model. Words which were not seen when the subset was built,
+e.g. from newly scraped recipes, fall back to the full model.
+"""
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+from typing import Set, Optional
+
+import numpy as np
+import pandas as pd
+from gensim.models import KeyedVectors
+
+from preprocessing.dataset_store import CHUNK_SIZE, iter_recipes
+from preprocessing.glove_store import load_glove_model
+from preprocessing.recipe_ingredient_embedding import find_recipe_files, \
+    ingredient_split
+from preprocessing.word_embedding import PUNCTUATION_TABLE, WORD_SPLIT
+
+
+def domain_vectors_path(data_dir: Path) -> Path:
+    """Path of the domain vocabulary vectors within the data directory."""
+    return data_dir / "glove" / "domain_vectors.kv"
+
+
+def missing_tokens_path(data_dir: Path) -> Path:
+    """Path of the list of domain words which are not in the GloVe model."""
+    return data_dir / "glove" / "domain_vectors_missing.txt"
+
+
+class DomainVectors:
+    """Domain vocabulary vectors which fall back to the full GloVe model.
+
+    Provides the `get_vector` lookup used by `calculate_averaged_embedding`.
+    """
+    def __init__(self, vectors: KeyedVectors, missing: Set[str],
+                 data_dir: Path):
+        """Creates the domain vectors.
+
+        Args:
+            vectors: The vectors of the domain vocabulary.
+            missing: Domain words known to not be in the full model, which
+                therefore don't need a fall back.
+            data_dir: Path to the data directory, used to load the full model
+                when falling back.
+        """
+        self.vectors = vectors
+        self.missing = missing
+        self.data_dir = data_dir
+        self.fallbacks = 0
+
+    @property
+    def vector_size(self) -> int:
+        return self.vectors.vector_size
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.vectors.vectors.dtype
+
+    def get_vector(self, word: str) -> np.ndarray:
+        """Gets the vector of a word, as float32.
+
+        Raises:
+            KeyError: If the word is not in the GloVe model.
+        """
+        if word in self.vectors.key_to_index:
+            return self.vectors.get_vector(word).astype(np.float32)
+        if word in self.missing:
+            raise KeyError(f"Key '{word}' not present")
+        self.fallbacks += 1
+        return load_glove_model(self.data_dir).get_vector(word)
+
+
+def collect_domain_tokens(data_dir: Path) -> Counter:
+    """Counts every word which is looked up in the GloVe model.
+
+    Args:
+        data_dir: Path to the data directory.
+
+    Returns:
+        The lowercase words of all recipe ingredients and canonical ingredient
+            names, with how often they occur.
+    """
+    tokens = Counter()
+    for recipe_file in find_recipe_files(data_dir):
+        for df in iter_recipes(recipe_file, CHUNK_SIZE, ["ingredients"]):
+            for ingredient_list in df["ingredients"]:
+                for ing in ingredient_list:
+                    _, ingredient_name = ingredient_split(ing)
+                    tokens.update(
+                        word.strip().lower() for word in WORD_SPLIT.findall(
+                            ingredient_name.translate(PUNCTUATION_TABLE)
+                        )
+                    )
+
+    names = pd.read_csv(data_dir / "nutrition.csv", usecols=["name"])
+    for name in names["name"].tolist():
+        tokens.update(word.strip().lower()
+                      for word in WORD_SPLIT.findall(name))
+    return tokens
+
+
+def build_domain_vectors(data_dir: Path, use_float16: bool = False,
+                         model: Optional[KeyedVectors] = None
+                         ) -> DomainVectors:
+    """Extracts and saves the vectors of the domain vocabulary.
+
+    Args:
+        data_dir: Path to the data directory.
+        use_float16: Whether the vectors are stored as float16, halving their
+            size at the cost of precision.
+        model: The full GloVe model. Loaded from the data directory if not
+            given.
+    """
+    if model is None:
+        model = load_glove_model(data_dir)
+    tokens = collect_domain_tokens(data_dir)
+
+    known = sorted(t for t in tokens if t in model.key_to_index)
+    missing = sorted(t for t in tokens if t not in model.key_to_index)
+
+    dtype = np.float16 if use_float16 else np.float32
+    vectors = KeyedVectors(model.vector_size, dtype=dtype)
+    if known:
+        vectors.add_vectors(known, np.stack([model.get_vector(t)
+                                             for t in known]).astype(dtype))
+
+    out_path = domain_vectors_path(data_dir)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    vectors.save(str(out_path), separately=["vectors"])
+    missing_tokens_path(data_dir).write_text("\n".join(missing))
+
+    # Report coverage and memory use
+    occurrences = sum(tokens.values())
+    covered = sum(tokens[t] for t in known)
+    full_mb = model.vectors.nbytes / 2 ** 20
+    domain_mb = vectors.vectors.nbytes / 2 ** 20
+    print(f"Domain vocabulary: {len(known)}/{len(tokens)} words in GloVe "
+          f"({len(known) / max(len(tokens), 1):.1%}), covering "
+          f"{covered / max(occurrences, 1):.1%} of word occurrences.")
+    print(f"Vectors: {domain_mb:.1f} MB instead of {full_mb:.1f} MB "
+          f"({full_mb - domain_mb:.1f} MB saved).")
+
+    return DomainVectors(vectors, set(missing), data_dir)
+
+
+def load_domain_vectors(data_dir: Path,
+                        use_float16: bool = False) -> DomainVectors:
+    """Loads the domain vocabulary vectors, building them first if needed.
+
+    Args:
+        data_dir: Path to the data directory.
+        use_float16: Whether the vectors are stored as float16 when they have
+            to be built.
+    """
+    vectors_path = domain_vectors_path(data_dir)
+    if not vectors_path.exists():
+        print("Building domain vocabulary vectors...")
+        return build_domain_vectors(data_dir, use_float16)
+    vectors = KeyedVectors.load(str(vectors_path), mmap="r")
+    missing = set(missing_tokens_path(data_dir).read_text().split("\n"))
+    return DomainVectors(vectors, missing, data_dir)
+
+
+def parse_args():
+    """Parses the command line arguments."""
+    p = ArgumentParser(description="Builds the domain vocabulary subset of "
+                                   "the GloVe model.")
+    p.add_argument("DATA_DIR", type=Path,
+                   help="Path to the data directory.")
+    p.add_argument("--float16", action="store_true",
+                   help="Store the vectors as float16.")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    build_domain_vectors(args.DATA_DIR, args.float16)
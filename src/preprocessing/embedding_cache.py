@@ -0,0 +1,141 @@
+"""Embedding Cache.
+
+Persistent cache of ingredient string embeddings and their canonical matches.
+
+Many ingredient strings, e.g. "olive oil" or "salt", appear thousands of times
+across the recipe datasets. The cache is keyed by the normalized ingredient
+string (see `normalize_ingredient_string`) and stores both its embedding and
+its matched canonical name. Lookups go through an in-memory LRU dictionary
+backed by an SQLite database on disk, so the cache also persists across runs.
+
+The cache is tied to a fingerprint of everything the cached values depend on,
+most importantly the hash of the canonical embeddings file. When the
+fingerprint changes, all entries are discarded.
+"""
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+CacheEntry = Tuple[Optional[np.ndarray], Optional[str]]
+
+# Maximum number of parameters per SQLite query
+SQLITE_BATCH_SIZE = 500
+
+
+def file_hash(path: Path) -> str:
+    """Calculates the SHA-256 hash of a file."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class IngredientEmbeddingCache:
+    """LRU cache of ingredient embeddings, backed by SQLite."""
+    def __init__(self, path: Path, fingerprint: str,
+                 max_memory_entries: int = 100_000):
+        """Opens the cache, clearing it if the fingerprint has changed.
+
+        Args:
+            path: Path of the SQLite database.
+            fingerprint: Identifies the canonical embeddings and models the
+                cached values were calculated with.
+            max_memory_entries: Maximum number of entries kept in memory.
+        """
+        self.max_memory_entries = max_memory_entries
+        self.memory: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(str(path))
+        self.connection.executescript(
+            """CREATE TABLE IF NOT EXISTS meta (
+                   key   TEXT PRIMARY KEY,
+                   value TEXT);
+               CREATE TABLE IF NOT EXISTS entries (
+                   key            TEXT PRIMARY KEY,
+                   embedding      BLOB,
+                   canonical_name TEXT);"""
+        )
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'fingerprint'"
+        ).fetchone()
+        if row is None or row[0] != fingerprint:
+            if row is not None:
+                print("Canonical embeddings changed, clearing embedding "
+                      "cache.")
+            with self.connection:
+                self.connection.execute("DELETE FROM entries")
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)",
+                    (fingerprint,)
+                )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _remember(self, key: str, entry: CacheEntry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, CacheEntry]:
+        """Looks up many normalized ingredient strings.
+
+        Returns:
+            The (embedding, canonical_name) entries of all keys which are in
+                the cache. Keys which are not cached are left out.
+        """
+        found = {}
+        to_query = []
+        for key in keys:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+            else:
+                to_query.append(key)
+
+        for start in range(0, len(to_query), SQLITE_BATCH_SIZE):
+            batch = to_query[start:start + SQLITE_BATCH_SIZE]
+            rows = self.connection.execute(
+                f"SELECT key, embedding, canonical_name FROM entries "
+                f"WHERE key IN ({','.join('?' * len(batch))})",
+                batch
+            )
+            for key, embedding, canonical_name in rows:
+                if embedding is not None:
+                    embedding = np.frombuffer(embedding,
+                                              dtype=np.float32).copy()
+                found[key] = (embedding, canonical_name)
+                self._remember(key, found[key])
+
+        self.hits += len(found)
+        self.misses += sum(1 for key in to_query if key not in found)
+        return found
+
+    def put_many(self, entries: Dict[str, CacheEntry]):
+        """Stores the (embedding, canonical_name) entries of many keys."""
+        rows = []
+        for key, (embedding, canonical_name) in entries.items():
+            if embedding is not None:
+                embedding = np.asarray(embedding, dtype=np.float32)
+            self._remember(key, (embedding, canonical_name))
+            rows.append((key,
+                         None if embedding is None else embedding.tobytes(),
+                         canonical_name))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", rows
+            )
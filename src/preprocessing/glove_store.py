@@ -0,0 +1,66 @@
+"""GloVe Store.
+
+Keeps the pretrained GloVe model on disk in gensim's native format, so that it
+can be memory-mapped instead of being downloaded and parsed on every run.
+
+The first time the model is needed, it is loaded through gensim's downloader
+and saved into the data directory as a `.npy` vector matrix plus the
+vocabulary index. Afterwards it is opened with `mmap_mode='r'`, which only
+takes seconds, and only the pages of vectors actually looked up are read into
+memory. Loaded models are kept for the lifetime of the process, so every stage
+of a pipeline run shares the same model.
+"""
+from pathlib import Path
+from time import perf_counter
+from typing import Dict
+
+import gensim.downloader as api
+from gensim.models import KeyedVectors
+
+GLOVE_MODEL_NAME = "glove-wiki-gigaword-300"
+
+_loaded_models: Dict[Path, KeyedVectors] = {}
+
+
+def glove_store_path(data_dir: Path) -> Path:
+    """Path of the converted GloVe model within the data directory."""
+    return data_dir / "glove" / f"{GLOVE_MODEL_NAME}.kv"
+
+
+def convert_glove_model(store_path: Path):
+    """Downloads the pretrained GloVe model and saves it in native format.
+
+    Args:
+        store_path: Path where the model should be saved. The vector matrix
+            is saved next to it as a separate `.npy` file.
+    """
+    print("Loading pretrained GloVe model (this may take a while)...")
+    model = api.load(GLOVE_MODEL_NAME)
+    store_path.parent.mkdir(parents=True, exist_ok=True)
+    model.save(str(store_path), separately=["vectors"])
+    print(f"GloVe model converted and saved to {store_path}")
+
+
+def load_glove_model(data_dir: Path) -> KeyedVectors:
+    """Loads the memory-mapped GloVe model, converting it first if needed.
+
+    Args:
+        data_dir: Path to the data directory.
+
+    Returns:
+        The GloVe model as a read-only, memory-mapped KeyedVectors object.
+    """
+    store_path = glove_store_path(data_dir)
+    key = store_path.resolve()
+    if key in _loaded_models:
+        return _loaded_models[key]
+
+    if not store_path.exists():
+        convert_glove_model(store_path)
+
+    start = perf_counter()
+    model = KeyedVectors.load(str(store_path), mmap="r")
+    t = perf_counter() - start
+    print(f"GloVe model loaded. {t=:.3f}")
+    _loaded_models[key] = model
+    return model
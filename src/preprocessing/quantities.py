@@ -0,0 +1,146 @@
+"""Quantities.
+
+Converts the amounts of recipe ingredients and nutritional values into numbers.
+
+Ingredient amounts are parsed once during preprocessing into a weight in
+grams, so that nutritional values can be calculated with simple arithmetic
+when recommending recipes. Volumes are converted assuming the density of
+water.
+"""
+import re
+from typing import Optional
+
+# Grams per unit. Units which do not describe a mass or volume, e.g. "cm" or
+# "large", are not listed and result in no weight.
+UNIT_GRAMS = {
+    "g": 1., "gram": 1., "grams": 1., "gramme": 1., "grammes": 1.,
+    "kg": 1000., "kilogram": 1000., "kilograms": 1000.,
+    "kilogramme": 1000., "kilogrammes": 1000.,
+    "mg": 0.001,
+    "ml": 1., "milliliter": 1., "milliliters": 1., "millilitre": 1.,
+    "millilitres": 1.,
+    "l": 1000., "liter": 1000., "liters": 1000., "litre": 1000.,
+    "litres": 1000.,
+    "tsp": 5., "teaspoon": 5., "teaspoons": 5.,
+    "tbsp": 15., "tablespoon": 15., "tablespoons": 15., "spoon": 15.,
+    "cup": 240., "cups": 240.,
+    "pint": 568., "pints": 568.,
+    "pinch": 0.5,
+    "sprinkle": 1.,
+    "drizzle": 5.,
+    "handful": 30.,
+}
+
+WORD_NUMBERS = {
+    "one": 1., "two": 2., "three": 3., "four": 4., "five": 5.,
+    "six": 6., "seven": 7., "eight": 8., "nine": 9., "ten": 10.,
+    "few": 3.,
+}
+
+VULGAR_FRACTIONS = {
+    "¼": 1 / 4, "½": 1 / 2, "¾": 3 / 4,
+    "⅐": 1 / 7, "⅑": 1 / 9, "⅒": 1 / 10,
+    "⅓": 1 / 3, "⅔": 2 / 3,
+    "⅕": 1 / 5, "⅖": 2 / 5, "⅗": 3 / 5, "⅘": 4 / 5,
+    "⅙": 1 / 6, "⅚": 5 / 6,
+    "⅛": 1 / 8, "⅜": 3 / 8, "⅝": 5 / 8, "⅞": 7 / 8,
+}
+
+NUMBER_TOKEN = re.compile(
+    r"(\d+(?:\.\d+)?)\s*/\s*(\d+)"              # 1/2
+    r"|(\d+(?:\.\d+)?)"                         # 2 or 1.5
+    rf"|([{''.join(VULGAR_FRACTIONS)}])"        # ½
+    rf"|\b({'|'.join(WORD_NUMBERS)})\b",        # two
+    re.IGNORECASE
+)
+RANGE_SPLIT = re.compile(r"\s*(?:-+|–|\bto\b)\s*", re.IGNORECASE)
+WORD_TOKEN = re.compile(r"[a-z]+", re.IGNORECASE)
+NUTRIENT_AMOUNT = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([a-zμ]*)\s*$",
+                             re.IGNORECASE)
+NUTRIENT_UNIT_GRAMS = {"": 1., "g": 1., "mg": 0.001, "mcg": 1e-6,
+                       "µg": 1e-6, "μg": 1e-6}
+
+
+def parse_number(text: str) -> Optional[float]:
+    """Parses a single, possibly mixed, number.
+
+    Handles integers, decimals, fractions like "1/2", unicode vulgar fractions
+    like "½" and the number words one to ten. Adjacent numbers are summed, so
+    that mixed numbers like "1 ½" become 1.5.
+
+    Returns:
+        The number, or None if the text contains no number.
+    """
+    total = None
+    for numerator, denominator, number, vulgar, word in \
+            NUMBER_TOKEN.findall(text):
+        if numerator:
+            value = float(numerator) / float(denominator) \
+                if float(denominator) else 0.
+        elif number:
+            value = float(number)
+        elif vulgar:
+            value = VULGAR_FRACTIONS[vulgar]
+        else:
+            value = WORD_NUMBERS[word.lower()]
+        total = value if total is None else total + value
+    return total
+
+
+def parse_quantity(quantity: str) -> Optional[float]:
+    """Parses a quantity, using the middle of ranges like "200-500".
+
+    Returns:
+        The quantity, or None if the text contains no number.
+    """
+    values = [parse_number(part) for part in RANGE_SPLIT.split(quantity)]
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return sum(values) / len(values)
+
+
+def amount_to_grams(quantity: str, unit: str) -> Optional[float]:
+    """Converts the amount of an ingredient to grams.
+
+    Args:
+        quantity: The quantity, as returned by `parse_ingredient`.
+        unit: The unit, as returned by `parse_ingredient`.
+
+    Returns:
+        The weight in grams, or None if the amount does not describe a weight
+            or volume, e.g. "2" in "2 onions".
+    """
+    # Word quantities such as "pinch" may end up in the quantity, so both are
+    # searched for the first unit with a known weight.
+    grams_per_unit = None
+    for word in WORD_TOKEN.findall(f"{quantity} {unit}"):
+        grams_per_unit = UNIT_GRAMS.get(word.lower())
+        if grams_per_unit is not None:
+            break
+    if grams_per_unit is None:
+        return None
+
+    number = parse_quantity(quantity)
+    if number is None:
+        number = 1.
+    return number * grams_per_unit
+
+
+def parse_nutrient_amount(amount) -> Optional[float]:
+    """Parses a nutritional value such as "0.28 g" or "12 mg" into grams.
+
+    Amounts without a unit, e.g. calories, are returned as they are.
+
+    Returns:
+        The amount, or None if it could not be parsed.
+    """
+    if isinstance(amount, (int, float)):
+        return None if amount != amount else float(amount)  # NaN check
+    match = NUTRIENT_AMOUNT.match(str(amount))
+    if match is None:
+        return None
+    factor = NUTRIENT_UNIT_GRAMS.get(match.group(2).lower())
+    if factor is None:
+        return None
+    return float(match.group(1)) * factor
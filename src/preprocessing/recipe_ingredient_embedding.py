@@ -2,15 +2,82 @@
 
 Figures out the embeddings for every ingredient that appears in the recipes.
 """
-from typing import Tuple, List
+from typing import Tuple, List, Optional, Iterable, Callable
 import re
+import tempfile
+from contextlib import ExitStack
+from multiprocessing import Pool
 from pathlib import Path
 from argparse import ArgumentParser
-import pandas as pd
+import numpy as np
 from gensim.models import KeyedVectors
-import gensim.downloader as api
+from preprocessing.ann_index import ExactIndex, IVFIndex, \
+    canonical_index_path, normalize_rows
+from preprocessing.dataset_store import EmbeddedWriter, embedded_path, \
+    iter_recipes
+from preprocessing.embedding_cache import CacheEntry, \
+    IngredientEmbeddingCache, file_hash
+from preprocessing.glove_store import load_glove_model
+from preprocessing.quantities import amount_to_grams
 from preprocessing.word_embedding import embed_ingredient_string, \
-    match_canonical_name
+    match_canonical_names, normalize_ingredient_string
+
+# All possible units used in recipes
+UNITS = [
+    "g ", "grams", "grammes",
+    "kg", "kilograms", "kilogrammes",
+    "ml", "milliliters", "millilitres",
+    "l ", "liters", "litres",
+    "tsp", "teaspoon",
+    "tbsp", "tablespoon",
+    "spoon",
+    "cm", "centimeter", "centimetre",
+    "m ", "meter", "metre",
+    "mm", "millimeter", "millimetre",
+    "pinch",
+    "of",
+    "sprinkle",
+    "to taste",
+    "small", "medium", "large",
+    "drizzle",
+    "pint",
+    "cup",
+]
+
+WORD_QTYS = ["one", "two", "three", "four", "five", "six", "seven",
+             "eight", "nine", "ten",
+             "a few", "around"
+             "small", "medium", "large",
+             "of", "sprinkle",  "drizzle", "to taste", "pinch", "handful",
+             "pack", "pot", "tub", "clove", "can"]
+
+# Fractions also have to be taken into account
+FRACTION_CODES = r"[\u00BC-\u00BE]|[\u2150-\u215E]|\d/\d"
+
+# Structure used for ingredients
+# This is a multiline comment just so I can visualize what kind of regex I
+# need to build
+"""
+500g of something
+500 g of something
+500g something
+500 g something
+200-500g of something
+200g-500g something
+3 of something
+3 somethings
+"""
+# Sorry
+AMOUNT_REGEX = re.compile(
+    rf"^(?P<quantity>(?:(?:\d+|{'|'.join(WORD_QTYS)}|{FRACTION_CODES})"
+    rf"\s*-*\s*)*)"
+    rf"(?P<unit>(?:{'|'.join(UNITS)})*)",
+    re.IGNORECASE
+)
+PARENTHESES_REGEX = re.compile(r"\(.*\)|\[.*]")
+
+# Models of an embedding worker process, see `_init_worker`
+_worker_state = {}
 
 
 def parse_args():
@@ -26,9 +93,75 @@ def parse_args():
         type=Path,
         help="Path to the data directory."
     )
+    parser.add_argument(
+        "--ann",
+        action="store_true",
+        help="Match canonical names using the approximate IVF index instead "
+             "of exact search."
+    )
+    parser.add_argument(
+        "--n-probe",
+        type=int,
+        default=None,
+        help="Number of IVF clusters to search per ingredient. Higher values "
+             "are slower but more accurate."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use the ingredient embedding cache."
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="Number of recipes to embed at a time. By default whole recipe "
+             "files are embedded at once."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to embed the ingredients with."
+    )
     return parser.parse_args()
 
 
+def parse_ingredient(ingredient: str) -> Tuple[str, str, str]:
+    """Parses the given ingredient into its quantity, unit and name.
+
+    Args:
+        ingredient: The ingredient string with amount
+
+    Returns:
+        A tuple of (quantity, unit, name), e.g. ("200-500", "g", "flour") for
+            "200-500g flour". The quantity and unit are empty strings if not
+            present.
+    """
+    amount_match = AMOUNT_REGEX.match(ingredient)
+    name = ingredient[amount_match.end():]
+
+    # Check for parentheses and remove everything within them
+    name = PARENTHESES_REGEX.sub("", name).strip()
+
+    return (amount_match.group("quantity").strip(),
+            amount_match.group("unit").strip(),
+            name)
+
+
+def parse_ingredients(ingredients: Iterable[str]
+                      ) -> List[Tuple[str, str, str]]:
+    """Parses many ingredients at once using `parse_ingredient`.
+
+    Args:
+        ingredients: A list or pandas Series of ingredient strings.
+
+    Returns:
+        A list of (quantity, unit, name) tuples, in the same order.
+    """
+    return [parse_ingredient(ingredient) for ingredient in ingredients]
+
+
 def ingredient_split(ingredient: str) -> Tuple[str, str]:
     """Splits the given ingredient into the amount and ingredient.
 
@@ -42,67 +175,12 @@ def ingredient_split(ingredient: str) -> Tuple[str, str]:
         A tuple where the first string is the amount and the second string is
             the ingreident.
     """
-    # All possible units used in recipes
-    units = [
-        "g ", "grams", "grammes",
-        "kg", "kilograms", "kilogrammes",
-        "ml", "milliliters", "millilitres",
-        "l ", "liters", "litres",
-        "tsp", "teaspoon",
-        "tbsp", "tablespoon",
-        "spoon",
-        "cm", "centimeter", "centimetre",
-        "m ", "meter", "metre",
-        "mm", "millimeter", "millimetre",
-        "pinch",
-        "of",
-        "sprinkle",
-        "to taste",
-        "small", "medium", "large",
-        "drizzle",
-        "pint",
-        "cup",
-    ]
-    # Turn it into a regex compatible string
-    units = "|".join(units)
-
-    word_qtys = ["one", "two", "three", "four", "five", "six", "seven",
-                 "eight", "nine", "ten",
-                 "a few", "around"
-                 "small", "medium", "large",
-                 "of", "sprinkle",  "drizzle", "to taste", "pinch", "handful",
-                 "pack", "pot", "tub", "clove", "can"]
-
-    # Turn it into a regex compatible string
-    word_qtys = "|".join(word_qtys)
-
-    # Fractions also have to be taken into account
-    fraction_codes = r"[\u00BC-\u00BE]|[\u2150-\u215E]|\d/\d"
-
-    # Structure used for ingredients
-    # This is a multiline comment just so I can visualize what kind of regex I
-    # need to build
-    """
-    500g of something
-    500 g of something
-    500g something
-    500 g something
-    200-500g of something
-    200g-500g something
-    3 of something
-    3 somethings
-    """
-    # Sorry
-    regex_str = rf"^((\d+|{word_qtys}|{fraction_codes})\s*-*\s*)*({units})*"
-    regex_amt_matcher = re.compile(regex_str, re.IGNORECASE)
-
-    end_of_amount_str = regex_amt_matcher.match(ingredient).end()
-    amount = ingredient[0:end_of_amount_str].strip()
-    ingredient = ingredient[end_of_amount_str:]
+    amount_match = AMOUNT_REGEX.match(ingredient)
+    amount = ingredient[0:amount_match.end()].strip()
+    ingredient = ingredient[amount_match.end():]
 
     # Check for parentheses and remove everything within them
-    parentheses_regex = re.compile(r"\(.*\)|\[.*]")
-    ingredient = parentheses_regex.sub("", ingredient)
+    ingredient = PARENTHESES_REGEX.sub("", ingredient)
     ingredient = ingredient.strip()
 
     return amount, ingredient
@@ -110,7 +188,8 @@ def ingredient_split(ingredient: str) -> Tuple[str, str]:
 
 def embed_ingredient_list(ingredient_list: List[str],
                           model: KeyedVectors,
-                          canonical_embeddings: KeyedVectors) -> List[dict]:
+                          canonical_embeddings: KeyedVectors,
+                          index: Optional[IVFIndex] = None) -> List[dict]:
     """Takes a list of ingredients and makes the appropriate dictionaries.
 
     Args:
@@ -118,54 +197,266 @@ def embed_ingredient_list(ingredient_list: List[str],
         model: The model to use for the embedding.
         canonical_embeddings: The embeddings of the canonical ingredients as a
             KeyedVectors object.
+        index: Optional approximate index over the canonical embeddings.
 
     Returns:
-        A list of dictionaries with keys [original_name, amount,
+        A list of dictionaries with keys [original_name, amount, grams,
             ingredient_name, canonical_name, embedding]
     """
-    split_ingredients = []
-    for ing in ingredient_list:
-        amount, ingredient_name = ingredient_split(ing)
-        embedding = embed_ingredient_string(ingredient_name, model)
-        closest_canonical = match_canonical_name(embedding,
-                                                 canonical_embeddings)
-        split_ingredients.append({
-            "original_name": ing,
-            "amount": amount,
-            "ingredient_name": ingredient_name,
-            "canonical_name": closest_canonical,
-            "embedding": embedding})
-
-    return split_ingredients
-
-
-def embed_recipe_ingredients(data_dir: Path):
-    # First find the recipe files
+    return embed_ingredient_lists([ingredient_list], model,
+                                  canonical_embeddings, index)[0]
+
+
+def embed_ingredient_keys(keys: List[str], model: KeyedVectors,
+                          canonical_embeddings: KeyedVectors,
+                          index=None) -> List[CacheEntry]:
+    """Embeds normalized ingredient strings and matches their canonical names.
+
+    Args:
+        keys: The normalized ingredient strings.
+        model: The model to use for the embedding.
+        canonical_embeddings: The embeddings of the canonical ingredients as a
+            KeyedVectors object.
+        index: Optional index over the canonical embeddings.
+
+    Returns:
+        An (embedding, canonical_name) tuple for every key.
+    """
+    embeddings = [embed_ingredient_string(key, model) for key in keys]
+    canonical_names = match_canonical_names(embeddings, canonical_embeddings,
+                                            index)
+    return list(zip(embeddings, canonical_names))
+
+
+def _init_worker(data_dir: Path, model_loader: Callable,
+                 canonical_path: Path, canonical_keys: List[str],
+                 index_path: Optional[Path], n_probe: Optional[int]):
+    """Loads the models used by an embedding worker process.
+
+    The GloVe vectors and the normalized canonical embeddings are both
+    memory-mapped, so all workers share the same pages instead of receiving
+    pickled copies.
+    """
+    canonical_matrix = np.load(canonical_path, mmap_mode="r")
+    canonical = KeyedVectors(canonical_matrix.shape[1])
+    canonical.index_to_key = canonical_keys
+    canonical.key_to_index = {key: i for i, key in enumerate(canonical_keys)}
+    canonical.vectors = canonical_matrix
+
+    if index_path is not None:
+        index = IVFIndex.load(index_path, n_probe)
+    else:
+        index = ExactIndex.from_normalized(canonical_matrix)
+
+    _worker_state.update(model=model_loader(data_dir), canonical=canonical,
+                         index=index)
+
+
+def _embed_ingredient_keys_worker(keys: List[str]) -> List[CacheEntry]:
+    """Runs `embed_ingredient_keys` using the models of the worker process."""
+    return embed_ingredient_keys(keys, _worker_state["model"],
+                                 _worker_state["canonical"],
+                                 _worker_state["index"])
+
+
+def embed_ingredient_lists(ingredient_lists: List[List[str]],
+                           model: KeyedVectors,
+                           canonical_embeddings: KeyedVectors,
+                           index: Optional[IVFIndex] = None,
+                           cache: Optional[IngredientEmbeddingCache] = None,
+                           pool: Optional[Pool] = None,
+                           workers: int = 1) -> List[List[dict]]:
+    """Embeds many ingredient lists, matching canonical names in one batch.
+
+    Every ingredient of every list is split first. Each distinct ingredient
+    string is then embedded only once, and the canonical names are matched for
+    all embeddings at once using `match_canonical_names`, instead of scanning
+    the canonical ingredients once per ingredient.
+
+    Args:
+        ingredient_lists: The ingredient lists to process, e.g. the
+            ingredients column of a recipe dataframe.
+        model: The model to use for the embedding.
+        canonical_embeddings: The embeddings of the canonical ingredients as a
+            KeyedVectors object.
+        index: Optional approximate index over the canonical embeddings.
+        cache: Optional cache of previously calculated embeddings and
+            canonical names. New results are added to it.
+        pool: Optional process pool, created by `embed_recipe_ingredients`,
+            across which the ingredient strings are embedded.
+        workers: Number of processes of the pool, which the ingredient
+            strings are split into chunks for.
+
+    Returns:
+        For every ingredient list, a list of dictionaries as returned by
+            `embed_ingredient_list`.
+    """
+    split_lists = []
+    ingredient_keys = []
+    for ingredient_list in ingredient_lists:
+        split_ingredients = []
+        for ing in ingredient_list:
+            amount, ingredient_name = ingredient_split(ing)
+            quantity, unit, _ = parse_ingredient(ing)
+            ingredient_keys.append(
+                normalize_ingredient_string(ingredient_name)
+            )
+            split_ingredients.append({
+                "original_name": ing,
+                "amount": amount,
+                "grams": amount_to_grams(quantity, unit),
+                "ingredient_name": ingredient_name,
+                "canonical_name": None,
+                "embedding": None})
+        split_lists.append(split_ingredients)
+
+    # Only embed and match the distinct ingredient strings which are not cached
+    keys = list(dict.fromkeys(ingredient_keys))
+    entries = cache.get_many(keys) if cache is not None else {}
+    missing = [key for key in keys if key not in entries]
+    if pool is None:
+        new_entries = embed_ingredient_keys(missing, model,
+                                            canonical_embeddings, index)
+    else:
+        # Contiguous chunks keep the merged results in a deterministic order
+        n_chunks = min(len(missing), workers * 4) or 1
+        chunk_size = -(-len(missing) // n_chunks)
+        chunks = [missing[i:i + chunk_size]
+                  for i in range(0, len(missing), chunk_size)]
+        new_entries = []
+        for chunk in pool.map(_embed_ingredient_keys_worker, chunks):
+            for embedding, canonical_name in chunk:
+                if embedding is not None:
+                    # Unpickled arrays carry their own dtype instance, which
+                    # would make the pickled output differ from the serial one
+                    embedding = embedding.astype(embedding.dtype.type)
+                new_entries.append((embedding, canonical_name))
+    new_entries = dict(zip(missing, new_entries))
+    if cache is not None:
+        cache.put_many(new_entries)
+    entries.update(new_entries)
+
+    ingredient_keys = iter(ingredient_keys)
+    for split_ingredients in split_lists:
+        for ingredient in split_ingredients:
+            embedding, canonical_name = entries[next(ingredient_keys)]
+            if canonical_name is not None:
+                # Refer to the canonical key itself, so that the output does
+                # not depend on whether it came from the cache or a worker
+                canonical_name = canonical_embeddings.index_to_key[
+                    canonical_embeddings.key_to_index[canonical_name]
+                ]
+            ingredient["canonical_name"] = canonical_name
+            ingredient["embedding"] = embedding
+
+    return split_lists
+
+
+def find_recipe_files(data_dir: Path) -> List[Path]:
+    """Finds the scraped recipe files in the data directory."""
     recipe_files = []
-    for file in data_dir.glob("*.pkl"):
-        if not str(file).endswith("_canonical.pkl"):
-            recipe_files.append(file)
+    for file in sorted(data_dir.glob("*.parquet")):
+        recipe_files.append(file)
+    return recipe_files
+
+
+def cache_fingerprint(canonical_embed_path: Path, index: Optional[IVFIndex],
+                      model: KeyedVectors) -> str:
+    """Identifies everything the cached embeddings and matches depend on."""
+    if index is None:
+        matcher = "exact"
+    else:
+        matcher = (f"ivf:{index.n_probe}:"
+                   f"{file_hash(canonical_index_path(canonical_embed_path))}")
+    dtype = getattr(model, "dtype", None) or model.vectors.dtype
+    return f"{file_hash(canonical_embed_path)}|{matcher}|{dtype}"
+
+
+def embed_recipe_ingredients(data_dir: Path, use_ann: bool = False,
+                             n_probe: Optional[int] = None,
+                             model_loader: Callable = load_glove_model,
+                             use_cache: bool = True, workers: int = 1,
+                             recipe_files: Optional[List[Path]] = None,
+                             chunk_size: Optional[int] = None):
+    """Embeds the ingredients of every scraped recipe file.
+
+    Args:
+        data_dir: Path to the data directory.
+        use_ann: Whether canonical names are matched using the approximate
+            IVF index saved next to the canonical embeddings.
+        n_probe: Overrides the number of IVF clusters searched.
+        model_loader: Function taking the data directory and returning the
+            model to use for the embedding, e.g. `load_domain_vectors`.
+            Defaults to loading the full GloVe model. Must be picklable when
+            using more than one worker.
+        use_cache: Whether embeddings and canonical names are cached in the
+            data directory, so that unchanged ingredients are not recomputed.
+        workers: Number of worker processes to embed with. The output is the
+            same as with a single process.
+        recipe_files: The recipe files to embed, e.g. the delta datasets of
+            an incremental scrape. Defaults to all recipe files in the data
+            directory.
+        chunk_size: Number of recipes read, embedded and written at a time,
+            so that memory use does not grow with the number of recipes.
+            Whole recipe files are embedded at once if None.
+    """
+    # First find the recipe files
+    if recipe_files is None:
+        recipe_files = find_recipe_files(data_dir)
 
     # Load pretrained GloVe model
-    print("Loading pretrained GloVe model...")
-    model = api.load("glove-wiki-gigaword-300")
-    print("Pretrained model loaded!")
+    model = model_loader(data_dir)
 
-    canonical_embeddings = KeyedVectors.load(
-        str(data_dir / "canonical_ingredient_embeddings.gz")
-    )
+    canonical_embed_path = data_dir / "canonical_ingredient_embeddings.gz"
+    canonical_embeddings = KeyedVectors.load(str(canonical_embed_path))
+    index = None
+    index_path = None
+    if use_ann:
+        index_path = canonical_index_path(canonical_embed_path)
+        index = IVFIndex.load(index_path, n_probe)
+
+    cache = None
+    if use_cache:
+        cache = IngredientEmbeddingCache(
+            data_dir / "ingredient_embedding_cache.sqlite",
+            cache_fingerprint(canonical_embed_path, index, model)
+        )
+
+    # The pool is terminated before the directory of the files its workers
+    # memory-map is removed, also when embedding fails
+    with tempfile.TemporaryDirectory() as tmp_dir, ExitStack() as stack:
+        pool = None
+        if workers > 1:
+            # Workers memory-map the normalized canonical embeddings
+            canonical_path = Path(tmp_dir) / "canonical_normed.npy"
+            np.save(canonical_path,
+                    normalize_rows(canonical_embeddings.vectors))
+            pool = stack.enter_context(Pool(
+                workers, initializer=_init_worker,
+                initargs=(data_dir, model_loader, canonical_path,
+                          canonical_embeddings.index_to_key, index_path,
+                          n_probe)
+            ))
 
-    # For each recipe file
-    for recipe_file in recipe_files:
-        # Read the file and calculate the ingredient embeddings
-        df = pd.read_pickle(recipe_file)
-        df["ingredients"] = df["ingredients"]\
-            .apply(lambda row: embed_ingredient_list(row, model,
-                                                     canonical_embeddings))
+        # For each recipe file
+        for recipe_file in recipe_files:
+            # Read the file and calculate the ingredient embeddings
+            with EmbeddedWriter(embedded_path(recipe_file)) as writer:
+                for df in iter_recipes(recipe_file, chunk_size):
+                    df["ingredients"] = embed_ingredient_lists(
+                        df["ingredients"].tolist(), model,
+                        canonical_embeddings, index, cache, pool, workers
+                    )
+                    writer.write(df)
 
-        df.to_pickle(recipe_file.with_name(recipe_file.stem + "_embedded.pkl"))
+    if cache is not None:
+        print(f"Embedding cache: {cache.hits} hits, {cache.misses} misses.")
+        cache.close()
 
 
 if __name__ == '__main__':
     args = parse_args()
-    embed_recipe_ingredients(args.data_dir)
+    embed_recipe_ingredients(args.data_dir, args.ann, args.n_probe,
+                             use_cache=not args.no_cache,
+                             workers=args.workers,
+                             chunk_size=args.chunk_size)
@@ -5,14 +5,17 @@ Contains functions used for word embeddings.
 import re
 import string
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 import numpy as np
 import pandas as pd
 from gensim.models import KeyedVectors
 
+from preprocessing.ann_index import ExactIndex, IVFIndex, MATCH_CHUNK_SIZE
+
 PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
 WORD_SPLIT = re.compile(r"\w+")
+CANONICAL_THRESHOLD = 0.8
 
 
 def embed_ingredient_string(ingredient_str: str,
@@ -29,8 +32,23 @@ def embed_ingredient_string(ingredient_str: str,
     return calculate_averaged_embedding(ing_list, model)
 
 
+def normalize_ingredient_string(ingredient_str: str) -> str:
+    """Normalizes an ingredient string to the words its embedding uses.
+
+    Two ingredient strings with the same normalized string have the same
+    embedding, which makes it suitable as a cache key.
+    """
+    return " ".join(
+        word.strip().lower()
+        for word in WORD_SPLIT.findall(
+            ingredient_str.translate(PUNCTUATION_TABLE)
+        )
+    )
+
+
 def match_canonical_name(embedding: np.ndarray,
-                         name_vecs: KeyedVectors) -> str or None:
+                         name_vecs: KeyedVectors,
+                         index: Optional[IVFIndex] = None) -> str or None:
     """Matches the closest canonical name.
 
     Matches the given ingredient to the closest name in the names dataframe
@@ -49,6 +67,8 @@ def match_canonical_name(embedding: np.ndarray,
         embedding: The embedding of the ingredient to be matched
         name_vecs: The embeddings of canonical ingredients as a KeyedVectors
             object.
+        index: Optional approximate index over `name_vecs`. If not given, the
+            canonical ingredients are searched exhaustively.
 
     References:
         "Automated Identification of Food Substitutes Using Knowledge Graph
@@ -58,15 +78,59 @@ def match_canonical_name(embedding: np.ndarray,
     Returns:
         The canonical name or None
     """
+    if embedding is not None and index is not None:
+        return match_canonical_names([embedding], name_vecs, index)[0]
     if embedding is not None:
         # Get the most similar word
         most_similar = name_vecs.similar_by_vector(embedding, topn=1)[0]
-        if most_similar[1] > 0.8:
+        if most_similar[1] > CANONICAL_THRESHOLD:
             return most_similar[0]
     # If embedding was None or the similarity < 0.8,
     return None
 
 
+def match_canonical_names(embeddings: List[Optional[np.ndarray]],
+                          name_vecs: KeyedVectors,
+                          index: Optional[IVFIndex] = None,
+                          chunk_size: int = MATCH_CHUNK_SIZE
+                          ) -> List[Optional[str]]:
+    """Matches the closest canonical name for many embeddings at once.
+
+    Batch version of `match_canonical_name`. Instead of scanning all canonical
+    ingredients once per embedding, all embeddings are L2-normalized into a
+    single matrix and compared against the normalized canonical matrix using
+    chunked matrix multiplications. The same 0.8 cosine similarity threshold
+    is used, so the result is the same as calling `match_canonical_name` on
+    every embedding.
+
+    Args:
+        embeddings: The embeddings of the ingredients to be matched. Entries
+            may be None, in which case no canonical name is matched.
+        name_vecs: The embeddings of canonical ingredients as a KeyedVectors
+            object.
+        index: Optional approximate index over `name_vecs`. If not given, the
+            canonical ingredients are searched exhaustively.
+        chunk_size: Number of embeddings to compare per matrix
+            multiplication when searching exhaustively.
+
+    Returns:
+        A list with the canonical name or None for every embedding.
+    """
+    matches = [None] * len(embeddings)
+    positions = [i for i, e in enumerate(embeddings) if e is not None]
+    if not positions or len(name_vecs) == 0:
+        return matches
+
+    if index is None:
+        index = ExactIndex(name_vecs.vectors, chunk_size)
+    similarities, idxs = index.search(np.stack([embeddings[i]
+                                                for i in positions]))
+    for position, idx, sim in zip(positions, idxs[:, 0], similarities[:, 0]):
+        if sim > CANONICAL_THRESHOLD:
+            matches[position] = name_vecs.index_to_key[idx]
+    return matches
+
+
 def calculate_averaged_embedding(ingredient: List[str],
                                  model: KeyedVectors) -> np.ndarray or None:
     """Calculates the averaged word embedding of a list of words.
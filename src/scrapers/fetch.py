@@ -0,0 +1,217 @@
+"""Fetch.
+
+Concurrent fetching of web pages for the scrapers.
+
+Pages are fetched with asyncio through one pooled, keep-alive HTTP session.
+The number of requests in flight is bounded by a semaphore, requests to the
+same host are spaced out by a rate limiter and failed requests are retried
+with exponential backoff, so that scraping is fast without overloading the
+websites.
+
+Cached pages can be revalidated with conditional GETs, in which case unchanged
+pages are answered with a bodiless 304 Not Modified.
+"""
+import asyncio
+import random
+from collections import Counter
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Any, Set
+from urllib.parse import urlparse
+
+import aiohttp
+
+from scrapers.page_cache import PageCache
+
+HEADERS = {'user-agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) '
+                         'AppleWebKit/537.36 (KHTML, like Gecko) '
+                         'Chrome/70.0.3538.25 '
+                         'Safari/537.36 '
+                         'Core/1.70.3777.400 '
+                         'QQBrowser/10.6.4212.400'}
+
+# Responses with these statuses are worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HostRateLimiter:
+    """Spaces out requests to the same host."""
+    def __init__(self, requests_per_second: float):
+        """Creates the rate limiter.
+
+        Args:
+            requests_per_second: Maximum number of requests started per
+                second for every host.
+        """
+        self.interval = 1 / requests_per_second
+        self.next_slot: Dict[str, float] = {}
+
+    async def wait(self, url: str):
+        """Waits until a request to the host of the url may be started."""
+        host = urlparse(url).netloc
+        now = monotonic()
+        slot = max(now, self.next_slot.get(host, now))
+        self.next_slot[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class AsyncFetcher:
+    """Fetches many pages concurrently."""
+    def __init__(self, concurrency: int = 8,
+                 requests_per_second: float = 5.,
+                 retries: int = 4, backoff: float = 1.,
+                 timeout: float = 30., cache: Optional[PageCache] = None,
+                 offline: bool = False, revalidate: bool = False):
+        """Creates the fetcher.
+
+        Args:
+            concurrency: Maximum number of requests in flight at once.
+            requests_per_second: Maximum number of requests started per
+                second for every host.
+            retries: Number of times a failed request is retried.
+            backoff: Seconds waited before the first retry. Doubles with
+                every further retry.
+            timeout: Total timeout of a single request in seconds.
+            cache: Optional cache of raw pages. Cached pages are not fetched
+                again and newly fetched pages are added to it.
+            offline: Whether only cached pages are returned, without any
+                network access.
+            revalidate: Whether cached pages are revalidated with a
+                conditional GET instead of being returned as they are.
+        """
+        self.concurrency = concurrency
+        self.requests_per_second = requests_per_second
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.offline = offline
+        self.revalidate = revalidate
+        # Number of pages read from the cache, fetched, not modified since
+        # they were cached and failed
+        self.stats = Counter()
+        # Urls of pages which were not cached or whose content has changed
+        self.changed: Set[str] = set()
+
+    def _conditional_headers(self, url: str) -> Dict[str, str]:
+        """Headers revalidating the cached copy of a page."""
+        metadata = self.cache.metadata(url) or {}
+        headers = {}
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+        return headers
+
+    async def _fetch(self, session: aiohttp.ClientSession,
+                     semaphore: asyncio.Semaphore,
+                     rate_limiter: HostRateLimiter,
+                     url: str) -> Optional[str]:
+        """Fetches a single page, retrying on failure.
+
+        Returns:
+            The page text, or None if it could not be fetched.
+        """
+        url = url.strip()
+        cached = self.cache is not None and url in self.cache
+        if cached and (self.offline or not self.revalidate):
+            self.stats["cached"] += 1
+            return self.cache.get(url)
+        if self.offline:
+            self.stats["failed"] += 1
+            return None
+        headers = self._conditional_headers(url) if cached else {}
+
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt * (1 + random.random() / 2)
+            async with semaphore:
+                await rate_limiter.wait(url)
+                try:
+                    async with session.get(url, headers=headers) as response:
+                        if response.status == 304 and cached:
+                            self.stats["not_modified"] += 1
+                            return self.cache.get(url)
+                        if response.status == 200:
+                            page = await response.text()
+                            self.stats["fetched"] += 1
+                            if cached and page == self.cache.get(url):
+                                # The server ignored the conditional headers
+                                return page
+                            self.changed.add(url)
+                            if self.cache is not None:
+                                self.cache.put(
+                                    url, page, response.headers.get("ETag"),
+                                    response.headers.get("Last-Modified")
+                                )
+                            return page
+                        if response.status not in RETRY_STATUSES:
+                            break
+                        retry_after = response.headers.get("Retry-After")
+                        if retry_after is not None and retry_after.isdigit():
+                            delay = max(delay, float(retry_after))
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+        self.stats["failed"] += 1
+        # Fall back to the cached copy if the page could not be revalidated
+        return self.cache.get(url) if cached else None
+
+    async def _fetch_all(self, urls: List[str],
+                         on_page: Optional[Callable[[str, Optional[str]],
+                                                    Any]]) -> List[Any]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        rate_limiter = HostRateLimiter(self.requests_per_second)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(headers=HEADERS,
+                                         connector=connector,
+                                         timeout=timeout) as session:
+            async def fetch_one(url):
+                page = await self._fetch(session, semaphore, rate_limiter,
+                                         url)
+                if on_page is not None:
+                    return on_page(url, page)
+                return page
+
+            # A fixed number of workers take the next url when they are done,
+            # so that memory does not grow with the number of urls. There are
+            # more workers than requests in flight, so that workers waiting
+            # to retry do not hold up the others.
+            results = [None] * len(urls)
+            pending = iter(enumerate(urls))
+
+            async def worker():
+                for i, url in pending:
+                    results[i] = await fetch_one(url)
+
+            await asyncio.gather(*(worker()
+                                   for _ in range(4 * self.concurrency)))
+            return results
+
+    def fetch_all(self, urls: List[str],
+                  on_page: Optional[Callable[[str, Optional[str]], Any]] = None
+                  ) -> List[Any]:
+        """Fetches all urls concurrently.
+
+        Args:
+            urls: The urls to fetch.
+            on_page: Optional function called with the url and page text (or
+                None) as soon as a page has been fetched, e.g. to parse it. The
+                page text is then not kept in memory.
+
+        Returns:
+            For every url in the given order, the page text or None, or the
+                result of `on_page` if given.
+        """
+        return asyncio.run(self._fetch_all(urls, on_page))
+
+
+def get_pages(urls: List[str], **fetcher_kwargs) -> List[Optional[str]]:
+    """Fetches many pages concurrently, see `AsyncFetcher`.
+
+    Returns:
+        For every url, the page text or None if it could not be fetched.
+    """
+    return AsyncFetcher(**fetcher_kwargs).fetch_all(urls)
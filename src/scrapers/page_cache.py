@@ -0,0 +1,145 @@
+"""Page Cache.
+
+On-disk state of the scrapers, so that an interrupted scrape can be resumed.
+
+    PageCache:        Raw HTML of every fetched page, stored under the hash of
+                      its url together with its ETag and Last-Modified headers.
+                      Pages can be re-parsed from it without any network
+                      access, e.g. after fixing a selector.
+    RecordCheckpoint: Append-only JSON lines file of every parsed recipe. On
+                      restart, pages which were already parsed are skipped.
+                      Records are indexed by their offset in the file, so
+                      that they can be streamed into a dataset.
+"""
+import hashlib
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional
+
+
+class PageCache:
+    """Raw HTML cache keyed by url."""
+    def __init__(self, cache_dir: Path):
+        """Creates the cache.
+
+        Args:
+            cache_dir: Directory the pages are stored in.
+        """
+        self.cache_dir = cache_dir
+
+    def _path(self, url: str) -> Path:
+        key = hashlib.sha256(url.strip().encode("utf-8")).hexdigest()
+        return self.cache_dir / key[:2] / key
+
+    def __contains__(self, url: str) -> bool:
+        return self._path(url).with_suffix(".html").exists()
+
+    def urls(self) -> Iterator[str]:
+        """Iterates over the urls of all cached pages."""
+        for path in self.cache_dir.glob("*/*.json"):
+            yield json.loads(path.read_text(encoding="utf-8"))["url"]
+
+    def get(self, url: str) -> Optional[str]:
+        """Gets the cached HTML of a url, or None if it is not cached."""
+        path = self._path(url).with_suffix(".html")
+        if not path.exists():
+            return None
+        return path.read_text(encoding="utf-8")
+
+    def metadata(self, url: str) -> Optional[dict]:
+        """Gets the metadata of a cached url, or None if it is not cached.
+
+        Returns:
+            A dictionary with keys [url, etag, last_modified, fetched_at].
+        """
+        path = self._path(url).with_suffix(".json")
+        if not path.exists():
+            return None
+        return json.loads(path.read_text(encoding="utf-8"))
+
+    def put(self, url: str, html: str, etag: Optional[str] = None,
+            last_modified: Optional[str] = None):
+        """Stores the HTML of a url along with its caching headers."""
+        path = self._path(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so that a crash never leaves a
+        # partially written page behind
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(html, encoding="utf-8")
+        tmp_path.replace(path.with_suffix(".html"))
+        path.with_suffix(".json").write_text(json.dumps({
+            "url": url.strip(),
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": datetime.now(timezone.utc).isoformat()
+        }), encoding="utf-8")
+
+
+class RecordCheckpoint:
+    """Append-only checkpoint of parsed records keyed by url."""
+    def __init__(self, path: Path, url_key: str = "recipe_url"):
+        """Opens the checkpoint.
+
+        Args:
+            path: Path of the JSON lines file.
+            url_key: Key of the records which holds their url.
+        """
+        self.path = path
+        self.url_key = url_key
+
+    def index(self) -> Dict[str, int]:
+        """Indexes all checkpointed records without keeping them in memory.
+
+        Returns:
+            The offset of the latest record of every stripped url, to be read
+                with `iter_records`. A truncated last line, e.g. from a crash
+                while writing, is removed.
+        """
+        offsets = {}
+        if not self.path.exists():
+            return offsets
+        good_length = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                offsets[record[self.url_key].strip()] = good_length
+                good_length += len(line)
+        # Drop anything after the last complete record, so that new records
+        # are appended on a fresh line
+        with open(self.path, "r+b") as f:
+            f.truncate(good_length)
+        return offsets
+
+    def iter_records(self, offsets: Iterable[int]) -> Iterator[dict]:
+        """Reads the records at the given offsets, one at a time.
+
+        Reads nothing if there is no checkpoint, e.g. when no page could be
+        parsed.
+        """
+        if not self.path.exists():
+            return
+        with open(self.path, "rb") as f:
+            for offset in offsets:
+                f.seek(offset)
+                yield json.loads(f.readline())
+
+    def append(self, record: dict) -> int:
+        """Appends a record and flushes it to disk.
+
+        Returns:
+            The offset of the record.
+        """
+        with open(self.path, "ab") as f:
+            offset = f.seek(0, 2)
+            f.write((json.dumps(record) + "\n").encode("utf-8"))
+        return offset
+
+    def clear(self):
+        """Removes all checkpointed records."""
+        self.path.unlink(missing_ok=True)
@@ -1,35 +1,105 @@
-import requests
-from bs4 import BeautifulSoup
+import json
+import re
+from argparse import ArgumentParser
+from html import unescape
 from pathlib import Path
+from typing import Optional
+
+from lxml import etree, html as lxml_html
 from tqdm import tqdm
-import pandas as pd
+
+from scrapers.fetch import AsyncFetcher, get_pages
+from preprocessing.dataset_store import write_recipe_records
+from preprocessing.delta import write_delta
+from scrapers.page_cache import PageCache, RecordCheckpoint
+
+# Pages are parsed from bytes, so that encoding declarations in the HTML are
+# not rejected by lxml
+HTML_PARSER = lxml_html.HTMLParser(encoding="utf-8")
+
+COMPOUND_SELECTOR = re.compile(
+    r"^(?P<tag>[\w-]*)(?:#(?P<id>[\w-]+))?(?P<classes>(?:\.[\w-]+)*)$"
+)
+TAG_REGEX = re.compile(r"<[^>]+>")
+
+
+def css_to_xpath(selector: str) -> str:
+    """Translates a CSS selector to XPath.
+
+    Only chains of child combinators (`>`) between compound selectors of a
+    tag, an id and classes are supported, e.g. "#main > div.a.b > p".
+    """
+    steps = []
+    for compound in selector.split(">"):
+        match = COMPOUND_SELECTOR.match(compound.strip())
+        if match is None:
+            raise ValueError(f"Unsupported selector: {compound.strip()}")
+        step = match["tag"] or "*"
+        if match["id"]:
+            step += f"[@id='{match['id']}']"
+        for cls in match["classes"].split(".")[1:]:
+            step += (f"[contains(concat(' ', normalize-space(@class), ' '), "
+                     f"' {cls} ')]")
+        steps.append(step)
+    return "//" + "/".join(steps)
+
+
+# XPath expressions of the recipe page elements, compiled once
+NAME_XPATH = etree.XPath(css_to_xpath(
+    "#__next > div.default-layout > main > div > section > div > "
+    "div.post-header__body.oflow-x-hidden > "
+    "div.headline.post-header__title.post-header__title--masthead-layout > "
+    "h1"))
+DESCRIPTION_XPATH = etree.XPath(css_to_xpath(
+    "#__next > div.default-layout > main > div > section > div > "
+    "div.post-header__body.oflow-x-hidden > "
+    "div.editor-content.mt-sm.pr-xxs.hidden-print > p"))
+NUTRITION_NAME_XPATH = etree.XPath(css_to_xpath(
+    "#__next > div.default-layout > main > div > section > div > "
+    "div.post-header__body.oflow-x-hidden > table > tbody > tr > "
+    "td.key-value-blocks__key"))
+NUTRITION_VALUE_XPATH = etree.XPath(css_to_xpath(
+    "#__next > div.default-layout > main > div > section > div > "
+    "div.post-header__body.oflow-x-hidden > table > tbody > tr > "
+    "td.key-value-blocks__value"))
+INGREDIENT_XPATH = etree.XPath(css_to_xpath(
+    "#__next > div.default-layout > main > div > div > "
+    "div.layout-md-rail > div.layout-md-rail__primary > "
+    "div.post__content > div > div > "
+    "section.recipe__ingredients.col-12.mt-md.col-lg-6 > section > ul > li"))
+METHOD_XPATH = etree.XPath(css_to_xpath(
+    "#__next > div.default-layout > main > div > div > "
+    "div.layout-md-rail > div.layout-md-rail__primary > "
+    "div.post__content > div > div > "
+    "section.recipe__method-steps.mb-lg.col-12.col-lg-6 > div > ul > "
+    "li > div > p"))
+LINK_XPATH = etree.XPath("//a/@href")
+JSON_LD_XPATH = etree.XPath("//script[@type='application/ld+json']/text()")
+
+# Nutrition names of the JSON-LD block, mapped to the names on the page
+JSON_LD_NUTRITION = {"calories": "kcal",
+                     "fatContent": "fat",
+                     "saturatedFatContent": "saturates",
+                     "carbohydrateContent": "carbs",
+                     "sugarContent": "sugars",
+                     "fiberContent": "fibre",
+                     "proteinContent": "protein",
+                     "sodiumContent": "salt"}
 
 
 def get_one_page(url):
-    headers = {'user-agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) '
-                             'AppleWebKit/537.36 (KHTML, like Gecko) '
-                             'Chrome/70.0.3538.25 '
-                             'Safari/537.36 '
-                             'Core/1.70.3777.400 '
-                             'QQBrowser/10.6.4212.400'}
-    url = url.strip()
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.text
-    return None
+    return get_pages([url])[0]
+
+
+def parse_html(page: str) -> etree.ElementBase:
+    """Parses a page into an lxml tree."""
+    return lxml_html.fromstring(page.encode("utf-8"), parser=HTML_PARSER)
 
 
 def parse_one_page(url):
-    soup = BeautifulSoup(url, 'html.parser')
-    # get all the links in this page
-    hrefs = []
-    for link in soup.findAll('a'):
-        hrefs.append(link.get('href'))
-    res = list(filter(None, hrefs))
-    # print(res)
     # get all needed links
     links = []
-    for href in res:
+    for href in LINK_XPATH(parse_html(url)):
         if href.startswith('/recipes/'):
             if (not href.startswith('/recipes/category/')
                     and not href.startswith('/recipes/collection/')):
@@ -39,81 +109,152 @@ def parse_one_page(url):
     return links
 
 
+def _strip_tags(text: str) -> str:
+    return unescape(TAG_REGEX.sub("", text)).strip()
+
+
+def _find_json_ld_recipe(node) -> Optional[dict]:
+    """Finds the Recipe object within a JSON-LD document."""
+    if isinstance(node, list):
+        for item in node:
+            recipe = _find_json_ld_recipe(item)
+            if recipe is not None:
+                return recipe
+    elif isinstance(node, dict):
+        types = node.get("@type")
+        if types == "Recipe" or (isinstance(types, list)
+                                 and "Recipe" in types):
+            return node
+        return _find_json_ld_recipe(node.get("@graph"))
+    return None
+
+
+def _json_ld_steps(instructions) -> list:
+    """Flattens JSON-LD recipe instructions into a list of step texts."""
+    if isinstance(instructions, str):
+        return [instructions]
+    steps = []
+    for step in instructions or []:
+        if isinstance(step, str):
+            steps.append(step)
+        elif "itemListElement" in step:
+            # HowToSection
+            steps.extend(_json_ld_steps(step["itemListElement"]))
+        elif "text" in step:
+            steps.append(step["text"])
+    return steps
+
+
+def parse_json_ld(currenturl: str, tree: etree.ElementBase) -> Optional[dict]:
+    """Reads a recipe from the JSON-LD `Recipe` block embedded in a page.
+
+    Args:
+        currenturl: The url of the recipe.
+        tree: The parsed page.
+
+    Returns:
+        The recipe in the same format as `parse_one_article`, or None if the
+            page contains no JSON-LD recipe.
+    """
+    recipe = None
+    for block in JSON_LD_XPATH(tree):
+        try:
+            recipe = _find_json_ld_recipe(json.loads(block))
+        except json.JSONDecodeError:
+            continue
+        if recipe is not None:
+            break
+    if recipe is None or "name" not in recipe:
+        return None
+
+    nutrition_name = []
+    nutrition_value = []
+    for key, value in (recipe.get("nutrition") or {}).items():
+        if key in JSON_LD_NUTRITION:
+            nutrition_name.append(JSON_LD_NUTRITION[key])
+            # "479 calories" -> "479", "20 g" -> "20g"
+            nutrition_value.append(
+                str(value).replace("calories", "").replace(" ", "")
+            )
+    steps = _json_ld_steps(recipe.get("recipeInstructions"))
+    return {"name": _strip_tags(recipe["name"]),
+            "description": _strip_tags(recipe.get("description", "")),
+            "nutrition_name": nutrition_name,
+            "nutrition_value": nutrition_value,
+            "ingredients": [_strip_tags(ingredient) for ingredient
+                            in recipe.get("recipeIngredient", [])],
+            "method": ['Step' + str(i + 1) + ': ' + _strip_tags(step)
+                       for i, step in enumerate(steps)],
+            "recipe_url": currenturl}
+
+
 def parse_one_article(currenturl, link):
-    if link is not None:
-        soup = BeautifulSoup(link, 'lxml')
-        name = soup.select(
-            "#__next > div.default-layout > main > div > section > div > "
-            "div.post-header__body.oflow-x-hidden > "
-            "div.headline.post-header__title.post-header__title--masthead"
-            "-layout > h1")[
-            0].get_text()
-        description = soup.select(
-            "#__next > div.default-layout > main > div > section > div > "
-            "div.post-header__body.oflow-x-hidden > "
-            "div.editor-content.mt-sm.pr-xxs.hidden-print > p")[
-            0].get_text()
-        # prep_time=soup.select("#__next > div.default-layout > main > div >
-        # section > div > div.post-header__body.oflow-x-hidden >
-        # ul.post-header__row.post-header__planning.list.list--horizontal >
-        # li > div > div.icon-with-text__children > ul > li > span > time")
-        # cook_time=soup.select("#__next > div.default-layout > main > div >
-        # section > div > div.post-header__body.oflow-x-hidden >
-        # ul.post-header__row.post-header__planning.list.list--horizontal >
-        # li > div > div.icon-with-text__children > ul > li > span > time")
-        nutrition_names = soup.select(
-            "#__next > div.default-layout > main > div > section > div > "
-            "div.post-header__body.oflow-x-hidden > table > tbody > tr > "
-            "td.key-value-blocks__key")
-        nutrition_name = []
-        for i in range(len(nutrition_names)):
-            nutrition_name.append(nutrition_names[i].get_text())
-        nutrition_values = soup.select(
-            "#__next > div.default-layout > main > div > section > div > "
-            "div.post-header__body.oflow-x-hidden > table > tbody > tr > "
-            "td.key-value-blocks__value")
-        nutrition_value = []
-        for i in range(len(nutrition_values)):
-            nutrition_value.append(nutrition_values[i].get_text())
-        ingredient_list = soup.select(
-            "#__next > div.default-layout > main > div > div > "
-            "div.layout-md-rail > div.layout-md-rail__primary > "
-            "div.post__content > div > div > "
-            "section.recipe__ingredients.col-12.mt-md.col-lg-6 > section > ul "
-            "> li")
-        ingredients = []
-        for i in range(len(ingredient_list)):
-            ingredients.append(ingredient_list[i].get_text())
-        methods = soup.select(
-            "#__next > div.default-layout > main > div > div > "
-            "div.layout-md-rail > div.layout-md-rail__primary > "
-            "div.post__content > div > div > "
-            "section.recipe__method-steps.mb-lg.col-12.col-lg-6 > div > ul > "
-            "li > div > p")
-        method = []
-        for i in range(len(methods)):
-            method.append('Step' + str(i + 1) + ': ' + methods[i].get_text())
-        # name=['title','description','nutrition_name',' nutrition_value',
-        # 'ingredients','recipe_url']
-        data = {"name": name,
-                "description": description,
-                "nutrition_name": nutrition_name,
-                "nutrition_value": nutrition_value,
-                "ingredients": ingredients,
-                "method": method,
-                "recipe_url": currenturl}
-        return 1, data
-    return 0, None
-
-
-def scrape_from_bbc(data_dir: Path):
-    data = {"name": [],
-            "description": [],
-            "nutrition_name": [],
-            "nutrition_value": [],
-            "ingredients": [],
-            "method": [],
-            "recipe_url": []}
+    """Extracts a recipe from a BBC Good Food recipe page.
+
+    The page elements are located with precompiled XPath expressions. If the
+    page layout does not match them, the recipe is read from the JSON-LD block
+    embedded in the page instead.
+
+    Args:
+        currenturl: The url of the recipe.
+        link: The HTML of the recipe page.
+
+    Returns:
+        A tuple of (1, recipe), or (0, None) if the page is missing or holds
+            no recipe.
+    """
+    if link is None or not link.strip():
+        return 0, None
+    tree = parse_html(link)
+    names = NAME_XPATH(tree)
+    descriptions = DESCRIPTION_XPATH(tree)
+    if not names or not descriptions:
+        data = parse_json_ld(currenturl, tree)
+        return (0, None) if data is None else (1, data)
+
+    data = {"name": names[0].text_content(),
+            "description": descriptions[0].text_content(),
+            "nutrition_name": [element.text_content() for element
+                               in NUTRITION_NAME_XPATH(tree)],
+            "nutrition_value": [element.text_content() for element
+                                in NUTRITION_VALUE_XPATH(tree)],
+            "ingredients": [element.text_content() for element
+                            in INGREDIENT_XPATH(tree)],
+            "method": ['Step' + str(i + 1) + ': ' + element.text_content()
+                       for i, element in enumerate(METHOD_XPATH(tree))],
+            "recipe_url": currenturl}
+    return 1, data
+
+
+def scrape_from_bbc(data_dir: Path, concurrency: int = 8,
+                    requests_per_second: float = 5., offline: bool = False,
+                    reparse: bool = False, incremental: bool = False,
+                    revalidate: bool = False):
+    """Scrapes recipes from BBC Good Food.
+
+    Fetched pages are cached in `data_dir/html_cache/bbc` and parsed recipes
+    are checkpointed in `recipe_bbc_checkpoint.jsonl`, so that an interrupted
+    scrape continues where it stopped.
+
+    Args:
+        data_dir: Path to the data directory.
+        concurrency: Maximum number of pages fetched at once.
+        requests_per_second: Maximum number of requests per second.
+        offline: Whether to only use cached pages, without network access.
+        reparse: Whether to discard the checkpoint and parse all pages again,
+            e.g. after fixing a selector.
+        incremental: Whether to discover recipe urls again and only scrape
+            the new ones. The new and changed recipes are also written to the
+            delta dataset, see `preprocessing.delta`.
+        revalidate: Whether already scraped recipes are revalidated with
+            conditional GETs, so that changed recipes are scraped again.
+    """
+    cache = PageCache(data_dir / "html_cache" / "bbc")
+    fetcher = AsyncFetcher(concurrency, requests_per_second, cache=cache,
+                           offline=offline, revalidate=revalidate)
+    checkpoint = RecordCheckpoint(data_dir / "recipe_bbc_checkpoint.jsonl")
+    if reparse:
+        checkpoint.clear()
     # with open('../data/recipe_bbc.csv', 'w', encoding='utf-8-sig',
     #           newline='') as f:
     #     f.truncate(0)
@@ -132,31 +273,91 @@ def scrape_from_bbc(data_dir: Path):
         print("Links file exists. Using prefetched links.")
         with open(links_file) as f:
             links = f.readlines()
-    else:
-        for url in tqdm(urls, desc="Collecting recipe urls"):
-            page = get_one_page(url)
+    if not links or (incremental and not offline):
+        print("Collecting recipe urls...")
+        # Search pages change over time, so they are never cached
+        search_fetcher = AsyncFetcher(concurrency, requests_per_second)
+        known_links = set(links)
+        for page in search_fetcher.fetch_all(urls):
+            if page is None:
+                continue
             for link in parse_one_page(page):
-                links.append(f"https://www.bbcgoodfood.com{link}\n")
+                link = f"https://www.bbcgoodfood.com{link}\n"
+                if link not in known_links:
+                    known_links.add(link)
+                    links.append(link)
         with open(links_file, "w") as f:
             f.writelines(links)
 
-    p_bar = tqdm(total=len(links), desc="Parsing recipes")
-    for link in links:
-        current_url = link
-        page = get_one_page(current_url)
-        count, recipe_data = parse_one_article(current_url, page)
+    # Only the offsets of parsed recipes are kept in memory, the recipes
+    # themselves are streamed from the checkpoint into the dataset
+    parsed = checkpoint.index()
+    to_parse = [link for link in links if link.strip() not in parsed]
+    to_revalidate = [link for link in links
+                     if link.strip() in parsed] if revalidate else []
+    print(f"{len(parsed)} recipes already parsed, {len(to_parse)} to go, "
+          f"{len(to_revalidate)} to revalidate.")
+    p_bar = tqdm(total=len(to_parse) + len(to_revalidate),
+                 desc="Parsing recipes")
+    delta = set()
 
+    def parse_page(current_url, page):
+        # Parse as soon as a page arrives, so pages aren't kept in memory
+        url = current_url.strip()
+        if url in parsed and url not in fetcher.changed:
+            # The page has not changed since it was parsed
+            p_bar.update(1)
+            return
+        try:
+            count, recipe_data = parse_one_article(current_url, page)
+        except etree.ParserError:
+            # The page could not be parsed as HTML
+            recipe_data = None
         if recipe_data is not None:
-            for key, value in recipe_data.items():
-                data[key].append(value)
+            parsed[url] = checkpoint.append(recipe_data)
+            delta.add(url)
         else:
-            p_bar.write("Invalid file")
+            p_bar.write(f"Invalid file: {url}")
         p_bar.update(1)
 
-    data_df = pd.DataFrame(data)
-    print(f"Collected {len(data_df)} recipes")
-    data_df.to_pickle(str(data_dir / "recipe_bbc.pkl"))
+    fetcher.fetch_all(to_parse + to_revalidate, parse_page)
+    p_bar.close()
+    print(f"Fetched {fetcher.stats['fetched']} pages, "
+          f"{fetcher.stats['cached']} from cache, "
+          f"{fetcher.stats['not_modified']} not modified, "
+          f"{fetcher.stats['failed']} failed.")
+
+    urls = [link.strip() for link in links]
+    count = write_recipe_records(
+        checkpoint.iter_records(parsed[url] for url in urls if url in parsed),
+        data_dir / "recipe_bbc.parquet"
+    )
+    print(f"Collected {count} recipes")
+    if incremental:
+        write_delta(data_dir, "recipe_bbc.parquet",
+                    list(checkpoint.iter_records(parsed[url] for url in urls
+                                                 if url in delta)))
+
+
+def parse_args():
+    p = ArgumentParser(description="Scrapes recipes from BBC Good Food.")
+    p.add_argument("DATA_DIR", type=Path, nargs="?", default=Path("../data/"),
+                   help="Path to the data directory.")
+    p.add_argument("--offline", action="store_true",
+                   help="Only use cached pages, without network access.")
+    p.add_argument("--reparse", action="store_true",
+                   help="Parse all pages again instead of resuming from the "
+                        "checkpoint.")
+    p.add_argument("--incremental", action="store_true",
+                   help="Discover recipe urls again, only scrape new recipes "
+                        "and write them to the delta dataset.")
+    p.add_argument("--revalidate", action="store_true",
+                   help="Revalidate already scraped recipes with conditional "
+                        "GETs and scrape the changed ones again.")
+    return p.parse_args()
 
 
 if __name__ == '__main__':
-    scrape_from_bbc(Path('../data/'))
+    args = parse_args()
+    scrape_from_bbc(args.DATA_DIR, offline=args.offline, reparse=args.reparse,
+                    incremental=args.incremental, revalidate=args.revalidate)
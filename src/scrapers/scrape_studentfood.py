@@ -1,87 +1,237 @@
-import pandas as pd
-import requests
+import re
+from argparse import ArgumentParser
+from typing import List
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
 from bs4 import BeautifulSoup
 from tqdm import tqdm
 from pathlib import Path
 
+from preprocessing.dataset_store import write_recipe_records
+from preprocessing.delta import write_delta
+from scrapers.fetch import AsyncFetcher
+from scrapers.page_cache import PageCache, RecordCheckpoint
+
+SECTIONS = ["main-courses", "lunch", "breakfasts", "desserts", "drinks",
+            "vegan"]
+
+
+def normalize_url(base_url: str, href: str) -> str:
+    """Makes a link absolute and drops its query, fragment and trailing slash.
+
+    Different links to the same recipe thereby map to the same url.
+    """
+    parts = urlsplit(urljoin(base_url, href.strip()))
+    path = re.sub(r"/{2,}", "/", parts.path).rstrip("/")
+    return urlunsplit((parts.scheme, parts.netloc.lower(), path, "", ""))
 
-def get_recipe_urls(base_url: str):
-    """Gets all recipe urls from the different sections on the website."""
+
+def get_recipe_urls(base_url: str, fetcher: AsyncFetcher) -> List[str]:
+    """Gets all recipe urls from the different sections on the website.
+
+    The sections are fetched concurrently.
+
+    Args:
+        base_url: The url of the website.
+        fetcher: The fetcher used to get the section pages.
+
+    Returns:
+        The normalized recipe urls, without duplicates, in order of discovery.
+    """
+    section_urls = [base_url + section for section in SECTIONS]
     recipe_urls = []
+    seen = set()
+    duplicates = 0
 
-    for i in ["/main-courses", "/lunch", "/breakfasts", "/desserts", "/drinks",
-              "/vegan"]:
-        page = requests.get(base_url + i)
-        soup = BeautifulSoup(page.content, 'html.parser')
+    for page in fetcher.fetch_all(section_urls):
+        if page is None:
+            continue
+        soup = BeautifulSoup(page, 'html.parser')
         for link in soup.find_all(
                 "a",
                 href=lambda href: href and "/recipes/" in href
         ):
-            if link not in recipe_urls:
-                recipe_urls.append(link.get("href"))
-    print(recipe_urls)
+            url = normalize_url(base_url, link.get("href"))
+            if url in seen:
+                duplicates += 1
+                continue
+            seen.add(url)
+            recipe_urls.append(url)
+    print(f"Found {len(recipe_urls)} recipe urls in {len(section_urls)} "
+          f"sections ({duplicates} duplicate links skipped).")
     return recipe_urls
 
 
-def scrape_from_studentfoodproject(data_dir: Path):
-    """Scrapes recipes from The Student Food Project."""
+def parse_recipe(recipe_url: str, html: str) -> dict:
+    """Parses a recipe page of The Student Food Project.
+
+    Args:
+        recipe_url: The url of the recipe.
+        html: The HTML of the recipe page.
+
+    Returns:
+        The recipe with keys [name, description, nutrition_name,
+            nutrition_value, ingredients, method, recipe_url].
+    """
+    # Get ingredients
+    recipe_ingredients = []
+    soup = BeautifulSoup(html, 'html.parser')
+    recipe_ingredients_p = soup.find(
+        'div', class_='recipe-ingrediens w-richtext'
+    ).find_all('p')
+    for i in recipe_ingredients_p:
+        recipe_ingredients.append(i.text)
+
+    # Get method
+    recipe_method_p = soup.find(
+        'div', class_='recipe-method w-richtext'
+    ).find_all('p')
+    recipe_method = []
+    for i in range(len(recipe_method_p)):
+        recipe_method.append(f"Step{i}:{recipe_method_p[i].text}")
+
+    # Get title
+    recipe_title = soup.find('h1', class_='recipe-title').text
+
+    # Get description
+    recipe_desc = soup.find('div', class_='recipe-description').text
+
+    return {"name": recipe_title,
+            "description": recipe_desc,
+            "nutrition_name": None,
+            "nutrition_value": None,
+            "ingredients": recipe_ingredients,
+            "method": recipe_method,
+            "recipe_url": recipe_url}
+
+
+def scrape_from_studentfoodproject(data_dir: Path, offline: bool = False,
+                                   reparse: bool = False,
+                                   concurrency: int = 8,
+                                   requests_per_second: float = 5.,
+                                   incremental: bool = False,
+                                   revalidate: bool = False):
+    """Scrapes recipes from The Student Food Project.
+
+    Fetched pages are cached in `data_dir/html_cache/studentfood` and parsed
+    recipes are checkpointed in `studentfoodrecipe_checkpoint.jsonl`, so that
+    an interrupted scrape continues where it stopped.
+
+    Args:
+        data_dir: Path to the data directory.
+        offline: Whether to only use cached pages, without network access.
+        reparse: Whether to discard the checkpoint and parse all pages again,
+            e.g. after fixing a selector.
+        concurrency: Maximum number of pages fetched at once.
+        requests_per_second: Maximum number of requests per second.
+        incremental: Whether to discover recipe urls again and only scrape
+            the new ones. The new and changed recipes are also written to the
+            delta dataset, see `preprocessing.delta`.
+        revalidate: Whether already scraped recipes are revalidated with
+            conditional GETs, so that changed recipes are scraped again.
+    """
     base_url = "https://www.thestudentfoodproject.com/"
 
-    recipe_urls = get_recipe_urls(base_url)
-
-    data = {"name": [],
-            "description": [],
-            "nutrition_name": [],
-            "nutrition_value": [],
-            "ingredients": [],
-            "method": [],
-            "recipe_url": []}
-
-    prog_bar = tqdm(total=len(recipe_urls))
-    prog_bar.set_description(f"Starting download")
-
-    for recipe in recipe_urls:
-        recipe_url = base_url + recipe
-        recipe_page = requests.get(recipe_url)
-
-        # Get ingredients
-        recipe_ingredients = []
-        soup = BeautifulSoup(recipe_page.content, 'html.parser')
-        recipe_ingredients_p = soup.find(
-            'div', class_='recipe-ingrediens w-richtext'
-        ).find_all('p')
-        for i in recipe_ingredients_p:
-            recipe_ingredients.append(i.text)
-
-        # Get method
-        recipe_method_p = soup.find(
-            'div', class_='recipe-method w-richtext'
-        ).find_all('p')
-        recipe_method = []
-        for i in range(len(recipe_method_p)):
-            recipe_method.append(f"Step{i}:{recipe_method_p[i].text}")
-
-        # Get title
-        recipe_title = soup.find('h1', class_='recipe-title').text
-        prog_bar.set_description(f"Downloading {recipe_title}")
-
-        # Get description
-        recipe_desc = soup.find('div', class_='recipe-description').text
-
-        # Add everything to data
-        data["name"].append(recipe_title)
-        data["description"].append(recipe_desc)
-        data["nutrition_name"].append(None)
-        data["nutrition_value"].append(None)
-        data["ingredients"].append(recipe_ingredients)
-        data["method"].append(recipe_method)
-        data["recipe_url"].append(recipe_url)
+    cache = PageCache(data_dir / "html_cache" / "studentfood")
+    fetcher = AsyncFetcher(concurrency, requests_per_second, cache=cache,
+                           offline=offline, revalidate=revalidate)
+    checkpoint = RecordCheckpoint(
+        data_dir / "studentfoodrecipe_checkpoint.jsonl"
+    )
+    if reparse:
+        checkpoint.clear()
 
+    urls_file = data_dir / "sfp_recipe_urls.txt"
+    recipe_urls = []
+    if urls_file.exists():
+        print("Links file exists. Using prefetched links.")
+        recipe_urls = list(dict.fromkeys(
+            normalize_url(base_url, href)
+            for href in urls_file.read_text().split()
+        ))
+    if not recipe_urls or (incremental and not offline):
+        # Section pages change over time, so they are never cached
+        recipe_urls = list(dict.fromkeys(recipe_urls + get_recipe_urls(
+            base_url, AsyncFetcher(concurrency, requests_per_second)
+        )))
+        urls_file.write_text("\n".join(recipe_urls) + "\n")
+
+    # Only the offsets of parsed recipes are kept in memory, the recipes
+    # themselves are streamed from the checkpoint into the dataset
+    parsed = checkpoint.index()
+    to_parse = [url for url in recipe_urls if url not in parsed]
+    to_revalidate = [url for url in recipe_urls
+                     if url in parsed] if revalidate else []
+    print(f"{len(parsed)} recipes already parsed, {len(to_parse)} to go, "
+          f"{len(to_revalidate)} to revalidate.")
+
+    prog_bar = tqdm(total=len(to_parse) + len(to_revalidate),
+                    desc="Parsing recipes")
+    delta = set()
+
+    def parse_page(recipe_url, html):
+        # Parse as soon as a page arrives, so pages aren't kept in memory
+        if recipe_url in parsed and recipe_url not in fetcher.changed:
+            # The page has not changed since it was parsed
+            prog_bar.update(1)
+            return
+        if html is not None:
+            try:
+                recipe_data = parse_recipe(recipe_url, html)
+            except AttributeError:
+                # The page layout did not match the selectors
+                prog_bar.write(f"Invalid file: {recipe_url}")
+            else:
+                parsed[recipe_url] = checkpoint.append(recipe_data)
+                delta.add(recipe_url)
         prog_bar.update(1)
 
-    data_df = pd.DataFrame(data)
-    data_df.to_pickle(str(data_dir / "studentfoodrecipe.pkl"))
+    fetcher.fetch_all(to_parse + to_revalidate, parse_page)
+    prog_bar.close()
+    print(f"Fetched {fetcher.stats['fetched']} pages, "
+          f"{fetcher.stats['cached']} from cache, "
+          f"{fetcher.stats['not_modified']} not modified, "
+          f"{fetcher.stats['failed']} failed. Skipped "
+          f"{len(recipe_urls) - len(to_parse)} already parsed recipes.")
+
+    write_recipe_records(
+        checkpoint.iter_records(parsed[url] for url in recipe_urls
+                                if url in parsed),
+        data_dir / "studentfoodrecipe.parquet"
+    )
+    if incremental:
+        write_delta(data_dir, "studentfoodrecipe.parquet",
+                    list(checkpoint.iter_records(parsed[url]
+                                                 for url in recipe_urls
+                                                 if url in delta)))
+
+
+def parse_args():
+    p = ArgumentParser(description="Scrapes recipes from The Student Food "
+                                   "Project.")
+    p.add_argument("DATA_DIR", type=Path, nargs="?",
+                   default=Path('../../data/'),
+                   help="Path to the data directory.")
+    p.add_argument("--offline", action="store_true",
+                   help="Only use cached pages, without network access.")
+    p.add_argument("--reparse", action="store_true",
+                   help="Parse all pages again instead of resuming from the "
+                        "checkpoint.")
+    p.add_argument("--concurrency", type=int, default=8,
+                   help="Maximum number of pages fetched at once.")
+    p.add_argument("--incremental", action="store_true",
+                   help="Discover recipe urls again, only scrape new recipes "
+                        "and write them to the delta dataset.")
+    p.add_argument("--revalidate", action="store_true",
+                   help="Revalidate already scraped recipes with conditional "
+                        "GETs and scrape the changed ones again.")
+    return p.parse_args()
 
 
 if __name__ == '__main__':
-    scrape_from_studentfoodproject(Path('../../data/'))
+    args = parse_args()
+    scrape_from_studentfoodproject(args.DATA_DIR, offline=args.offline,
+                                   reparse=args.reparse,
+                                   concurrency=args.concurrency,
+                                   incremental=args.incremental,
+                                   revalidate=args.revalidate)
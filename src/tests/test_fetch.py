@@ -0,0 +1,149 @@
+"""Tests of the fetcher against a local fixture HTTP server.
+
+Run from the `src` directory:
+    python -m unittest discover tests
+"""
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from scrapers.fetch import AsyncFetcher
+from scrapers.page_cache import PageCache
+
+ETAG = '"v1"'
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """Serves the pages of the tests, recording the requests."""
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests[self.path] += 1
+            server.request_headers.append((self.path, dict(self.headers)))
+            count = server.requests[self.path]
+
+        if self.path.startswith("/flaky/"):
+            # Fails with a 503 as often as the path says, then succeeds
+            if count <= int(self.path.split("/")[2]):
+                return self._respond(503, "unavailable")
+            return self._respond(200, "recovered")
+        if self.path == "/missing":
+            return self._respond(404, "not found")
+        if self.path.startswith("/slow/"):
+            with server.lock:
+                server.in_flight += 1
+                server.max_in_flight = max(server.max_in_flight,
+                                           server.in_flight)
+            time.sleep(0.05)
+            with server.lock:
+                server.in_flight -= 1
+            return self._respond(200, self.path)
+        if self.path == "/page":
+            if self.headers.get("If-None-Match") == ETAG:
+                return self._respond(304, None)
+            return self._respond(200, "page", {"ETag": ETAG})
+        self._respond(404, "not found")
+
+    def _respond(self, status: int, body, headers: dict = None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        data = b"" if body is None else body.encode()
+        if status != 304:
+            self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+        cls.server.daemon_threads = True
+        cls.server.lock = threading.Lock()
+        cls.thread = threading.Thread(target=cls.server.serve_forever,
+                                      daemon=True)
+        cls.thread.start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = Counter()
+        self.server.request_headers = []
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+
+    def fetcher(self, **kwargs) -> AsyncFetcher:
+        return AsyncFetcher(**{"requests_per_second": 1000., "backoff": 0.05,
+                               "timeout": 5., **kwargs})
+
+    def test_retries_server_errors_with_backoff(self):
+        fetcher = self.fetcher(retries=3)
+        start = time.monotonic()
+        pages = fetcher.fetch_all([f"{self.base_url}/flaky/2"])
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(pages, ["recovered"])
+        self.assertEqual(self.server.requests["/flaky/2"], 3)
+        # Waits at least 0.05s and then 0.1s before the retries
+        self.assertGreaterEqual(elapsed, 0.15)
+        self.assertEqual(fetcher.stats["fetched"], 1)
+
+    def test_gives_up_after_retries(self):
+        fetcher = self.fetcher(retries=2)
+        pages = fetcher.fetch_all([f"{self.base_url}/flaky/5"])
+
+        self.assertEqual(pages, [None])
+        self.assertEqual(self.server.requests["/flaky/5"], 3)
+        self.assertEqual(fetcher.stats["failed"], 1)
+
+    def test_does_not_retry_client_errors(self):
+        fetcher = self.fetcher(retries=3)
+        pages = fetcher.fetch_all([f"{self.base_url}/missing"])
+
+        self.assertEqual(pages, [None])
+        self.assertEqual(self.server.requests["/missing"], 1)
+
+    def test_bounds_requests_in_flight(self):
+        urls = [f"{self.base_url}/slow/{i}" for i in range(20)]
+        pages = self.fetcher(concurrency=3).fetch_all(urls)
+
+        self.assertEqual(pages, [f"/slow/{i}" for i in range(20)])
+        self.assertLessEqual(self.server.max_in_flight, 3)
+        self.assertGreater(self.server.max_in_flight, 1)
+
+    def test_revalidates_cached_pages(self):
+        url = f"{self.base_url}/page"
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = PageCache(Path(cache_dir))
+            first = self.fetcher(cache=cache)
+            self.assertEqual(first.fetch_all([url]), ["page"])
+            self.assertEqual(first.changed, {url})
+
+            # Cached pages are not fetched again unless revalidated
+            self.assertEqual(self.fetcher(cache=cache).fetch_all([url]),
+                             ["page"])
+            self.assertEqual(self.server.requests["/page"], 1)
+
+            revalidating = self.fetcher(cache=cache, revalidate=True)
+            self.assertEqual(revalidating.fetch_all([url]), ["page"])
+            self.assertEqual(self.server.requests["/page"], 2)
+            _, headers = self.server.request_headers[-1]
+            self.assertEqual(headers.get("If-None-Match"), ETAG)
+            self.assertEqual(revalidating.stats["not_modified"], 1)
+            self.assertEqual(revalidating.changed, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+"""Tests of the checkpoint of parsed records."""
+import tempfile
+import unittest
+from pathlib import Path
+
+from scrapers.page_cache import RecordCheckpoint
+
+
+class RecordCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.checkpoint = RecordCheckpoint(Path(self.tmp_dir.name) /
+                                           "checkpoint.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_reads_nothing_without_checkpoint(self):
+        self.assertEqual(self.checkpoint.index(), {})
+        self.assertEqual(list(self.checkpoint.iter_records([])), [])
+
+    def test_reads_latest_record_of_every_url(self):
+        self.checkpoint.append({"recipe_url": "a", "name": "old"})
+        self.checkpoint.append({"recipe_url": "b ", "name": "b"})
+        self.checkpoint.append({"recipe_url": "a", "name": "new"})
+
+        offsets = self.checkpoint.index()
+        records = self.checkpoint.iter_records(offsets[url]
+                                               for url in ["a", "b"])
+        self.assertEqual([record["name"] for record in records],
+                         ["new", "b"])
+
+
+if __name__ == '__main__':
+    unittest.main()
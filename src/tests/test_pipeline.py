@@ -0,0 +1,72 @@
+"""Tests of running the stage graph of the pipeline."""
+import tempfile
+import unittest
+from pathlib import Path
+
+from pipeline import Pipeline, Stage
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = Path(self.tmp_dir.name)
+        self.scraped = self.data_dir / "scraped.txt"
+        self.cleaned = self.data_dir / "cleaned.txt"
+        self.calls = []
+        self.params = {"ann": False}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def stage(self, name: str, output: Path = None, **kwargs) -> Stage:
+        """A stage recording its calls, which writes its output if any."""
+        def call(kind):
+            def run():
+                self.calls.append(kind)
+                if output is not None:
+                    output.write_text(f"{kind} {self.params}")
+            return run
+
+        return Stage(name, call(name), outputs=[] if output is None
+                     else [output], update=call(f"update {name}"), **kwargs)
+
+    def pipeline(self) -> Pipeline:
+        """An incremental pipeline of scraping, cleaning and loading."""
+        return Pipeline([
+            self.stage("scrape", self.scraped, always_run=True),
+            self.stage("clean", self.cleaned, inputs=[self.scraped],
+                       deps=["scrape"], params=self.params),
+            self.stage("load", inputs=[self.cleaned], deps=["clean"]),
+        ], self.data_dir / "pipeline_state.json")
+
+    def test_runs_every_stage_once_per_process(self):
+        pipeline = self.pipeline()
+        pipeline.run(targets=["clean"])
+        self.assertEqual(pipeline.plan(), {"scrape": None, "clean": None,
+                                           "load": "never run"})
+        pipeline.run()
+
+        self.assertEqual(self.calls, ["scrape", "clean", "load"])
+        self.assertEqual(pipeline.plan(), {"scrape": None, "clean": None,
+                                           "load": None})
+
+    def test_updates_stages_with_new_inputs(self):
+        self.pipeline().run()
+        self.calls.clear()
+        self.pipeline().run()
+
+        self.assertEqual(self.calls, ["update scrape", "update clean",
+                                      "update load"])
+
+    def test_rebuilds_stages_with_changed_params(self):
+        self.pipeline().run()
+        self.calls.clear()
+        self.params["ann"] = True
+        self.pipeline().run()
+
+        # The load is rebuilt too, as the stage it depends on was rebuilt
+        self.assertEqual(self.calls, ["update scrape", "clean", "load"])
+
+
+if __name__ == '__main__':
+    unittest.main()
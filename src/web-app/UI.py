@@ -1,55 +1,51 @@
 import collections
+from argparse import ArgumentParser
 from math import ceil
+from pathlib import Path
 
 import streamlit as st
 import pandas as pd
 import numpy as np
-from neo4j import GraphDatabase
 import sys
 import csv
 
 # sys.path.insert(1,'../nutritional_requirements')
+sys.path.insert(1, str(Path(__file__).resolve().parents[1]))
 from pandas import DataFrame
+from knowledge_graph.recipe_macros import MACROS, load_recipe_macros, \
+    update_recipe_macros
+from knowledge_graph.repository import open_repository
+
+
+def parse_args():
+    # Arguments are given after "--", e.g.
+    # streamlit run UI.py -- --uri sqlite:../../data/graph.sqlite
+    p = ArgumentParser(description="Recipe recommendations for students")
+    p.add_argument("--uri", type=str, default="bolt://localhost:7687",
+                   help="URI of the graph, see "
+                        "knowledge_graph.repository.open_repository")
+    p.add_argument("--user", type=str, default="neo4j",
+                   help="User to authenticate as for neo4j")
+    p.add_argument("--password", type=str, default="password",
+                   help="Password to authenticate with for neo4j")
+    return p.parse_args()
+
+
+@st.cache_resource
+def get_graph(uri, user, password):
+    # Opened once and shared by all reruns and sessions of the app
+    return open_repository(uri, user, password)
 
 
 def get_df(results, columns):
     recipe_list = []
-    for i in results.data():
-        recipe_list.append([i[columns[0]], str(i[columns[1]])])
+    for i in results:
+        recipe_list.append([i[0], str(i[1])])
     df = pd.DataFrame(recipe_list, columns=columns)
     # print(df)
     return df
 
 
-def calculate_nutritional_value(nut_list):
-    nutritional_value = 0
-    # print(nut_list)
-    for i in range(len(nut_list)):
-        try:
-            if 'g' in nut_list[i]['i.amount']:
-                amount = float(nut_list[i]['i.amount'].replace('g', ''))
-            elif 'ml' in nut_list[i]['i.amount']:
-                amount = float(nut_list[i]['i.amount'].replace('ml', ''))
-            elif 'kg' in nut_list[i]['i.amount']:
-                amount = float(nut_list[i]['i.amount'].replace('kg', '')) * 1000
-            else:
-                    amount = float(nut_list[i]['i.amount'])
-        except:
-            amount = 0
-        nutritional_value += amount * (float(nut_list[i]['nv_rel.amount'].replace('g', ''))) / 100
-        # print("nutritional_value", nutritional_value)
-    return nutritional_value
-
-
-def get_nutr_from_db(session, recipe_name, nutrient):
-    query = """MATCH (recipe:Recipe)-[i:HAS_INGREDIENT]->(ing:Ingredient)-[ci:HAS_CANONICAL_NAME]\
-                    ->(can:CanonicalIngredient)-[nv_rel:HAS_NUTRITIONAL_VALUE]->(nv:NutritionalValue{name: $nutrient }) \
-                     WHERE recipe.name = $recipe_name \
-                     RETURN i.amount, nv_rel.amount"""
-    results = session.run(query, recipe_name=recipe_name, nutrient=nutrient)
-    return results
-
-
 def get_recipe_diff(recipe_nutr_dict, person_req_dict):
     recipe_diff = []
     for key in recipe_nutr_dict:
@@ -66,12 +62,9 @@ from nutritional_requirements.compute import compute_nutritional_needs
 
 st.title('Recipe recommendations for students')
 st.subheader('To calculate your nutrition requirements, please enter your information below (metric unit)')
-neo4j_connection = GraphDatabase.driver(uri="bolt://localhost:7687", auth=("neo4j", "password"))
-session = neo4j_connection.session()
-results = (session.run("MATCH p = (recipe:Recipe)-[i:HAS_INGREDIENT]->(ing:Ingredient)-\
-                        [ci:HAS_CANONICAL_NAME]->(can:CanonicalIngredient) \
-                        RETURN DISTINCT can.name"))
-ingredient_list = [i[0] for i in (results.values())]
+args = parse_args()
+graph = get_graph(args.uri, args.user, args.password)
+ingredient_list = graph.recipe_canonical_ingredient_names()
 
 username = st.text_input('Enter username')
 st.session_state['username'] = username
@@ -145,16 +138,10 @@ except ZeroDivisionError:
 carbs, fat, protein = nutrition_requirements.carb_grams, nutrition_requirements.fat_grams / 4, \
                       nutrition_requirements.protein_grams
 
-query_get_recipes = "MATCH (recipe:Recipe) return recipe.name, recipe.method"
-all_recipes = (session.run(query_get_recipes))
+all_recipes = graph.recipes()
 all_recipes_df = get_df(all_recipes, ['recipe.name', 'recipe.method'])
-print("all_recipes.data()", all_recipes.data())
-
-query_get_recipes = 'MATCH p = (recipe:Recipe)-[i:HAS_INGREDIENT]->(ing:Ingredient)-[ci:HAS_CANONICAL_NAME]\
-            ->(can_ing:CanonicalIngredient)\
-            return  recipe.name, can_ing.name'
 
-recipes = (session.run(query_get_recipes))
+recipes = graph.recipe_canonical_ingredients()
 df_recipe = get_df(recipes, ['recipe.name', 'can_ing.name'])
 
 selected_ingredients_list = st.multiselect('Select ingredients (start typing to filter options)', ingredient_list,
@@ -181,6 +168,13 @@ if st.button('Continue'):
     # pick top 5 recipes with the most number of selected ingredients
     sorted_recipes = dict(sorted(recipe_dict.items(), key=lambda item: item[1], reverse=True))
     print(sorted_recipes)
+    # grams of protein, carbohydrates and fat of the top 5 recipes, computed when the graph was loaded
+    recipe_macros = load_recipe_macros(graph, list(sorted_recipes)[:5])
+    # recipes whose macros were never computed, e.g. after a bulk import, get them computed now
+    missing = recipe_macros.index[recipe_macros.isna().any(axis=1)].tolist()
+    if missing:
+        update_recipe_macros(graph, missing)
+        recipe_macros = load_recipe_macros(graph, list(sorted_recipes)[:5])
     counter = 0
     recipe_nut_val= {}
     for i in sorted_recipes:
@@ -188,11 +182,7 @@ if st.button('Continue'):
             break
         else:
             counter += 1
-            recipe_nutr_dict[i] = {'Protein': 0, 'Carbohydrates': 0, 'Total Fat': 0}
-            for j in recipe_nutr_dict[i]:
-                res = get_nutr_from_db(session, i, j)
-                print(j)
-                recipe_nutr_dict[i][j] = ceil(calculate_nutritional_value(res.data()))
+            recipe_nutr_dict[i] = {j: ceil(recipe_macros.at[i, j]) for j in MACROS}
             recipe_nut_val[i] = get_recipe_diff(recipe_nutr_dict[i],
                                                      {'Protein': protein, 'Carbohydrates': carbs, 'Total Fat': fat})
     print(recipe_nutr_dict)
@@ -210,22 +200,13 @@ if st.button('Continue'):
     for i in recipe_nutr_dict[min_diff_recipe]:
         st.write(i + ': ' + str(recipe_nutr_dict[min_diff_recipe][i]))
     st.subheader('Ingredients:')
-    query_get_ingredients = 'MATCH p = (recipe:Recipe)-[i:HAS_INGREDIENT]->(ing:Ingredient) \
-                WHERE recipe.name= $recipe\
-                return ing.name'
-    ingredients = (session.run(query_get_ingredients, recipe=min_diff_recipe))
-    list_ingredients = list(ingredients.data())
+    list_ingredients = graph.recipe_ingredients(min_diff_recipe)
     for i in list_ingredients:
-        st.write(i.get('ing.name'))
+        st.write(i)
     st.subheader('Substitutes:')
-    query_get_substitutes = 'MATCH p = (recipe:Recipe)-[i:HAS_INGREDIENT]->(ing:Ingredient)-[ci:HAS_CANONICAL_NAME]-\
-                (can_ing:CanonicalIngredient)-[s:HAS_SUBSTITUTE]->(sub:CanonicalIngredient) \
-                WHERE recipe.name= $recipe\
-                return ing.name,sub.name '
-    substitutes = (session.run(query_get_substitutes, recipe=min_diff_recipe))
-    list_substitutes = list(substitutes.data())
-    for i in list_substitutes:
-        st.write(i.get('ing.name') + ': ' + i.get('sub.name'))
+    list_substitutes = graph.recipe_substitutes(min_diff_recipe)
+    for ingredient, substitute in list_substitutes:
+        st.write(ingredient + ': ' + substitute)
 
 # todo: get substitutes for the selected ingredients
 # todo: add exception handling to remove error messages
\ No newline at end of file